@@ -0,0 +1,46 @@
+"""
+Mide el cifrado y descifrado de trozos de archivo (AES-GCM) en MB/s según el
+número de hilos del ChunkCipherPool. Con 1 hilo el pool cifra en el hilo que
+llama, así que esa fila sirve de referencia.
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_chunk_pool [MB]
+"""
+import os
+import sys
+import time
+
+from common import protocol
+from common import security
+
+
+def run(pool, function, key, chunks):
+    """Devuelve los segundos que tarda en procesar todos los trozos."""
+    start = time.perf_counter()
+    if function is security.seal_chunk:
+        results = list(pool.seal_chunks(key, chunks))
+    else:
+        results = list(pool.open_chunks(key, chunks))
+    return time.perf_counter() - start, results
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    chunk_size = protocol.FILE_CHUNK_SIZE
+    data = memoryview(os.urandom(megabytes * 1024 * 1024))
+    key = security.generate_session_key()
+    plain = [(index, data[offset:offset + chunk_size]) for index, offset in enumerate(range(0, len(data), chunk_size))]
+
+    print(f"{len(plain)} trozos de {chunk_size // 1024} KiB ({megabytes} MB), {os.cpu_count()} núcleos")
+    print(f"{'hilos':<8}{'cifrar MB/s':>14}{'descifrar MB/s':>16}")
+    for workers in (1, 2, 4, 8):
+        pool = security.ChunkCipherPool(workers)
+        seal_time, sealed = run(pool, security.seal_chunk, key, plain)
+        open_time, opened = run(pool, security.open_chunk, key, list(enumerate(sealed)))
+        assert b"".join(opened) == data
+        pool.shutdown()
+        print(f"{workers:<8}{megabytes / seal_time:>14,.0f}{megabytes / open_time:>16,.0f}")
+
+
+if __name__ == "__main__":
+    main()
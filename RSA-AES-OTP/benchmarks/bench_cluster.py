@@ -0,0 +1,123 @@
+"""
+Rendimiento del modo multiproceso: arranca el servidor con 1, 2 y 4 procesos
+trabajadores, conecta varios clientes (cada uno en su propio proceso) y todos
+envían a la vez mensajes públicos. Mide cuántos mensajes entregados (ya
+cifrados para cada destinatario) por segundo salen del servidor. Con un solo
+núcleo los procesos se turnan y no hay nada que ganar; la mejora se ve con
+tantos núcleos como trabajadores.
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_cluster [clientes] [mensajes por cliente] [threads|asyncio]
+"""
+import contextlib
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from common import protocol
+from common import security
+from server.async_server import AsyncChatServer
+from server.cluster import Cluster
+from server.server import ChatServer
+
+SERVER_BACKENDS = {"threads": ChatServer, "asyncio": AsyncChatServer}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def handshake(port, nickname):
+    """Conexión de cliente con las cuatro fases del protocolo; devuelve el NetworkHandler."""
+    from client.network.handler import NetworkHandler
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        network = NetworkHandler(lambda *args: None, lambda *args: None)
+        if not network.connect("127.0.0.1", port):
+            raise ConnectionError(network.refusal or "no se pudo conectar")
+    reader = network.reader
+    challenge = protocol.as_bytes(reader.read_message()["payload"]["challenge"])
+    otp = security.decrypt_with_rsa(network.rsa_private_key, challenge)
+    network.socket.sendall(network.encoder.encode("otp_response", response=security.encrypt_with_rsa(network.server_rsa_public_pem, otp)))
+    assert reader.read_message()["type"] == "auth_success"
+    network.session_key = security.generate_session_key()
+    network.socket.sendall(network.encoder.encode("aes_key_exchange", key=security.encrypt_with_rsa(network.server_rsa_public_pem, network.session_key)))
+    assert reader.read_message()["type"] == "secure_channel_ready"
+    network.is_listening = True
+    network.send("login", nickname=nickname)
+    return network
+
+
+def client(port, nickname, messages, expected, ready, go, results):
+    network = handshake(port, nickname)
+    ready.put(nickname)
+    go.wait()
+    for i in range(messages):
+        nonce, tag, ciphertext = network.cipher.encrypt(f"mensaje {i}".encode())
+        network.send("public_message", content=protocol.encrypted_payload(nonce, tag, ciphertext))
+    received = 0
+    network.socket.settimeout(60)
+    while received < expected:
+        message = network.reader.read_message()
+        if message is None:
+            break
+        if message["type"] == "public_message":
+            received += 1
+    results.put((received, time.monotonic()))
+    network.disconnect()
+
+
+def run(backend, workers, clients, messages):
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    logs = []
+    cluster = Cluster(
+        SERVER_BACKENDS[backend], "127.0.0.1", port, workers,
+        path=os.path.join(tempfile.gettempdir(), f"bench-broker-{port}.sock"),
+        logger=logs.append, blob_dir=None
+    )
+    cluster.start_in_thread()
+    while sum("Servidor escuchando" in line for line in logs) < workers:
+        time.sleep(0.05)
+
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    expected = messages * (clients - 1)
+    processes = [
+        context.Process(target=client, args=(port, f"user_{i}", messages, expected, ready, go, results))
+        for i in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get(timeout=300)
+    time.sleep(0.5)  # Que se repartan las listas de usuarios antes de empezar
+
+    start = time.monotonic()
+    go.set()
+    finished = [results.get(timeout=300) for _ in processes]
+    elapsed = max(end for _, end in finished) - start
+    for process in processes:
+        process.join()
+    cluster.stop()
+    delivered = sum(received for received, _ in finished)
+    return delivered, elapsed, delivered == expected * clients
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    backend = sys.argv[3] if len(sys.argv) > 3 else "asyncio"
+    print(f"{clients} clientes x {messages} mensajes públicos, backend {backend}, {os.cpu_count()} núcleos")
+    print(f"{'procesos':<10}{'entregados':>12}{'segundos':>10}{'msg/s':>10}  completo")
+    for workers in (1, 2, 4):
+        delivered, elapsed, complete = run(backend, workers, clients, messages)
+        print(f"{workers:<10}{delivered:>12,}{elapsed:>10.2f}{delivered / elapsed:>10,.0f}  {complete}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compara el códec JSON + Base64 con el códec binario, con y sin compresión.
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_codec
+"""
+import os
+import time
+
+from common import protocol
+
+
+def sample_messages():
+    """Mensajes típicos del chat: texto cifrado con AES-GCM y archivos."""
+    def encrypted(size):
+        return protocol.encrypted_payload(os.urandom(16), os.urandom(16), os.urandom(size))
+
+    return {
+        "public_message (60 B)": ("public_message", {"sender": "ana", "content": encrypted(60)}),
+        "private_message (500 B)": ("private_message", {"sender": "ana", "recipient": "luis", "content": encrypted(500)}),
+        "user_list_update (50)": ("user_list_update", {"users": [f"user_{i}" for i in range(50)]}),
+        "file_transfer (64 KB txt)": ("file_transfer", {"sender": "ana", "recipient": "public", "filename": "notas.txt", "content": b"Lorem ipsum dolor sit amet. " * 2341}),
+        "file_transfer (64 KB)": ("file_transfer", {"sender": "ana", "recipient": "public", "filename": "foto.jpg", "content": os.urandom(64 * 1024)}),
+        "file_transfer (1 MB)": ("file_transfer", {"sender": "ana", "recipient": "public", "filename": "video.mp4", "content": os.urandom(1024 * 1024)}),
+    }
+
+
+def measure(encoder, msg_type, payload, min_time=0.5):
+    """Devuelve (bytes por mensaje, mensajes/s codificando, mensajes/s decodificando)."""
+    frame = encoder.encode(msg_type, **payload)
+
+    iterations = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        encoder.encode(msg_type, **payload)
+        iterations += 1
+    encode_rate = iterations / (time.perf_counter() - start)
+
+    body = frame[4:]
+    compressed = encoder.compression is not None
+    iterations = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        protocol.decode_message(body, compressed=compressed)
+        iterations += 1
+    decode_rate = iterations / (time.perf_counter() - start)
+
+    return len(frame), encode_rate, decode_rate
+
+
+def main():
+    encoders = [
+        protocol.get_encoder(codec, compression)
+        for codec in (protocol.CODEC_JSON, protocol.CODEC_BINARY)
+        for compression in (None, protocol.COMPRESSION_ZDICT)
+    ]
+    print(f"{'mensaje':<26}{'códec':<22}{'bytes/msg':>12}{'enc msg/s':>14}{'dec msg/s':>14}")
+    for name, (msg_type, payload) in sample_messages().items():
+        for encoder in encoders:
+            label = f"{encoder.codec}+{encoder.compression}" if encoder.compression else encoder.codec
+            size, encode_rate, decode_rate = measure(encoder, msg_type, payload)
+            print(f"{name:<26}{label:<22}{size:>12,}{encode_rate:>14,.0f}{decode_rate:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
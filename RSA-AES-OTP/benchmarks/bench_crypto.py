@@ -0,0 +1,61 @@
+"""
+Coste criptográfico por mensaje: cifrar y descifrar con encrypt_with_aes /
+decrypt_with_aes (un cifrador de pycryptodome nuevo y un nonce aleatorio en
+cada mensaje) frente a SessionCipher (AESGCM preparado una vez por sesión y
+nonce de contador), para varios tamaños de mensaje. También el cifrado RSA del
+handshake leyendo el PEM en cada llamada frente a la PeerKey guardada, y
+sacar el nonce.
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_crypto [repeticiones]
+"""
+import sys
+import timeit
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+from common import security
+
+
+def per_call(function, number):
+    """Microsegundos por llamada (el mejor de tres)."""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    key = security.generate_session_key()
+    sender = security.client_cipher(key)
+    receiver = security.server_cipher(key)
+
+    print(f"Microsegundos por mensaje ({number} repeticiones, el mejor de 3)")
+    print(f"{'bytes':<8}{'cifrar antes':>14}{'cifrar ahora':>14}{'descifrar antes':>17}{'descifrar ahora':>17}")
+    for size in (64, 1024, 16 * 1024):
+        data = b"x" * size
+        old = security.encrypt_with_aes(key, data)
+        new = sender.encrypt(data)
+        print(
+            f"{size:<8}"
+            f"{per_call(lambda: security.encrypt_with_aes(key, data), number):>14.1f}"
+            f"{per_call(lambda: sender.encrypt(data), number):>14.1f}"
+            f"{per_call(lambda: security.decrypt_with_aes(key, *old), number):>17.1f}"
+            f"{per_call(lambda: receiver.decrypt(*new), number):>17.1f}"
+        )
+
+    pem = security.get_public_key_pem(security.generate_rsa_keys())
+    secret = security.generate_session_key()
+    rsa_number = max(1, number // 10)
+    print()
+    print(f"{'RSA-OAEP con clave pública':<30}{'µs':>10}")
+    print(f"{'leyendo el PEM cada vez':<30}{per_call(lambda: PKCS1_OAEP.new(RSA.import_key(pem)).encrypt(secret), rsa_number):>10.1f}")
+    print(f"{'PeerKey guardada':<30}{per_call(lambda: security.encrypt_with_rsa(pem, secret), rsa_number):>10.1f}")
+    print()
+    print(f"{'nonce':<30}{'µs':>10}")
+    print(f"{'get_random_bytes(16)':<30}{per_call(lambda: get_random_bytes(16), number):>10.2f}")
+    print(f"{'contador de SessionCipher':<30}{per_call(sender.next_nonce, number):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
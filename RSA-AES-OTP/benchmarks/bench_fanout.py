@@ -0,0 +1,92 @@
+"""
+Coste de repartir un mensaje público según el tamaño de la sala: con la clave
+de sesión de cada destinatario (una cifra y una trama por cliente, lo de antes)
+y con la clave de grupo del canal público (una cifra y una trama por códec
+para todos). También mide lo que cuesta una rotación de la clave de grupo, que
+se paga cuando alguien entra o sale y no en cada mensaje.
+El cifrado para cada destinatario se mide en un solo hilo y repartido entre
+varios (el pool de reparto); con un solo núcleo no hay nada que ganar.
+
+Los clientes son de mentira: enviar no hace nada, así que se mide solo el
+trabajo del servidor (cifrar y codificar).
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_fanout [mensajes por prueba] [hilos de reparto]
+"""
+import os
+import sys
+import time
+
+from common import protocol
+from common import security
+from server.client_handler import PHASE_MESSAGES
+from server.server import ChatServer
+
+
+class FakeClient:
+    def __init__(self, nickname, features):
+        self.nickname = nickname
+        self.session_key = security.generate_session_key()
+        self.cipher = security.server_cipher(self.session_key)
+        self.encoder = protocol.get_encoder(protocol.CODEC_BINARY)
+        self.phase = PHASE_MESSAGES
+        self.features = features
+        self.group_epoch = None
+        self.frames = 0
+
+    def send(self, frame, on_sent=None, kind=None):
+        self.frames += 1
+        return True
+
+    def send_message(self, msg_type, **payload):
+        return self.send(self.encoder.encode(msg_type, **payload), kind=msg_type)
+
+    def wrap_key(self, key):
+        return protocol.encrypted_payload(*self.cipher.encrypt(key))
+
+
+def make_server(recipients, group_key, fanout_workers=1):
+    server = ChatServer("127.0.0.1", 0, logger=lambda *args: None, blob_dir=None, fanout_workers=fanout_workers)
+    features = [protocol.FEATURE_GROUP_KEY] if group_key else []
+    for i in range(recipients):
+        server.add_client(FakeClient(f"user_{i}", features))
+    rotation = 0.0
+    if group_key:
+        start = time.perf_counter()
+        server.rotate_group_key()
+        rotation = time.perf_counter() - start
+    return server, rotation
+
+
+def fanout(server, messages):
+    """Segundos por mensaje público repartido a todos los clientes del servidor."""
+    text = "Hola a todos, ¿qué tal va el día?"
+    start = time.perf_counter()
+    for _ in range(messages):
+        server.deliver_public_message("sender", text)
+    return (time.perf_counter() - start) / messages
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{messages} mensajes públicos por prueba; tiempos por mensaje; {os.cpu_count()} núcleos")
+    print(
+        f"{'destinatarios':<15}{'por cliente ms':>16}{f'con {workers} hilos ms':>18}"
+        f"{'grupo ms':>12}{'mejora':>9}{'rotación ms':>14}"
+    )
+    for recipients in (10, 100, 1000):
+        per_client, _ = make_server(recipients, group_key=False)
+        pooled, _ = make_server(recipients, group_key=False, fanout_workers=workers)
+        group, rotation = make_server(recipients, group_key=True)
+        before = fanout(per_client, messages)
+        parallel = fanout(pooled, messages)
+        after = fanout(group, messages)
+        print(
+            f"{recipients:<15}{before * 1000:>16.3f}{parallel * 1000:>18.3f}{after * 1000:>12.3f}"
+            f"{before / after:>8.1f}x{rotation * 1000:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Mide el rendimiento de cada backend JSON instalado con los mensajes típicos.
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_json
+"""
+import time
+
+from common import protocol
+from benchmarks.bench_codec import sample_messages
+
+
+def rate(function, argument, min_time=0.5):
+    """Llamadas por segundo de function(argument)."""
+    iterations = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        function(argument)
+        iterations += 1
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    print(f"{'mensaje':<26}{'backend':<10}{'enc msg/s':>14}{'dec msg/s':>14}{'enc MB/s':>12}")
+    messages = sample_messages()
+    for name, (msg_type, payload) in messages.items():
+        for backend in protocol.JSON_BACKENDS:
+            protocol.set_json_backend(backend)
+            frame = protocol.encode_message(protocol.CODEC_JSON, msg_type, **payload)
+            body = memoryview(frame)[4:]
+            encode_rate = rate(lambda p: protocol.encode_message(protocol.CODEC_JSON, msg_type, **p), payload)
+            decode_rate = rate(protocol.decode_message, body)
+            megabytes = encode_rate * len(frame) / 1e6
+            print(f"{name:<26}{backend:<10}{encode_rate:>14,.0f}{decode_rate:>14,.0f}{megabytes:>12,.1f}")
+    protocol.set_json_backend()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Contención en el registro de clientes del servidor: muchos hilos reparten
+mensajes (privados y a todos) mientras otro hilo conecta, identifica y
+desconecta clientes sin parar. Compara la foto inmutable del registro (se lee
+sin candado) con el registro de antes, en el que cada lectura cogía el
+candado del servidor y copiaba la lista.
+
+Los clientes son de mentira: enviar no hace nada, así que se mide solo el
+camino de reparto del servidor (buscar destinatarios, cifrar, codificar).
+
+Uso (desde la carpeta del proyecto):
+    python -m benchmarks.bench_registry [clientes] [segundos]
+"""
+import statistics
+import sys
+import threading
+import time
+
+from common import protocol
+from common import security
+from server.client_handler import PHASE_MESSAGES
+from server.server import ChatServer, Registry
+
+
+class FakeClient:
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.session_key = security.generate_session_key()
+        self.cipher = security.server_cipher(self.session_key)
+        self.encoder = protocol.get_encoder(protocol.CODEC_BINARY)
+        self.phase = PHASE_MESSAGES
+
+    def send(self, frame, on_sent=None, kind=None):
+        return True
+
+    def send_message(self, msg_type, **payload):
+        return self.send(self.encoder.encode(msg_type, **payload), kind=msg_type)
+
+
+class LockedChatServer(ChatServer):
+    """El registro de antes: cada lectura coge el candado y copia la lista."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Reentrante porque los que escriben también leen self.registry con el candado cogido
+        self.lock = threading.RLock()
+
+    @property
+    def registry(self):
+        with self.lock:
+            registry = self._registry
+            return Registry(tuple(registry.clients), dict(registry.nicknames))
+
+    @registry.setter
+    def registry(self, value):
+        self._registry = value
+
+
+def populate(server, count):
+    for i in range(count):
+        client = FakeClient(f"user_{i}")
+        server.add_client(client)
+        server.register_client(client, client.nickname)
+
+
+def sender(server, count, go, stop, latencies):
+    source = FakeClient("sender")
+    i = 0
+    go.wait()
+    while not stop.is_set():
+        start = time.perf_counter()
+        if i % 10 == 0:
+            server.broadcast("user_list_update", source_client=source, users=["ana", "luis"])
+        else:
+            server.send_private_message(f"user_{i % count}", f"user_{(i + 1) % count}", "hola")
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def churn(server, go, stop, counter):
+    i = 0
+    go.wait()
+    while not stop.is_set():
+        client = FakeClient(f"churn_{i}")
+        server.add_client(client)
+        server.register_client(client, client.nickname)
+        server.remove_client(client)
+        i += 1
+    counter.append(i)
+
+
+def run(server, senders, duration):
+    # Los hilos esperan a go para no medir lo que tarda en arrancar cada uno
+    go = threading.Event()
+    stop = threading.Event()
+    latencies = [[] for _ in range(senders)]
+    churned = []
+    count = len(server.registry.clients)
+    threads = [threading.Thread(target=sender, args=(server, count, go, stop, latencies[i])) for i in range(senders)]
+    threads.append(threading.Thread(target=churn, args=(server, go, stop, churned)))
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    go.set()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    merged = [latency for per_thread in latencies for latency in per_thread]
+    p99 = statistics.quantiles(merged, n=100)[98] if len(merged) > 1 else 0.0
+    return len(merged) / elapsed, p99, churned[0] / elapsed
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    servers = {
+        "candado": LockedChatServer("127.0.0.1", 0, logger=lambda *args: None, blob_dir=None),
+        "foto": ChatServer("127.0.0.1", 0, logger=lambda *args: None, blob_dir=None),
+    }
+    for server in servers.values():
+        populate(server, clients)
+
+    print(f"{clients} clientes, {duration:.0f} s por prueba; 1 de cada 10 envíos es a todos")
+    print(f"{'hilos':<8}{'registro':<10}{'envíos/s':>12}{'p99 ms':>10}{'altas/s':>10}")
+    for senders in (1, 4, 16, 64):
+        for name, server in servers.items():
+            rate, p99, churn_rate = run(server, senders, duration)
+            print(f"{senders:<8}{name:<10}{rate:>12,.0f}{p99 * 1000:>10.2f}{churn_rate:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
+import bisect
 import tkinter as tk
 from tkinter import Listbox, filedialog
 from datetime import datetime
 from client import config
 import base64
+import shutil
+import threading
 
 
 class GuiManager:
@@ -13,6 +16,7 @@ class GuiManager:
         self.widgets = {}
         self.active_chat = "public"
         self.received_files = {}
+        self.users = []  # Nicks de la lista de usuarios, ordenados como en el Listbox
         self._setup_main_window()
 
     def _setup_main_window(self):
@@ -221,12 +225,29 @@ class GuiManager:
                     parent=self.root, initialfile=file_info["filename"]
                 )
                 if save_path:
-                    file_content = base64.b64decode(file_info["content"])
-                    with open(save_path, "wb") as f:
-                        f.write(file_content)
-                    self._add_system_message(
-                        f"Archivo '{file_info['filename']}' guardado."
-                    )
+                    if file_info.get("ref"):
+                        # Archivo del almacén del servidor: se descarga ahora, en segundo plano
+                        self.callbacks["fetch_file"](file_info["ref"], file_info["filename"], save_path)
+                        return
+                    # La copia se hace en otro hilo para no bloquear la ventana
+                    threading.Thread(
+                        target=self._save_file, args=(file_info, save_path), daemon=True
+                    ).start()
+
+    def _save_file(self, file_info, save_path):
+        try:
+            if file_info.get("path"):
+                # Archivo enviado o ya recibido en el spool: copiamos el archivo del disco
+                shutil.copyfile(file_info["path"], save_path)
+            else:
+                # Historial antiguo, con el contenido en Base64
+                file_content = base64.b64decode(file_info["content"])
+                with open(save_path, "wb") as f:
+                    f.write(file_content)
+            text = f"Archivo '{file_info['filename']}' guardado."
+        except (OSError, ValueError) as e:
+            text = f"No se pudo guardar '{file_info['filename']}': {e}"
+        self.root.after(0, self._add_system_message, text)
 
     def display_conversation(self, messages):
         chat_area = self.widgets["chat_area"]
@@ -236,7 +257,7 @@ class GuiManager:
             if msg["type"] == "system":
                 self._add_system_message(msg["content"])
             elif msg["type"] == "file":
-                self._add_file_display(msg["sender"], msg["filename"], msg["content"])
+                self._add_file_display(msg["sender"], msg["filename"], msg.get("content"), msg.get("path"), msg.get("file_id"))
             else:
                 self._add_message_bubble(msg["sender"], msg["content"])
         chat_area.config(state="disabled")
@@ -250,7 +271,7 @@ class GuiManager:
         if msg["type"] == "system":
             chat_area.insert(tk.END, f"{msg['content']}\n", "info")
         elif msg["type"] == "file":
-            self._add_file_display(msg["sender"], msg["filename"], msg["content"])
+            self._add_file_display(msg["sender"], msg["filename"], msg.get("content"), msg.get("path"), msg.get("file_id"))
         else:
             self._add_message_bubble(msg["sender"], msg["content"])
             
@@ -280,11 +301,14 @@ class GuiManager:
             chat_area.insert(tk.END, f"{sender} ({timestamp})\n", "nombre_otro_linea")
             chat_area.insert(tk.END, f"{text}\n\n", "otro_usuario_burbuja")
 
-    def _add_file_display(self, sender, filename, b64_content):
+    def _add_file_display(self, sender, filename, b64_content=None, path=None, ref=None):
         chat_area = self.widgets["chat_area"]
         timestamp = datetime.now().strftime("%H:%M")
-        file_id = f"{sender}_{filename}_{len(b64_content)}"
-        self.received_files[file_id] = {"filename": filename, "content": b64_content}
+        # Los archivos enviados y recibidos guardan la ruta local (los recibidos, en
+        # el spool), los públicos la referencia (hash) al almacén del servidor y
+        # los de historiales antiguos el contenido en Base64
+        file_id = f"{sender}_{filename}_{ref or (len(b64_content) if b64_content else path)}"
+        self.received_files[file_id] = {"filename": filename, "content": b64_content, "path": path, "ref": ref}
         file_tag = f"fileid_{file_id}"
         if sender == self.nickname:
             chat_area.insert(
@@ -311,6 +335,27 @@ class GuiManager:
     def update_user_list(self, users):
         user_listbox = self.widgets["user_list"]
         user_listbox.delete(0, tk.END)
-        for user in sorted(users):
-            display_name = f"{user} (tú)" if user == self.nickname else user
-            user_listbox.insert(tk.END, display_name)
+        self.users = sorted(set(users))
+        for user in self.users:
+            user_listbox.insert(tk.END, self._user_display_name(user))
+
+    def add_users(self, users):
+        # Deltas de presencia: se toca solo la fila de cada nick, sin rehacer la lista
+        user_listbox = self.widgets["user_list"]
+        for user in users:
+            index = bisect.bisect_left(self.users, user)
+            if index < len(self.users) and self.users[index] == user:
+                continue
+            self.users.insert(index, user)
+            user_listbox.insert(index, self._user_display_name(user))
+
+    def remove_users(self, users):
+        user_listbox = self.widgets["user_list"]
+        for user in users:
+            index = bisect.bisect_left(self.users, user)
+            if index < len(self.users) and self.users[index] == user:
+                del self.users[index]
+                user_listbox.delete(index)
+
+    def _user_display_name(self, user):
+        return f"{user} (tú)" if user == self.nickname else user
@@ -1,31 +1,68 @@
+import collections
+import contextlib
+import os
+import shutil
 import socket
 import threading
 from common import protocol
 from common import security  
-import base64
+from .transfers import OutgoingTransfer, IncomingTransfer, map_file, FILE_CREDIT_TIMEOUT, FILE_NEED_TIMEOUT
+
+# Clave con la que le escribimos a un contacto de extremo a extremo: la huella
+# de su clave pública, la clave AES, su identificador y la clave sellada con RSA
+PairKey = collections.namedtuple("PairKey", ["fingerprint", "key_id", "key", "sealed"])
 
 class NetworkHandler:
     def __init__(self, on_message_received, on_server_disconnect):
         self.socket = None
+        self.reader = None  # Lector con búfer; todas las lecturas del socket pasan por él
         self.on_message_received = on_message_received
         self.on_server_disconnect = on_server_disconnect
         self.is_listening = False
-        self.session_key = None  # NUEVO: Para guardar la clave de sesión AES
+        # El hilo de escucha, la GUI y los envíos de archivos comparten el socket
+        self.send_lock = threading.Lock()
+        self.outgoing_transfers = {}  # {transfer_id: OutgoingTransfer}
+        self.incoming_transfers = {}  # {transfer_id: IncomingTransfer}
+        self.transfer_store = None  # TransferStore del usuario; se asigna tras el login
+        self.fetches = {}  # Descargas del almacén del servidor: {file_id: (ruta destino, on_finished)}
+        self.cipher = None  # SessionCipher de la clave de sesión AES; se crea al asignar session_key
+        self.encoder = protocol.get_encoder()  # Códec negociado con el servidor en la Fase 1
+        self.features = []  # Funciones opcionales negociadas en la Fase 1
+        self.presence_version = None  # Versión de la lista de usuarios que tenemos (con deltas de presencia)
+        self.group_keys = {}  # Claves de grupo del canal público: {época: SessionCipher}, solo las últimas
+        # Privados de extremo a extremo: {nick: PairKey, o None si no los entiende},
+        # los textos que esperan su clave pública y las claves de cada conversación
+        # (las nuestras y las que nos mandan): {key_id: clave}
+        self.peer_lock = threading.Lock()
+        self.peers = {}
+        self.pending_private = {}
+        self.pair_keys = {}
 
         print("Generando par de claves RSA para el cliente...")
         self.rsa_private_key = security.generate_rsa_keys()
         self.rsa_public_pem = security.get_public_key_pem(self.rsa_private_key)
         self.server_rsa_public_pem = None # Para guardar la clave del servidor
+        self.refusal = None  # Motivo si el servidor rechazó la conexión con server_busy
         print("Claves de cliente generadas.")
 
+    @property
+    def session_key(self):
+        return self.cipher.key if self.cipher else None
+
+    @session_key.setter
+    def session_key(self, key):
+        # El cifrador se prepara una sola vez por sesión
+        self.cipher = security.client_cipher(key) if key is not None else None
+
     def connect(self, host, port):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((host, port))
+            self.reader = protocol.SocketReader(self.socket)
             
             # El handshake sigue siendo el primer paso
             if not self.perform_rsa_exchange():
-                self.on_server_disconnect("Fallo en el intercambio de claves RSA.")
+                self.on_server_disconnect(self.refusal or "Fallo en el intercambio de claves RSA.")
                 return False
 
             # El resto de la lógica de conexión no cambia
@@ -38,24 +75,43 @@ class NetworkHandler:
      
 
     def perform_rsa_exchange(self):
+        self.refusal = None
         try:
             # 1. El Cliente envía su clave pública PRIMERO.
             print("Enviando clave pública del cliente al servidor...")
+            # Anunciamos también los códecs que entendemos, por orden de preferencia.
             client_key_msg = protocol.create_message(
                 "client_public_key",
-                public_key=self.rsa_public_pem.decode('ascii')
+                public_key=self.rsa_public_pem.decode('ascii'),
+                codecs=protocol.SUPPORTED_CODECS,
+                compression=protocol.SUPPORTED_COMPRESSION,
+                features=protocol.SUPPORTED_FEATURES
             )
             self.socket.sendall(client_key_msg)
 
             # 2. El Cliente espera recibir la clave pública del Servidor.
             print("Esperando clave pública del servidor...")
-            server_msg = protocol.parse_message_from_socket(self.socket)
+            server_msg = self.reader.read_message()
+            if server_msg and server_msg.get("type") == "server_busy":
+                # Servidor lleno o con demasiados handshakes a la vez: hay que volver a intentarlo luego
+                retry_after = server_msg["payload"].get("retry_after")
+                self.refusal = f"El servidor está ocupado; vuelve a intentarlo en {retry_after} s."
+                print(self.refusal)
+                return False
             if not server_msg or server_msg.get("type") != "server_public_key":
                 print("No se recibió una respuesta válida del servidor.")
                 return False
             
             self.server_rsa_public_pem = server_msg["payload"]["public_key"].encode('ascii')
-            print("Clave pública del servidor recibida.")
+            # Un servidor antiguo no elige códec ni compresión: seguimos en JSON sin comprimir.
+            self.encoder = protocol.get_encoder(
+                server_msg["payload"].get("codec", protocol.CODEC_JSON),
+                server_msg["payload"].get("compression")
+            )
+            self.reader.compressed = self.encoder.compression is not None
+            # Funciones opcionales que usará el servidor (ninguna si es antiguo)
+            self.features = server_msg["payload"].get("features", [])
+            print(f"Clave pública del servidor recibida (códec: {self.encoder.codec}, compresión: {self.encoder.compression}).")
             return True
 
         except Exception as e:
@@ -66,29 +122,456 @@ class NetworkHandler:
     def listen(self):
         while self.is_listening:
             try:
-                message = protocol.parse_message_from_socket(self.socket)
+                message = self.reader.read_message()
                 if message is None:
                     self.is_listening = False
                     self.on_server_disconnect("El servidor cerró la conexión.")
                     break
 
-                self.on_message_received(
-                    message.get("type"), message.get("payload", {})
-                )
+                msg_type = message.get("type")
+                payload = message.get("payload", {})
+                if msg_type == "ping":
+                    # El servidor comprueba que seguimos aquí
+                    self.send("pong")
+                elif msg_type in self.TRANSFER_MESSAGES:
+                    self._handle_transfer_message(msg_type, payload)
+                elif msg_type == "file_transfer":
+                    self._spool_file_transfer(payload)
+                elif msg_type == "group_key":
+                    self._install_group_key(payload)
+                elif msg_type == "peer_key":
+                    self._install_peer_key(payload)
+                elif msg_type in self.PRESENCE_MESSAGES:
+                    if self._check_presence(msg_type, payload):
+                        self.on_message_received(msg_type, payload)
+                else:
+                    self.on_message_received(msg_type, payload)
             except (ConnectionResetError, ConnectionAbortedError, OSError):
                 self.is_listening = False
                 self.on_server_disconnect("Se perdió la conexión con el servidor.")
                 break
+            except ValueError:
+                # Trama demasiado grande o mal formada: no se puede seguir leyendo
+                self.is_listening = False
+                self.disconnect()
+                self.on_server_disconnect("El servidor envió una trama no válida.")
+                break
+
+    PRESENCE_MESSAGES = ("user_list_update", "presence_join", "presence_leave")
+
+    def _check_presence(self, msg_type, payload):
+        """
+        Comprueba la versión de un mensaje de presencia. La lista entera
+        (user_list_update) fija la versión y cada delta tiene que ser la
+        siguiente; si falta alguno se pide la lista entera con presence_sync y
+        se ignoran los deltas hasta que llegue. Devuelve si hay que aplicarlo.
+        """
+        if msg_type == "user_list_update":
+            # Sin versión si el servidor no manda deltas: siempre es la lista entera
+            self.presence_version = payload.get("version")
+            self._forget_peers(set(self.peers) - set(payload.get("users", [])))
+            return True
+        if self.presence_version is None:
+            return False
+        if payload.get("version") != self.presence_version + 1:
+            print(f"Falta algún cambio de la lista de usuarios (v{self.presence_version} -> v{payload.get('version')}); se pide entera.")
+            self.presence_version = None
+            self.send("presence_sync")
+            return False
+        self.presence_version = payload["version"]
+        if msg_type == "presence_leave":
+            self._forget_peers(payload.get("users", []))
+        return True
+
+    # Épocas de la clave de grupo que se guardan: un público cifrado con la
+    # anterior puede llegar justo después de la clave nueva
+    GROUP_KEYS_KEPT = 4
+
+    def _install_group_key(self, payload):
+        try:
+            key = self._unwrap_key(payload["key"])
+        except (KeyError, TypeError, ValueError):
+            print("Clave de grupo no válida; los públicos cifrados con ella no se podrán leer.")
+            return
+        self.group_keys[payload["epoch"]] = security.client_cipher(key)
+        for epoch in sorted(self.group_keys)[:-self.GROUP_KEYS_KEPT]:
+            del self.group_keys[epoch]
+
+    def decrypt_content(self, payload):
+        """
+        Descifra el content de un mensaje de texto con la clave que le toca: la
+        de su conversación si es un privado de extremo a extremo, la de grupo
+        de su época si es un público cifrado con ella y si no la de sesión.
+        Lanza ValueError, KeyError o TypeError si no se puede.
+        """
+        content = payload["content"]
+        nonce = protocol.as_bytes(content["nonce"])
+        tag = protocol.as_bytes(content["tag"])
+        ciphertext = protocol.as_bytes(content["ciphertext"])
+        if payload.get("e2e"):
+            return security.decrypt_with_aes(self._pair_key(payload["e2e"]), nonce, tag, ciphertext)
+        epoch = payload.get("epoch")
+        cipher = self.cipher if epoch is None else self.group_keys[epoch]
+        return cipher.decrypt(nonce, tag, ciphertext)
+
+    # --- Privados de extremo a extremo ---
+
+    def send_private_message(self, recipient, text):
+        """
+        Envía un privado. Si el servidor y el destinatario lo permiten va
+        cifrado de extremo a extremo; la primera vez hay que pedir su clave
+        pública, y el texto espera hasta que llega.
+        """
+        if protocol.FEATURE_E2E not in self.features:
+            self._send_private_via_server(recipient, text)
+            return
+        with self.peer_lock:
+            if recipient not in self.peers:
+                waiting = self.pending_private.setdefault(recipient, [])
+                waiting.append(text)
+                if len(waiting) == 1:
+                    self.send("peer_key_request", nickname=recipient)
+                return
+            peer = self.peers[recipient]
+        if peer is None:
+            self._send_private_via_server(recipient, text)
+            return
+        nonce, tag, ciphertext = security.encrypt_with_aes(peer.key, text.encode('utf-8'))
+        self.send(
+            "private_message",
+            recipient=recipient,
+            content=protocol.encrypted_payload(nonce, tag, ciphertext),
+            e2e={"to_key": peer.fingerprint, "key_id": peer.key_id, "key": peer.sealed}
+        )
+
+    def _send_private_via_server(self, recipient, text):
+        # Como antes: cifrado con la clave de sesión, el servidor lo descifra y lo vuelve a cifrar
+        nonce, tag, ciphertext = self.cipher.encrypt(text.encode('utf-8'))
+        self.send("private_message", recipient=recipient, content=protocol.encrypted_payload(nonce, tag, ciphertext))
+
+    def _install_peer_key(self, payload):
+        """
+        Llega la clave pública de un contacto (None si no puede recibir privados
+        de extremo a extremo). Se le crea una clave de conversación y salen los
+        textos que esperaban; si el servidor nos devolvió uno porque iba para
+        una clave antigua, se descifra y se reenvía primero.
+        """
+        nickname = payload.get("nickname")
+        public_key = payload.get("public_key")
+        peer = None
+        if public_key:
+            public_pem = public_key.encode('ascii')
+            key = security.generate_session_key()
+            peer = PairKey(security.key_fingerprint(public_pem), os.urandom(16).hex(), key, security.encrypt_with_rsa(public_pem, key))
+        texts = []
+        bounced = payload.get("bounced")
+        if bounced:
+            try:
+                content = bounced["content"]
+                texts.append(security.decrypt_with_aes(
+                    self._pair_key(bounced["e2e"]),
+                    protocol.as_bytes(content["nonce"]),
+                    protocol.as_bytes(content["tag"]),
+                    protocol.as_bytes(content["ciphertext"])
+                ).decode('utf-8'))
+            except (KeyError, TypeError, ValueError):
+                print(f"No se pudo reenviar un privado devuelto para {nickname}.")
+        with self.peer_lock:
+            if peer is not None:
+                self.pair_keys[peer.key_id] = peer.key
+            self.peers[nickname] = peer
+            texts.extend(self.pending_private.pop(nickname, []))
+        for text in texts:
+            self.send_private_message(nickname, text)
+
+    def _pair_key(self, e2e):
+        """Clave de una conversación de extremo a extremo; la primera vez se abre la sellada con RSA."""
+        key_id = e2e["key_id"]
+        key = self.pair_keys.get(key_id)
+        if key is None:
+            key = security.decrypt_with_rsa(self.rsa_private_key, protocol.as_bytes(e2e["key"]))
+            self.pair_keys[key_id] = key
+        return key
+
+    def _forget_peers(self, nicknames):
+        # Si vuelve a entrar tendrá otra clave pública: se le pedirá de nuevo. Su
+        # clave de conversación se queda en pair_keys, por si llega un eco o nos
+        # devuelven un privado cifrado con ella.
+        with self.peer_lock:
+            for nickname in nicknames:
+                self.peers.pop(nickname, None)
 
     def send(self, msg_type, **payload):
-        if self.socket and self.is_listening:
+        sock = self.socket  # disconnect() puede vaciarlo desde otro hilo
+        if sock and self.is_listening:
             try:
-                message_bytes = protocol.create_message(msg_type, **payload)
-                self.socket.sendall(message_bytes)
+                message_bytes = self.encoder.encode(msg_type, **payload)
+                with self.send_lock:
+                    sock.sendall(message_bytes)
             except OSError:
                 self.is_listening = False
                 self.on_server_disconnect("Error al enviar, conexión perdida.")
 
+    # --- Transferencia de archivos por trozos ---
+
+    TRANSFER_MESSAGES = (
+        "file_credit", "file_need", "file_resume", "file_offer", "file_chunk",
+        "file_complete", "file_cancel", "file_unavailable"
+    )
+
+    def fetch_file(self, file_id, dest_path, on_finished):
+        """
+        Descarga un archivo del almacén del servidor (anunciado con file_ref) y
+        lo deja en dest_path. on_finished(error) se llama al terminar.
+        """
+        self.fetches[file_id] = (dest_path, on_finished)
+        self.send("file_fetch", file_id=file_id)
+
+    def resume_transfers(self, store):
+        """
+        Se llama tras el login, con el TransferStore del usuario. Vuelve a
+        ofrecer los envíos que se cortaron y pide a sus emisores los archivos
+        que quedaron a medias; en ambos casos solo viajan los trozos que faltan.
+        """
+        self.transfer_store = store
+        for entry in store.pending_outgoing():
+            if os.path.exists(entry["path"]):
+                self.send_file(entry["recipient"], entry["path"])
+        for info in store.pending_incoming():
+            self.send("file_resume", file_id=info["file_id"], sender=info["sender"])
+
+    def send_file(self, recipient, filepath, on_finished=None):
+        """
+        Envía un archivo por trozos en un hilo aparte, sin cargarlo entero en
+        memoria. on_finished(error) se llama al terminar (error es None si fue bien).
+        """
+        transfer = OutgoingTransfer(recipient, filepath)
+        self.outgoing_transfers[transfer.transfer_id] = transfer
+        threading.Thread(
+            target=self._send_file_chunks, args=(transfer, on_finished), daemon=True
+        ).start()
+        return transfer
+
+    def _send_file_chunks(self, transfer, on_finished):
+        error = None
+        try:
+            with map_file(transfer.filepath) as view:
+                # El manifiesto (hash de cada trozo) permite a los destinatarios
+                # decir qué trozos tienen ya de un intento anterior.
+                transfer.build_manifest(view)
+                if self.transfer_store:
+                    self.transfer_store.remember_outgoing(transfer.describe())
+                self.send(
+                    "file_offer",
+                    transfer_id=transfer.transfer_id,
+                    file_id=transfer.file_id,
+                    recipient=transfer.recipient,
+                    filename=transfer.filename,
+                    size=transfer.size,
+                    chunk_size=transfer.chunk_size,
+                    chunks=transfer.chunks,
+                    key=self._wrap_key(transfer.key)
+                )
+                needed = transfer.wait_for_needs(FILE_NEED_TIMEOUT)
+                # Los trozos se cifran desde la proyección del archivo en el pool de
+                # security, unos pocos por delante del que se envía
+                with contextlib.closing(transfer.sealed_chunks(view, needed)) as sealed_chunks:
+                    for index, sealed in zip(needed, sealed_chunks):
+                        # Esperamos a que el servidor nos deje enviar otro trozo
+                        if not transfer.credits.acquire(timeout=FILE_CREDIT_TIMEOUT):
+                            raise TimeoutError("El servidor no concedió créditos a tiempo.")
+                        if not self.is_listening:
+                            raise ConnectionError("Conexión perdida durante el envío.")
+                        self.send("file_chunk", transfer_id=transfer.transfer_id, index=index, data=sealed)
+            self.send("file_complete", transfer_id=transfer.transfer_id)
+            if self.transfer_store:
+                self.transfer_store.complete_outgoing(transfer.file_id, transfer.recipient)
+        except (OSError, TimeoutError, ConnectionError) as e:
+            error = e
+            self.send("file_cancel", transfer_id=transfer.transfer_id)
+        finally:
+            self.outgoing_transfers.pop(transfer.transfer_id, None)
+        if on_finished:
+            on_finished(error)
+
+    def _handle_transfer_message(self, msg_type, payload):
+        transfer_id = payload.get("transfer_id")
+
+        if msg_type == "file_credit":
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer:
+                transfer.add_credits(payload.get("credits", 1), payload.get("recipients"))
+
+        elif msg_type == "file_need":
+            transfer = self.outgoing_transfers.get(transfer_id)
+            if transfer:
+                transfer.add_need(payload.get("missing", []))
+
+        elif msg_type == "file_resume":
+            # Alguien tiene a medias un archivo que le enviamos: se lo volvemos a
+            # ofrecer, solo si es su destinatario (o el archivo era para el canal público)
+            requester = payload.get("requester")
+            path = self.transfer_store.find_outgoing(payload.get("file_id"), requester) if self.transfer_store else None
+            if path:
+                self.send_file(requester, path)
+
+        elif msg_type == "file_offer":
+            self._accept_offer(transfer_id, payload)
+
+        elif msg_type == "file_chunk":
+            transfer = self.incoming_transfers.get(transfer_id)
+            if transfer:
+                # Se descifra en el pool; data apunta al búfer del lector, así que se copia
+                index = payload.get("index")
+                future = transfer.queue_chunk(index, protocol.as_bytes(payload.get("data")))
+                future.add_done_callback(lambda f: self._chunk_queued(f, transfer_id, index))
+
+        elif msg_type == "file_complete":
+            transfer = self.incoming_transfers.pop(transfer_id, None)
+            if transfer is None:
+                return
+            sender, recipient, filename = transfer.offers.pop(transfer_id)
+            transfer.drain()
+            if not transfer.is_complete():
+                # Faltan trozos: el parcial se queda en disco para reanudarlo
+                self._close_if_unused(transfer)
+                return
+            if not transfer.offers and transfer.file_id in self.fetches:
+                self._finish_fetch(transfer, *self.fetches.pop(transfer.file_id))
+                return
+            try:
+                transfer.verify()
+                if transfer.offers:
+                    path = self.transfer_store.spool_incoming(transfer.file_id, keep_part=True)
+                else:
+                    transfer.close()
+                    path = self.transfer_store.spool_incoming(transfer.file_id)
+            except (OSError, ValueError) as e:
+                print(f"No se pudo guardar {filename}: {e}")
+                self._close_if_unused(transfer)
+                return
+            # Para la aplicación es un archivo recibido, igual que un file_transfer
+            self.on_message_received("file_transfer", {
+                "sender": sender,
+                "recipient": recipient,
+                "filename": filename,
+                "path": path,
+                "size": transfer.size,
+                "file_id": transfer.file_id,
+            })
+
+        elif msg_type == "file_cancel":
+            # El parcial se queda en disco para reanudarlo más tarde
+            transfer = self.incoming_transfers.pop(transfer_id, None)
+            if transfer:
+                transfer.offers.pop(transfer_id, None)
+                transfer.drain()
+                self._close_if_unused(transfer)
+                if not transfer.offers and transfer.file_id in self.fetches:
+                    _, on_finished = self.fetches.pop(transfer.file_id)
+                    on_finished(ConnectionError("El servidor canceló la descarga."))
+
+        elif msg_type == "file_unavailable":
+            fetch = self.fetches.pop(payload.get("file_id"), None)
+            if fetch:
+                fetch[1](FileNotFoundError("El servidor ya no tiene el archivo."))
+
+    def _wrap_key(self, key):
+        """Cifra la clave de una transferencia con la clave de sesión para la oferta."""
+        return protocol.encrypted_payload(*self.cipher.encrypt(key))
+
+    def _unwrap_key(self, wrapped):
+        return self.cipher.decrypt(
+            protocol.as_bytes(wrapped["nonce"]),
+            protocol.as_bytes(wrapped["tag"]),
+            protocol.as_bytes(wrapped["ciphertext"])
+        )
+
+    def _spool_file_transfer(self, payload):
+        """
+        Un file_transfer trae el archivo entero en la trama: se escribe al spool
+        y a la aplicación solo le llega la ruta, como con los archivos por trozos.
+        """
+        if self.transfer_store is None:
+            return
+        try:
+            content = protocol.as_bytes(payload["content"])
+            path, file_id = self.transfer_store.spool_bytes(content)
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            print(f"No se pudo guardar el archivo recibido: {e}")
+            return
+        self.on_message_received("file_transfer", {
+            "sender": payload.get("sender"),
+            "recipient": payload.get("recipient", "public"),
+            "filename": payload.get("filename"),
+            "path": path,
+            "size": len(content),
+            "file_id": file_id,
+        })
+
+    def _accept_offer(self, transfer_id, payload):
+        """Prepara la recepción de un archivo y dice al emisor qué trozos faltan."""
+        if self.transfer_store is None or not transfer_id or "file_id" not in payload:
+            return
+        file_id = payload["file_id"]
+        # Si ya lo estamos recibiendo por otra transferencia, compartimos el parcial
+        transfer = next((t for t in self.incoming_transfers.values() if t.file_id == file_id), None)
+        if transfer is not None:
+            transfer.add_offer(transfer_id, payload)
+        else:
+            # Una reanudación llega como envío privado, pero se muestra donde se envió al principio
+            previous = self.transfer_store.load_incoming(file_id)
+            if previous:
+                payload = dict(payload, recipient=previous["recipient"])
+            try:
+                key = self._unwrap_key(payload["key"]) if payload.get("key") else None
+                transfer = IncomingTransfer(payload, self.transfer_store.part_path(file_id), key)
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                print(f"Oferta de archivo no válida: {e}")
+                return
+            # Una descarga del almacén no se reanuda sola: se vuelve a pedir al guardar
+            if file_id not in self.fetches:
+                self.transfer_store.save_incoming(transfer.describe())
+        self.incoming_transfers[transfer_id] = transfer
+        self.send("file_need", transfer_id=transfer_id, missing=transfer.missing())
+
+    def _finish_fetch(self, transfer, dest_path, on_finished):
+        # El parcial ya es el archivo: se comprueba y se mueve a su destino, sin leerlo en memoria
+        error = None
+        try:
+            transfer.verify()
+            transfer.close()
+            shutil.move(transfer.part_path, dest_path)
+        except (OSError, ValueError) as e:
+            transfer.close()
+            error = e
+        on_finished(error)
+
+    def _chunk_queued(self, future, transfer_id, index):
+        # Desde el pool de security, cuando queue_chunk termina con un trozo
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            if not future.result():
+                print(f"Trozo {index} no válido en la transferencia {transfer_id}; se descarta.")
+            return
+        # No se pudo escribir (p. ej. disco lleno): la transferencia se da por
+        # fallida, como con un file_cancel, y el parcial se queda para reanudarla
+        print(f"No se pudo guardar el trozo {index} de la transferencia {transfer_id}: {error}")
+        transfer = self.incoming_transfers.pop(transfer_id, None)
+        if transfer is None:
+            return
+        transfer.offers.pop(transfer_id, None)
+        self._close_if_unused(transfer)
+        if not transfer.offers and transfer.file_id in self.fetches:
+            _, on_finished = self.fetches.pop(transfer.file_id)
+            on_finished(error)
+
+    def _close_if_unused(self, transfer):
+        if not transfer.offers:
+            transfer.close()
+
     def disconnect(self):
         self.is_listening = False
         if self.socket:
@@ -98,3 +581,9 @@ class NetworkHandler:
             except OSError:
                 pass
             self.socket = None
+            self.reader = None
+        # Los parciales se quedan en disco para reanudarlos al volver a conectar
+        for transfer in set(self.incoming_transfers.values()):
+            transfer.drain()
+            transfer.close()
+        self.incoming_transfers.clear()
@@ -0,0 +1,235 @@
+import contextlib
+from concurrent import futures
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+from common import protocol
+from common import security
+
+# Segundos que el emisor espera un crédito del servidor antes de abandonar
+FILE_CREDIT_TIMEOUT = 30
+# Segundos que el emisor espera a que los destinatarios digan qué trozos les faltan
+FILE_NEED_TIMEOUT = 5
+
+
+@contextlib.contextmanager
+def map_file(filepath):
+    """
+    Proyecta el archivo en memoria (solo lectura) y devuelve una vista sobre
+    él: los trozos se hashean y se cifran directamente desde la proyección, sin
+    leer el archivo a búferes de Python, y la memoria usada no depende del tamaño.
+    """
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b"")  # mmap no admite archivos vacíos
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+            yield view
+
+
+def build_manifest(view, chunk_size):
+    """
+    Devuelve (file_id, hashes) de un archivo proyectado con map_file: el SHA-256
+    del archivo completo en hexadecimal y la lista de SHA-256 de cada trozo.
+    """
+    file_hash = hashlib.sha256(view)
+    chunks = [hashlib.sha256(view[offset:offset + chunk_size]).digest() for offset in range(0, len(view), chunk_size)]
+    return file_hash.hexdigest(), chunks
+
+
+class OutgoingTransfer:
+    """Archivo que estamos enviando por trozos."""
+
+    def __init__(self, recipient, filepath):
+        self.transfer_id = uuid.uuid4().hex
+        self.recipient = recipient
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.size = os.path.getsize(filepath)
+        self.chunk_size = protocol.FILE_CHUNK_SIZE
+        # Se rellenan con build_manifest(), ya en el hilo de envío
+        self.file_id = None
+        self.chunks = None
+        # Clave AES propia de esta transferencia; viaja en la oferta cifrada con la clave de sesión
+        self.key = security.generate_session_key()
+        # Cada crédito del servidor permite enviar un trozo más
+        self.credits = threading.Semaphore(0)
+        # A cuántos clientes llegó la oferta (None si el servidor no lo dice)
+        # y qué trozos han pedido entre todos
+        self.recipients = None
+        self.needs_received = 0
+        self.needed = set()
+        self.condition = threading.Condition()
+
+    def build_manifest(self, view):
+        self.size = len(view)
+        self.file_id, self.chunks = build_manifest(view, self.chunk_size)
+
+    def sealed_chunks(self, view, indices):
+        """
+        Trozos indicados del archivo proyectado, cifrados con la clave de la
+        transferencia. Se cifran en paralelo en el pool de security y salen en orden.
+        """
+        size = self.chunk_size
+        chunks = ((index, view[index * size:(index + 1) * size]) for index in indices)
+        return security.chunk_pool().seal_chunks(self.key, chunks)
+
+    def add_credits(self, count, recipients=None):
+        if recipients is not None:
+            with self.condition:
+                self.recipients = recipients
+                self.condition.notify_all()
+        for _ in range(count):
+            self.credits.release()
+
+    def add_need(self, missing):
+        with self.condition:
+            self.needs_received += 1
+            self.needed.update(i for i in missing if 0 <= i < len(self.chunks))
+            self.condition.notify_all()
+
+    def wait_for_needs(self, timeout):
+        """
+        Espera a que todos los destinatarios digan qué trozos les faltan y
+        devuelve los índices a enviar, en orden. Si alguno no contesta (un
+        cliente antiguo, por ejemplo) se envía el archivo entero.
+        """
+        everything = range(len(self.chunks))
+        with self.condition:
+            answered = self.condition.wait_for(
+                lambda: self.recipients is not None and self.needs_received >= self.recipients,
+                timeout
+            )
+            if not answered:
+                return list(everything)
+            return sorted(self.needed)
+
+    def describe(self):
+        """Datos que se guardan en disco para poder reanudar el envío."""
+        return {
+            "file_id": self.file_id,
+            "recipient": self.recipient,
+            "path": os.path.abspath(self.filepath),
+            "size": self.size,
+        }
+
+
+class IncomingTransfer:
+    """
+    Archivo que estamos recibiendo por trozos. Se va escribiendo en un archivo
+    parcial en disco; cada trozo se comprueba contra el manifiesto, así que al
+    reanudar basta con volver a leer el parcial para saber qué trozos tenemos.
+    """
+
+    def __init__(self, payload, part_path, key=None):
+        self.transfer_id = payload["transfer_id"]
+        self.file_id = payload["file_id"]
+        self.sender = payload["sender"]
+        self.recipient = payload.get("recipient", "public")
+        self.filename = payload["filename"]
+        self.size = payload.get("size", 0)
+        self.chunk_size = payload["chunk_size"]
+        self.chunks = [protocol.as_bytes(digest) for digest in payload["chunks"]]
+        self.key = key  # None si el emisor no cifra los trozos
+        self.part_path = part_path
+        self.have = set()
+        self.lock = threading.Lock()  # Los trozos se escriben desde los hilos del pool
+        self.pending = set()  # Trozos encolados con queue_chunk que aún no se han escrito
+        # Ofertas que comparten este parcial (el mismo archivo puede llegar a
+        # la vez en público y en privado): {transfer_id: (remitente, destinatario, nombre)}
+        self.offers = {}
+        self.add_offer(self.transfer_id, payload)
+
+        if os.path.exists(part_path):
+            self.file = open(part_path, "r+b")
+            self._scan()
+        else:
+            self.file = open(part_path, "w+b")
+        self.file.truncate(self.size)
+
+    def add_offer(self, transfer_id, payload):
+        self.offers[transfer_id] = (payload["sender"], payload.get("recipient", "public"), payload["filename"])
+
+    def _scan(self):
+        """Comprueba qué trozos del parcial ya coinciden con el manifiesto."""
+        self.file.seek(0)
+        for index, digest in enumerate(self.chunks):
+            data = self.file.read(self.chunk_size)
+            if hashlib.sha256(data).digest() == digest:
+                self.have.add(index)
+
+    def describe(self):
+        """Metadatos que se guardan junto al parcial."""
+        return {
+            "file_id": self.file_id,
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": [digest.hex() for digest in self.chunks],
+        }
+
+    def missing(self):
+        return [index for index in range(len(self.chunks)) if index not in self.have]
+
+    def add_chunk(self, index, data):
+        """Escribe un trozo en su sitio. Devuelve False si no cuadra con el manifiesto."""
+        if not isinstance(index, int) or not 0 <= index < len(self.chunks):
+            return False
+        data = protocol.as_bytes(data)
+        if self.key is not None:
+            try:
+                data = security.open_chunk(self.key, index, data)
+            except ValueError:
+                return False
+        if hashlib.sha256(data).digest() != self.chunks[index]:
+            return False
+        with self.lock:
+            if index not in self.have and not self.file.closed:
+                self.file.seek(index * self.chunk_size)
+                self.file.write(data)
+                self.have.add(index)
+        return True
+
+    def queue_chunk(self, index, data):
+        """
+        Como add_chunk, pero el descifrado y el hash se hacen en el pool de
+        security, así el hilo de escucha sigue leyendo mientras tanto. data debe
+        ser una copia (no una vista sobre el búfer del lector). Devuelve el Future
+        con el resultado de add_chunk.
+        """
+        future = security.chunk_pool().submit(self.add_chunk, index, data)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._chunk_written)
+        return future
+
+    def _chunk_written(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def drain(self):
+        """Espera a que se escriban los trozos encolados con queue_chunk."""
+        with self.lock:
+            pending = list(self.pending)
+        futures.wait(pending)
+
+    def is_complete(self):
+        return len(self.have) == len(self.chunks)
+
+    def verify(self):
+        """Comprueba el hash del archivo completo sin cargarlo en memoria."""
+        self.file.flush()
+        self.file.seek(0)
+        file_hash = hashlib.sha256()
+        for block in iter(lambda: self.file.read(1024 * 1024), b""):
+            file_hash.update(block)
+        if file_hash.hexdigest() != self.file_id:
+            raise ValueError("El archivo recibido no coincide con su identificador.")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
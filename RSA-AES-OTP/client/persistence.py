@@ -1,8 +1,18 @@
 import os
 import json
+import hashlib
+import shutil
+import time
 from common import security
 
 LOGS_DIR = "chat_logs"
+TRANSFERS_DIR = "transfers"
+# Los envíos se recuerdan una semana por si algún destinatario pide reanudarlos
+OUTGOING_TTL = 7 * 24 * 3600
+
+
+def _safe_name(name):
+    return "".join(c for c in name if c.isalnum() or c in ("-", "_")).rstrip()
 
 
 class LogManager:
@@ -13,9 +23,7 @@ class LogManager:
 
     def _get_log_path(self, contact_name):
         """Genera una ruta de archivo segura para el log."""
-        safe_filename = "".join(
-            c for c in contact_name if c.isalnum() or c in ("-", "_")
-        ).rstrip()
+        safe_filename = _safe_name(contact_name)
         return os.path.join(LOGS_DIR, f"log_{self.owner}_with_{safe_filename}.json.enc")
 
     def load_conversation(self, contact_name):
@@ -39,3 +47,132 @@ class LogManager:
 
         with open(log_path, "wb") as f:
             f.write(encrypted_data)
+
+
+class TransferStore:
+    """
+    Estado en disco de las transferencias de archivos, para poder reanudarlas
+    tras una desconexión:
+      - Por cada archivo que estamos recibiendo, el parcial (<file_id>.part)
+        y sus metadatos (<file_id>.json).
+      - Un registro de los archivos enviados (outgoing.json), para volver a
+        ofrecerlos si el envío se cortó o si un destinatario lo pide.
+      - Los archivos ya recibidos (received/<file_id>). Los mensajes del chat
+        solo guardan su ruta, tamaño y hash, nunca el contenido.
+    """
+
+    def __init__(self, owner_nickname):
+        self.owner = owner_nickname
+        self.directory = os.path.join(TRANSFERS_DIR, _safe_name(owner_nickname))
+        # Ruta absoluta: queda guardada en el historial de los mensajes
+        self.spool_dir = os.path.abspath(os.path.join(self.directory, "received"))
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._outgoing_path = os.path.join(self.directory, "outgoing.json")
+        self.outgoing = self._load_outgoing()
+
+    def _load_outgoing(self):
+        try:
+            with open(self._outgoing_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if now - entry.get("time", 0) < OUTGOING_TTL}
+
+    def _save_outgoing(self):
+        with open(self._outgoing_path, "w", encoding="utf-8") as f:
+            json.dump(self.outgoing, f, indent=2)
+
+    # --- Envíos ---
+
+    def remember_outgoing(self, info):
+        """Apunta un envío (file_id, recipient, path, size) como pendiente."""
+        key = f"{info['recipient']}/{info['file_id']}"
+        self.outgoing[key] = dict(info, completed=False, time=time.time())
+        self._save_outgoing()
+
+    def complete_outgoing(self, file_id, recipient):
+        entry = self.outgoing.get(f"{recipient}/{file_id}")
+        if entry:
+            entry["completed"] = True
+            self._save_outgoing()
+
+    def pending_outgoing(self):
+        return [entry for entry in self.outgoing.values() if not entry["completed"]]
+
+    def find_outgoing(self, file_id, requester):
+        """
+        Ruta local de un archivo que le enviamos a requester (o al canal
+        público), si sigue existiendo. A quien no era el destinatario no se le
+        devuelve nada, aunque conozca el file_id.
+        """
+        for entry in self.outgoing.values():
+            if entry["file_id"] != file_id or entry["recipient"] not in (requester, "public"):
+                continue
+            if os.path.exists(entry["path"]):
+                return entry["path"]
+        return None
+
+    # --- Recepciones ---
+
+    def part_path(self, file_id):
+        return os.path.join(self.directory, f"{_safe_name(file_id)}.part")
+
+    def _info_path(self, file_id):
+        return os.path.join(self.directory, f"{_safe_name(file_id)}.json")
+
+    def save_incoming(self, info):
+        with open(self._info_path(info["file_id"]), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+
+    def load_incoming(self, file_id):
+        try:
+            with open(self._info_path(file_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def pending_incoming(self):
+        """Metadatos de los archivos que quedaron a medias."""
+        pending = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and name != "outgoing.json":
+                info = self.load_incoming(name[:-len(".json")])
+                if info:
+                    pending.append(info)
+        return pending
+
+    def remove_incoming(self, file_id):
+        for path in (self.part_path(file_id), self._info_path(file_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --- Archivos recibidos ---
+
+    def spool_path(self, file_id):
+        return os.path.join(self.spool_dir, _safe_name(file_id))
+
+    def spool_incoming(self, file_id, keep_part=False):
+        """
+        Pasa al spool el parcial ya completo de file_id y devuelve su ruta. Con
+        keep_part se copia en lugar de moverlo (otra transferencia lo comparte).
+        """
+        path = self.spool_path(file_id)
+        if keep_part:
+            shutil.copyfile(self.part_path(file_id), path)
+            return path
+        os.replace(self.part_path(file_id), path)
+        self.remove_incoming(file_id)
+        return path
+
+    def spool_bytes(self, content):
+        """Guarda en el spool un archivo recibido de una vez. Devuelve (ruta, file_id)."""
+        file_id = hashlib.sha256(content).hexdigest()
+        path = self.spool_path(file_id)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        return path, file_id
@@ -1,34 +1,1263 @@
+import asyncio
 import json
 import base64
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
 
-def create_message(msg_type, **payload):
+# --- Códecs de trama ---
+# Cada trama es un prefijo de 4 bytes con la longitud, seguido del cuerpo.
+# El cuerpo puede ir en JSON (el formato original) o en un formato binario
+# compacto. Un cuerpo JSON siempre empieza por '{', así que el binario usa un
+# byte mágico distinto y el receptor puede reconocer cualquiera de los dos.
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+
+# Orden de preferencia que anuncia el cliente durante el handshake.
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]
+
+BINARY_MAGIC = 0xB1
+_MAGIC_BYTE = bytes([BINARY_MAGIC])
+
+# --- Compresión por trama ---
+# Un cuerpo comprimido empieza por COMPRESSED_MAGIC y lleva detrás el cuerpo
+# original (JSON o binario) en deflate crudo con un diccionario predefinido.
+# El nombre de la opción incluye la versión del diccionario: si el diccionario
+# cambia, cambia el nombre y las dos partes solo lo usan si coinciden.
+COMPRESSED_MAGIC = 0xC5
+_COMPRESSED_BYTE = bytes([COMPRESSED_MAGIC])
+COMPRESSION_ZDICT = "deflate-dict2"
+SUPPORTED_COMPRESSION = [COMPRESSION_ZDICT]
+
+# Los cuerpos más pequeños no se comprimen
+COMPRESS_MIN_SIZE = 48
+# En cuerpos grandes se prueba antes con una muestra, y si apenas comprime
+# (un archivo ya comprimido, texto cifrado...) se envía tal cual.
+COMPRESS_PROBE_SIZE = 4096
+COMPRESS_PROBE_RATIO = 0.9
+COMPRESS_LEVEL = 6
+
+# Tamaño máximo del cuerpo de una trama, también una vez descomprimido. El
+# prefijo de longitud lo pone la otra parte (antes incluso del handshake): una
+# conexión que anuncia una trama mayor se cierra. Cabe de sobra el manifiesto
+# de un archivo de varios GB, y los archivos van en trozos de FILE_CHUNK_SIZE.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# --- Funciones opcionales del protocolo ---
+# El cliente anuncia las que entiende en client_public_key y el servidor
+# contesta con las que se usarán; un cliente antiguo no anuncia ninguna.
+# FEATURE_HEARTBEAT: el servidor manda "ping" a un cliente callado y este
+# contesta "pong", así se detectan las conexiones muertas.
+# FEATURE_PRESENCE: en vez de la lista de usuarios entera en cada cambio, el
+# servidor manda presence_join / presence_leave con un número de versión; la
+# lista entera (user_list_update con version) solo al entrar o si se pierde
+# algún delta (el cliente la pide con presence_sync).
+# FEATURE_GROUP_KEY: el canal público tiene una clave de grupo que el servidor
+# reparte (group_key, cifrada con la clave de sesión de cada uno) y cambia
+# cuando alguien entra o sale; un public_message con "epoch" va cifrado con la
+# clave de esa época, y es la misma trama para todos los que la tienen.
+# FEATURE_E2E: los privados van cifrados de extremo a extremo. El cliente pide
+# al servidor la clave pública RSA del destinatario (peer_key_request), crea
+# una clave para hablarle y se la manda sellada con RSA dentro del propio
+# private_message ("e2e"). El servidor solo reenvía el cifrado; si la clave
+# usada ya no es la del destinatario, le devuelve el mensaje con la nueva.
+FEATURE_HEARTBEAT = "heartbeat"
+FEATURE_PRESENCE = "presence_delta"
+FEATURE_GROUP_KEY = "group_key"
+FEATURE_E2E = "e2e_private"
+SUPPORTED_FEATURES = [FEATURE_HEARTBEAT, FEATURE_PRESENCE, FEATURE_GROUP_KEY, FEATURE_E2E]
+
+# Tamaño inicial del búfer de recepción de cada conexión
+RECV_BUFFER_SIZE = 64 * 1024
+
+# Escritura agrupada: tiempo máximo que una trama espera a otras antes de
+# enviarse, y volumen pendiente a partir del cual se envía sin esperar.
+FLUSH_INTERVAL = 0.002
+FLUSH_BYTES = 256 * 1024
+
+
+def _queue_full_error():
+    return BufferError("Cola de salida llena: el otro extremo no lee lo bastante rápido.")
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+# Etiquetas de tipo de los valores en el formato binario
+_TAG_NONE = 0x00
+_TAG_TRUE = 0x01
+_TAG_FALSE = 0x02
+_TAG_INT = 0x03
+_TAG_FLOAT = 0x04
+_TAG_STR = 0x05
+_TAG_BYTES = 0x06
+_TAG_LIST = 0x07
+_TAG_DICT = 0x08
+
+_TAG_NONE_BYTE = bytes([_TAG_NONE])
+_TAG_TRUE_BYTE = bytes([_TAG_TRUE])
+_TAG_FALSE_BYTE = bytes([_TAG_FALSE])
+_TAG_INT_BYTE = bytes([_TAG_INT])
+_TAG_FLOAT_BYTE = bytes([_TAG_FLOAT])
+_TAG_STR_BYTE = bytes([_TAG_STR])
+_TAG_BYTES_BYTE = bytes([_TAG_BYTES])
+_TAG_LIST_BYTE = bytes([_TAG_LIST])
+_TAG_DICT_BYTE = bytes([_TAG_DICT])
+
+_U8 = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_I64 = struct.Struct(">q")
+_F64 = struct.Struct(">d")
+
+
+def choose_codec(offered):
     """
-    Crea un mensaje JSON estandarizado, lo codifica a bytes y le prefija su longitud.
+    Elige el códec a usar a partir de la lista que anuncia el cliente.
+    Un cliente antiguo no anuncia nada y se queda en JSON.
+    """
+    for codec in offered or []:
+        if codec in SUPPORTED_CODECS:
+            return codec
+    return CODEC_JSON
+
+
+def as_bytes(value):
+    """
+    Devuelve un campo binario como bytes. Con el códec JSON los campos binarios
+    viajan en Base64; con el binario ya llegan como bytes.
+    """
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value)
+
+
+def encrypted_payload(nonce, tag, ciphertext):
+    """Empaqueta el resultado de encrypt_with_aes para enviarlo en un mensaje."""
+    return {"nonce": nonce, "tag": tag, "ciphertext": ciphertext}
+
+
+def _json_default(value):
+    # Los campos binarios se codifican en Base64 para que sean seguros en JSON
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Tipo no serializable en JSON: {type(value).__name__}")
+
+
+# --- Backends JSON ---
+# El códec JSON usa orjson o ujson si están instalados y si no la librería
+# estándar. Todos generan el mismo formato compacto en UTF-8, así que da igual
+# qué backend use cada extremo. dumps devuelve directamente bytes.
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=_json_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def _stdlib_loads(data):
+    return json.loads(bytes(data))
+
+JSON_BACKENDS = {"json": (_stdlib_dumps, _stdlib_loads)}
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    def _ujson_dumps(obj):
+        return ujson.dumps(obj, default=_json_default, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+    def _ujson_loads(data):
+        return ujson.loads(bytes(data))
+
+    JSON_BACKENDS["ujson"] = (_ujson_dumps, _ujson_loads)
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def _orjson_dumps(obj):
+        return orjson.dumps(obj, default=_json_default)
+
+    # orjson acepta memoryview, así que la trama no se copia antes de decodificarla
+    JSON_BACKENDS["orjson"] = (_orjson_dumps, orjson.loads)
+
+_JSON_PREFERENCE = ["orjson", "ujson", "json"]
+
+
+def set_json_backend(name=None):
+    """
+    Elige el backend JSON por nombre; sin nombre, el más rápido de los instalados.
+    Devuelve el nombre del backend en uso.
     """
+    global JSON_BACKEND, _json_dumps, _json_loads
+    if name is None:
+        name = next(backend for backend in _JSON_PREFERENCE if backend in JSON_BACKENDS)
+    _json_dumps, _json_loads = JSON_BACKENDS[name]
+    JSON_BACKEND = name
+    return name
+
+set_json_backend()
+
+
+def _encode_json(msg_type, payload):
     message = {
         "type": msg_type,
         "payload": payload
     }
-    json_message = json.dumps(message)
-    return len(json_message).to_bytes(4, 'big') + json_message.encode('utf-8')
+    return _json_dumps(message)
+
+
+def _encode_str(text, size_struct, parts):
+    data = text.encode("utf-8")
+    parts.append(size_struct.pack(len(data)))
+    parts.append(data)
+
+
+def _encode_value(value, parts):
+    if value is None:
+        parts.append(_TAG_NONE_BYTE)
+    elif value is True:
+        parts.append(_TAG_TRUE_BYTE)
+    elif value is False:
+        parts.append(_TAG_FALSE_BYTE)
+    elif isinstance(value, int):
+        parts.append(_TAG_INT_BYTE)
+        parts.append(_I64.pack(value))
+    elif isinstance(value, float):
+        parts.append(_TAG_FLOAT_BYTE)
+        parts.append(_F64.pack(value))
+    elif isinstance(value, str):
+        parts.append(_TAG_STR_BYTE)
+        _encode_str(value, _U32, parts)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(_TAG_BYTES_BYTE)
+        parts.append(_U32.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_TAG_LIST_BYTE)
+        parts.append(_U32.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(_TAG_DICT_BYTE)
+        _encode_fields(value, parts)
+    else:
+        raise TypeError(f"Tipo no serializable en binario: {type(value).__name__}")
+
+
+def _encode_fields(fields, parts):
+    parts.append(_U16.pack(len(fields)))
+    for key, value in fields.items():
+        _encode_str(key, _U8, parts)
+        _encode_value(value, parts)
+
+
+def _encode_binary(msg_type, payload):
+    """
+    Cuerpo binario: byte mágico, tipo del mensaje y los campos del payload.
+    Los campos bytes se copian tal cual, sin Base64.
+    """
+    parts = [_MAGIC_BYTE]
+    _encode_str(msg_type, _U8, parts)
+    _encode_fields(payload, parts)
+    return b"".join(parts)
+
+
+def binary_frame_head(msg_type, data_size, /, **payload):
+    """
+    Principio de una trama binaria cuyo último campo, "data", son data_size
+    bytes que no se incluyen: quien la envía los pone detrás, por ejemplo con
+    os.sendfile directamente desde el archivo (ver FileRegion).
+    """
+    parts = [_MAGIC_BYTE]
+    _encode_str(msg_type, _U8, parts)
+    parts.append(_U16.pack(len(payload) + 1))
+    for key, value in payload.items():
+        _encode_str(key, _U8, parts)
+        _encode_value(value, parts)
+    _encode_str("data", _U8, parts)
+    parts.append(_TAG_BYTES_BYTE)
+    parts.append(_U32.pack(data_size))
+    head = b"".join(parts)
+    return (len(head) + data_size).to_bytes(4, 'big') + head
+
+
+def _decode_slice(view, offset, size):
+    # Un corte más allá del final no falla solo: se queda corto sin avisar
+    if offset + size > len(view):
+        raise ValueError("Cuerpo binario truncado.")
+    return view[offset:offset + size]
+
+
+def _decode_str(view, offset, size_struct):
+    size = size_struct.unpack_from(view, offset)[0]
+    offset += size_struct.size
+    return str(_decode_slice(view, offset, size), "utf-8"), offset + size
+
+
+def _decode_value(view, offset, zero_copy=False):
+    tag = view[offset]
+    offset += 1
+    if tag == _TAG_NONE:
+        return None, offset
+    if tag == _TAG_TRUE:
+        return True, offset
+    if tag == _TAG_FALSE:
+        return False, offset
+    if tag == _TAG_INT:
+        return _I64.unpack_from(view, offset)[0], offset + _I64.size
+    if tag == _TAG_FLOAT:
+        return _F64.unpack_from(view, offset)[0], offset + _F64.size
+    if tag == _TAG_STR:
+        return _decode_str(view, offset, _U32)
+    if tag == _TAG_BYTES:
+        size = _U32.unpack_from(view, offset)[0]
+        offset += _U32.size
+        value = _decode_slice(view, offset, size)
+        return (value if zero_copy else bytes(value)), offset + size
+    if tag == _TAG_LIST:
+        count = _U32.unpack_from(view, offset)[0]
+        offset += _U32.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset, zero_copy)
+            items.append(item)
+        return items, offset
+    if tag == _TAG_DICT:
+        return _decode_fields(view, offset, zero_copy)
+    raise ValueError(f"Etiqueta binaria desconocida: {tag}")
+
+
+def _decode_fields(view, offset, zero_copy=False):
+    count = _U16.unpack_from(view, offset)[0]
+    offset += _U16.size
+    fields = {}
+    for _ in range(count):
+        key, offset = _decode_str(view, offset, _U8)
+        fields[key], offset = _decode_value(view, offset, zero_copy)
+    return fields, offset
+
+
+def _decode_binary(body, zero_copy=False):
+    """
+    Deshace _encode_binary. Cualquier cuerpo mal formado (truncado, con un
+    número de campos que no cuadra o una etiqueta desconocida) lanza
+    ValueError, que es lo único que esperan quienes decodifican tramas.
+    """
+    view = memoryview(body)
+    try:
+        msg_type, offset = _decode_str(view, 1, _U8)
+        payload, offset = _decode_fields(view, offset, zero_copy)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Cuerpo binario truncado: {e}") from None
+    if offset != len(view):
+        raise ValueError("Cuerpo binario con bytes de más.")
+    return {"type": msg_type, "payload": payload}
+
+
+def _extend_binary(body, fields):
+    # Se cambia el número de campos de la cabecera y los nuevos van al final;
+    # al decodificar gana el último valor de cada clave.
+    view = memoryview(body)
+    count_offset = 2 + view[1]
+    count = _U16.unpack_from(view, count_offset)[0]
+    parts = [view[:count_offset], _U16.pack(count + len(fields)), view[count_offset + _U16.size:]]
+    for key, value in fields.items():
+        _encode_str(key, _U8, parts)
+        _encode_value(value, parts)
+    return b"".join(parts)
+
+
+def _extend_json(body, message, fields):
+    # Solo si "payload" es la última clave del documento, que termina en "}}".
+    # Los campos nuevos van al final, y al decodificar gana el último valor.
+    if list(message)[-1] != "payload" or bytes(body[-2:]) != b"}}":
+        return None
+    extra = _json_dumps(fields)[1:-1]
+    separator = b"" if not message["payload"] else b","
+    return b"".join([body[:-2], separator, extra, b"}}"])
+
+
+def extend_body(body, message, **fields):
+    """
+    Devuelve el cuerpo (sin comprimir) de una trama con campos añadidos a su
+    payload, sin volver a codificar los que ya tenía. 'message' es el mensaje ya
+    decodificado de ese cuerpo. Devuelve None si el cuerpo no se puede ampliar
+    así y hay que recodificar el mensaje.
+    """
+    if body[0] == BINARY_MAGIC:
+        return _extend_binary(body, fields)
+    return _extend_json(body, message, fields)
+
+
+def body_codec(body):
+    """Códec de un cuerpo de trama sin comprimir."""
+    return CODEC_BINARY if body and body[0] == BINARY_MAGIC else CODEC_JSON
+
+
+def uncompressed_body(body, compressed=False):
+    """
+    Devuelve el cuerpo de la trama descomprimido si venía comprimido. Solo se
+    descomprime si compressed (la conexión negoció la compresión); si no, una
+    trama comprimida lanza ValueError.
+    """
+    if body and body[0] == COMPRESSED_MAGIC:
+        if not compressed:
+            raise ValueError("Trama comprimida en una conexión sin compresión.")
+        return decompress_body(body)
+    return body
+
+
+def _encode_body(codec, msg_type, payload):
+    if codec == CODEC_BINARY:
+        return _encode_binary(msg_type, payload)
+    return _encode_json(msg_type, payload)
+
+
+def encode_message(codec, msg_type, /, **payload):
+    """
+    Codifica un mensaje con el códec indicado y le prefija su longitud.
+    """
+    body = _encode_body(codec, msg_type, payload)
+    return len(body).to_bytes(4, 'big') + body
+
+
+def decode_message(body, zero_copy=False, compressed=False):
+    """
+    Decodifica el cuerpo de una trama, sea JSON, binario o (con compressed, si
+    la conexión negoció la compresión) comprimido.
+    Con zero_copy, los campos bytes de un cuerpo binario se devuelven como
+    memoryview sobre el propio cuerpo en vez de copiarse; solo valen mientras
+    el cuerpo siga vivo y sin reutilizar.
+    """
+    body = uncompressed_body(body, compressed)
+    if body and body[0] == BINARY_MAGIC:
+        return _decode_binary(body, zero_copy)
+    return _json_loads(body)
+
+
+def _build_zdict():
+    """
+    Diccionario de compresión "entrenado" con tramas típicas del chat, en los
+    dos códecs. Deflate encuentra antes lo que está al final, así que lo más
+    frecuente (claves de los mensajes de texto cifrados) va al final.
+    Se genera siempre con la librería estándar para que no dependa del backend.
+    """
+    samples = [
+        ("user_list_update", {"users": ["user_1", "user_2"]}),
+        ("file_transfer", {"sender": "", "recipient": "public", "filename": ".txt", "content": ""}),
+        ("private_message_echo", {"recipient": "", "content": encrypted_payload("", "", "")}),
+        ("private_message", {"sender": "", "recipient": "", "content": encrypted_payload("", "", "")}),
+        ("public_message", {"sender": "", "content": encrypted_payload("", "", "")}),
+    ]
+    parts = []
+    for msg_type, payload in samples:
+        parts.append(_encode_binary(msg_type, payload))
+        parts.append(_stdlib_dumps({"type": msg_type, "payload": payload}))
+    return b"".join(parts)
+
+ZDICT = _build_zdict()
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=ZDICT)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_body(body):
+    """
+    Comprime el cuerpo de una trama si merece la pena; si no, lo devuelve igual.
+    """
+    if len(body) < COMPRESS_MIN_SIZE:
+        return body
+    if len(body) > COMPRESS_PROBE_SIZE:
+        probe = memoryview(body)[:COMPRESS_PROBE_SIZE]
+        if len(_deflate(probe)) > COMPRESS_PROBE_SIZE * COMPRESS_PROBE_RATIO:
+            return body
+    compressed = _deflate(body)
+    if len(compressed) + 1 >= len(body):
+        return body
+    return _COMPRESSED_BYTE + compressed
+
+
+def decompress_body(body):
+    """Deshace compress_body."""
+    decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+    data = decompressor.decompress(memoryview(body)[1:], MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("La trama descomprimida supera el tamaño máximo.")
+    return data
+
+
+def choose_compression(offered):
+    """Elige la compresión a partir de las que anuncia el cliente (ninguna por defecto)."""
+    for compression in offered or []:
+        if compression in SUPPORTED_COMPRESSION:
+            return compression
+    return None
+
 
-def parse_message_from_socket(sock):
+def choose_features(offered):
+    """Funciones opcionales que entienden las dos partes, de las que anuncia el cliente."""
+    return [feature for feature in SUPPORTED_FEATURES if feature in (offered or [])]
+
+
+def create_message(msg_type, **payload):
+    """
+    Crea un mensaje JSON estandarizado, lo codifica a bytes y le prefija su longitud.
+    """
+    return encode_message(CODEC_JSON, msg_type, **payload)
+
+def _recv_exact(sock, view):
+    """Rellena la vista entera desde el socket. Devuelve False si se cierra antes."""
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            return False
+        received += count
+    return True
+
+def check_frame_size(msg_len):
+    """Lanza ValueError si un prefijo de longitud anuncia una trama mayor que MAX_FRAME_SIZE."""
+    if msg_len > MAX_FRAME_SIZE:
+        raise ValueError(f"Trama de {msg_len} bytes; el máximo es {MAX_FRAME_SIZE}.")
+
+def parse_message_from_socket(sock, compressed=False):
     """
     Lee un mensaje completo desde un socket, usando el prefijo de longitud.
+    Acepta también un SocketReader, que es lo que usan las conexiones del chat
+    (y entonces vale su propio compressed). compressed: la conexión negoció la
+    compresión.
     """
-    raw_msglen = sock.recv(4)
-    if not raw_msglen:
+    if isinstance(sock, SocketReader):
+        return sock.read_message()
+
+    raw_msglen = bytearray(4)
+    if not _recv_exact(sock, memoryview(raw_msglen)):
         return None
     msg_len = int.from_bytes(raw_msglen, 'big')
-    
+    check_frame_size(msg_len)
+
+    # El búfer crece con lo que llega, no con lo que anuncia el prefijo
     data = bytearray()
     while len(data) < msg_len:
-        packet = sock.recv(min(4096, msg_len - len(data)))
-        if not packet:
+        chunk = sock.recv(min(msg_len - len(data), RECV_BUFFER_SIZE))
+        if not chunk:
+            return None
+        data += chunk
+
+    return decode_message(data, compressed=compressed)
+
+
+class FrameEncoder:
+    """
+    Codificador de tramas de una conexión: sabe con qué códec y con qué
+    compresión hay que hablarle al otro extremo. No hace E/S; devuelve los
+    bytes listos para enviar.
+    """
+
+    def __init__(self, codec=CODEC_JSON, compression=None):
+        self.codec = codec
+        self.compression = compression
+
+    def encode(self, msg_type, /, **payload):
+        return self.wrap(_encode_body(self.codec, msg_type, payload))
+
+    def wrap(self, body):
+        """
+        Convierte en trama un cuerpo ya codificado con self.codec (por ejemplo,
+        uno recibido que se reenvía tal cual), comprimiéndolo si toca.
+        """
+        if self.compression:
+            body = compress_body(body)
+        return len(body).to_bytes(4, 'big') + body
+
+
+_encoders = {}
+
+def get_encoder(codec=CODEC_JSON, compression=None):
+    """
+    Devuelve el codificador compartido para un códec y una compresión. Como los
+    codificadores no tienen estado, todas las conexiones con las mismas opciones
+    usan el mismo objeto y una difusión puede codificar el mensaje una sola vez
+    por codificador.
+    """
+    key = (codec, compression)
+    encoder = _encoders.get(key)
+    if encoder is None:
+        encoder = _encoders.setdefault(key, FrameEncoder(codec, compression))
+    return encoder
+
+
+class FrameDecoder:
+    """
+    Decodificador incremental (sans-IO) de tramas con prefijo de longitud.
+
+    No sabe nada de sockets: recibe trozos de bytes de cualquier tamaño y va
+    entregando las tramas completas. Se puede alimentar de dos formas:
+      - feed(data), con los bytes que haya leído quien lo use;
+      - get_buffer() + buffer_updated(n), para que quien lee escriba directamente
+        en el búfer interno (recv_into, o asyncio.BufferedProtocol).
+
+    next_frame() entrega el cuerpo de la trama como un memoryview sobre el búfer,
+    sin copiarlo, y solo es válido hasta la siguiente vez que se alimente el
+    decodificador. Si el prefijo anuncia una trama mayor que MAX_FRAME_SIZE
+    lanza ValueError, y la conexión se debe cerrar.
+    compressed dice si la conexión negoció la compresión (para feed()).
+    """
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE):
+        self.compressed = False
+        self._default_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Inicio de los datos aún no entregados
+        self._end = 0    # Fin de los datos recibidos
+        self._needed = 4  # Bytes que necesita la trama en curso (prefijo incluido)
+
+    def next_frame(self):
+        """Devuelve el cuerpo de la siguiente trama completa, o None si faltan datos."""
+        pending = self._end - self._start
+        if pending < 4:
+            self._needed = 4
+            return None
+        msg_len = int.from_bytes(self._view[self._start:self._start + 4], 'big')
+        check_frame_size(msg_len)
+        frame_end = self._start + 4 + msg_len
+        if frame_end > self._end:
+            self._needed = 4 + msg_len
+            return None
+        frame = self._view[self._start + 4:frame_end]
+        self._start = frame_end
+        return frame
+
+    def frames(self):
+        """Itera sobre las tramas completas que ya están en el búfer."""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def feed(self, data):
+        """Añade un trozo de bytes y devuelve la lista de mensajes ya decodificados que completa."""
+        data = memoryview(data)
+        messages = []
+        while True:
+            messages.extend(decode_message(frame, compressed=self.compressed) for frame in self.frames())
+            if not data:
+                return messages
+            buffer = self.get_buffer()
+            count = min(len(buffer), len(data))
+            buffer[:count] = data[:count]
+            self.buffer_updated(count)
+            data = data[count:]
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Devuelve la zona libre del búfer donde escribir los siguientes bytes.
+        Con una trama grande el búfer crece a medida que llegan los bytes,
+        hasta que cabe la trama entera.
+        """
+        pending = self._end - self._start
+        size = len(self._buffer)
+        # Como mínimo un byte libre, aunque no se hayan consumido las tramas completas
+        needed = max(self._needed, pending + 1)
+        if needed > size:
+            # La trama en curso no cabe: no se reserva de golpe lo que dice su
+            # prefijo, se llena el búfer que hay y solo entonces se dobla
+            needed = pending + 1 if pending < size else min(needed, 2 * size)
+
+        if needed > size or (pending == 0 and size > self._default_size):
+            # La trama no cabe (o ya pasó una trama grande): búfer nuevo más grande.
+            # Las vistas entregadas antes siguen apuntando al búfer anterior.
+            new_buffer = bytearray(max(needed, self._default_size))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = new_buffer
+            self._view = memoryview(new_buffer)
+            self._start, self._end = 0, pending
+        elif pending == 0 or self._start + needed > size:
+            # Cabe, pero hay que mover los datos pendientes al principio
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Indica que se escribieron 'nbytes' en la zona devuelta por get_buffer()."""
+        self._end += nbytes
+
+
+class SocketReader:
+    """
+    Lector de tramas de un socket bloqueante: un FrameDecoder alimentado con
+    recv_into, un búfer por conexión. De una sola lectura pueden salir varias
+    tramas, y cada una se entrega sin copiarla (ver FrameDecoder.next_frame).
+    """
+
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(buffer_size)
+        # Se pone a True cuando la conexión negocia la compresión
+        self.compressed = False
+
+    def read_frame(self):
+        """Devuelve el cuerpo de la siguiente trama, o None si el socket se cerró."""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            received = self.sock.recv_into(self.decoder.get_buffer())
+            if not received:
+                return None
+            self.decoder.buffer_updated(received)
+
+    def read_message(self):
+        """Lee la siguiente trama y la decodifica."""
+        frame = self.read_frame()
+        if frame is None:
             return None
-        data.extend(packet)
-        
-    return json.loads(data.decode('utf-8'))
+        return decode_message(frame, compressed=self.compressed)
+
+class FileRegion:
+    """
+    Trama que se puede encolar en un SocketWriter en lugar de bytes: la cabecera
+    (de binary_frame_head) va en memoria y los count bytes desde offset se
+    envían directamente desde el archivo con sendfile, sin pasar por Python.
+    """
+
+    def __init__(self, head, file, offset, count):
+        self.head = head
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return len(self.head) + self.count
+
+
+class Backpressure:
+    """
+    Qué hace un escritor cuando un cliente lento deja que su cola de salida
+    pase de high_water bytes:
+      - BLOCK: quien envía espera (como mucho block_timeout segundos) a que la
+        cola baje de low_water; si no baja, se desconecta al cliente.
+      - DROP_OLDEST: se descartan las tramas prescindibles (tipos de mensaje en
+        droppable) más antiguas hasta bajar de low_water.
+      - COALESCE: de los tipos en coalesced (p. ej. user_list_update) solo se
+        deja en cola la trama más reciente, que deja obsoletas a las demás.
+      - DISCONNECT: se desconecta al cliente.
+    Con cualquier política, una cola que llega a max_bytes se cierra. Como no
+    guarda estado, todas las conexiones pueden compartir el mismo objeto.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+    POLICIES = (BLOCK, DROP_OLDEST, COALESCE, DISCONNECT)
+
+    def __init__(self, policy=COALESCE, high_water=1024 * 1024, low_water=256 * 1024, max_bytes=None,
+                 droppable=(), coalesced=(), block_timeout=5.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Política de cola desconocida: {policy}")
+        self.policy = policy
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water)
+        self.max_bytes = max_bytes
+        self.droppable = frozenset(droppable)
+        self.coalesced = frozenset(coalesced)
+        self.block_timeout = block_timeout
+
+
+class _FrameQueue:
+    """
+    Parte común de los escritores: la cola de tramas pendientes (cada una con
+    su aviso on_sent y su tipo de mensaje), la política para clientes lentos y
+    los contadores. policy_events cuenta cuántas veces actuó cada política:
+    esperas (blocked), tramas descartadas (dropped), tramas sustituidas por
+    otra más reciente (coalesced) y desconexiones (disconnected).
+    """
+
+    def _init_queue(self, backpressure):
+        self.backpressure = backpressure
+        self._pending = []
+        self._callbacks = []  # Alineada con _pending; None si la trama no tiene aviso
+        self._kinds = []      # Alineada con _pending; tipo de mensaje (o None)
+        self._pending_bytes = 0
+
+        # Contadores: envíos, tramas y bytes, un histograma de tramas por envío
+        # y los eventos de cada política
+        self.flushes = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_per_flush = collections.Counter()
+        self.policy_events = collections.Counter()
+
+    def _queued_bytes(self):
+        """Bytes que aún no han salido hacia el otro extremo."""
+        return self._pending_bytes
+
+    def _over(self, frame, mark):
+        # Una trama sola siempre cabe, aunque sea más grande que la marca
+        queued = self._queued_bytes()
+        return queued > 0 and queued + len(frame) > mark
+
+    def _append(self, frame, on_sent, kind):
+        self._pending.append(frame)
+        self._callbacks.append(on_sent)
+        self._kinds.append(kind)
+        self._pending_bytes += len(frame)
+
+    def _take(self, max_bytes=None):
+        """Saca las tramas más antiguas (todas, o hasta max_bytes y al menos una). Devuelve (tramas, avisos)."""
+        count = len(self._pending)
+        if max_bytes is not None:
+            size = 0
+            for count, frame in enumerate(self._pending, 1):
+                size += len(frame)
+                if size >= max_bytes:
+                    break
+        frames, callbacks = self._pending[:count], self._callbacks[:count]
+        del self._pending[:count], self._callbacks[:count], self._kinds[:count]
+        self._pending_bytes -= sum(len(frame) for frame in frames)
+        return frames, callbacks
+
+    def _remove(self, indices):
+        """Quita de la cola las tramas en esas posiciones y devuelve sus avisos."""
+        removed = set(indices)
+        callbacks = [self._callbacks[i] for i in indices]
+        self._pending_bytes -= sum(len(self._pending[i]) for i in removed)
+        keep = [i for i in range(len(self._pending)) if i not in removed]
+        self._pending = [self._pending[i] for i in keep]
+        self._callbacks = [self._callbacks[i] for i in keep]
+        self._kinds = [self._kinds[i] for i in keep]
+        return callbacks
+
+    def _apply_policy(self, frame, kind):
+        """
+        Decide qué hacer con una trama nueva según la política. Devuelve
+        (veredicto, avisos): el veredicto es "queue" (se encola), "drop" (se
+        descarta la nueva), "block" (quien envía debe esperar) o "disconnect";
+        los avisos son los de las tramas que se han quitado de la cola.
+        """
+        policy = self.backpressure
+        if policy is None:
+            return "queue", []
+        callbacks = []
+        if self._over(frame, policy.high_water):
+            if policy.policy == Backpressure.DISCONNECT:
+                return "disconnect", []
+            if policy.policy == Backpressure.BLOCK:
+                return "block", []
+            if policy.policy == Backpressure.COALESCE and kind in policy.coalesced:
+                older = [i for i, queued_kind in enumerate(self._kinds) if queued_kind == kind]
+                callbacks = self._remove(older)
+                self.policy_events["coalesced"] += len(older)
+            elif policy.policy == Backpressure.DROP_OLDEST:
+                callbacks = self._drop_oldest(policy.low_water)
+                if kind in policy.droppable and self._over(frame, policy.high_water):
+                    self.policy_events["dropped"] += 1
+                    return "drop", callbacks
+        if policy.max_bytes is not None and self._over(frame, policy.max_bytes):
+            return "disconnect", callbacks
+        return "queue", callbacks
+
+    def _drop_oldest(self, target):
+        # Descarta tramas prescindibles, de la más antigua a la más reciente, hasta bajar de target
+        excess = self._queued_bytes() - target
+        indices = []
+        for index, kind in enumerate(self._kinds):
+            if excess <= 0:
+                break
+            if kind in self.backpressure.droppable:
+                indices.append(index)
+                excess -= len(self._pending[index])
+        self.policy_events["dropped"] += len(indices)
+        return self._remove(indices)
+
+    def _count_flush(self, frames):
+        self.flushes += 1
+        self.frames_sent += len(frames)
+        self.bytes_sent += sum(len(frame) for frame in frames)
+        self.frames_per_flush[len(frames)] += 1
+
+    def stats(self):
+        """Resumen de los contadores del escritor."""
+        return {
+            "flushes": self.flushes,
+            "frames": self.frames_sent,
+            "bytes": self.bytes_sent,
+            "frames_per_flush": self.frames_sent / self.flushes if self.flushes else 0.0,
+            "max_frames_per_flush": max(self.frames_per_flush, default=0),
+            "policy_events": dict(self.policy_events),
+        }
+
+
+def _notify(callbacks):
+    # Si un aviso falla, los demás se llaman igual y el primer error se relanza al final
+    error = None
+    for callback in callbacks:
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                error = error or e
+    if error is not None:
+        raise error
+
+
+class SocketWriter(_FrameQueue):
+    """
+    Camino de escritura de una conexión. send() solo encola la trama; un hilo
+    propio las agrupa y las envía juntas con un único sendmsg (escritura
+    vectorizada), esperando como mucho flush_interval segundos desde que llega
+    la primera trama pendiente. Así una ráfaga de mensajes acaba en pocas
+    llamadas al sistema y pocos segmentos TCP.
+    Si el otro extremo no lee, la cola crece hasta las marcas de backpressure
+    (un Backpressure; None: sin límite) y se aplica su política. Cuando hay que
+    desconectar, el escritor se cierra y avisa con on_error. Un on_sent que
+    falla en el hilo escritor también se avisa con on_error, sin pararlo.
+    """
+
+    def __init__(self, sock, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, on_error=None,
+                 backpressure=None):
+        self.sock = sock
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.on_error = on_error
+        self._closed = False
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # Despierta al hilo escritor
+        self._room = threading.Condition(self._lock)  # Despierta a quien espera sitio en la cola (BLOCK)
+        self._sending_bytes = 0  # Bytes del lote que está enviando el hilo escritor
+        self._overflowed = False  # Cerrado por la política (ya se avisó con on_error)
+        self._init_queue(backpressure)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _queued_bytes(self):
+        return self._pending_bytes + self._sending_bytes
+
+    def send(self, frame, on_sent=None, kind=None):
+        """
+        Encola una trama. Devuelve False si no se encola, porque el escritor ya
+        está cerrado o porque la política la descarta; entonces on_sent no se
+        llamará. Si se encola, on_sent se llama desde el hilo escritor cuando la
+        trama ha salido al socket o se ha descartado después.
+        kind es el tipo de mensaje, que usa la política de la cola.
+        """
+        deadline = None
+        with self._lock:
+            while True:
+                if self._closed:
+                    return False
+                verdict, dropped = self._apply_policy(frame, kind)
+                # El propio hilo escritor (avisos on_sent que envían algo) no puede esperarse a sí mismo
+                if verdict != "block" or threading.current_thread() is self._thread:
+                    break
+                if deadline is None:
+                    self.policy_events["blocked"] += 1
+                    deadline = time.monotonic() + self.backpressure.block_timeout
+                low_water = self.backpressure.low_water
+                if not self._room.wait_for(
+                    lambda: self._closed or self._queued_bytes() <= low_water, deadline - time.monotonic()
+                ):
+                    verdict = "disconnect"
+                    break
+            if verdict == "disconnect":
+                self.policy_events["disconnected"] += 1
+                self._closed = True
+                self._overflowed = True
+                dropped += self._take()[1]
+                self._cond.notify()
+                self._room.notify_all()
+            elif verdict == "queue":
+                self._append(frame, on_sent, kind)
+                if len(self._pending) == 1 or self._pending_bytes >= self.flush_bytes:
+                    self._cond.notify()
+        _notify(dropped)
+        if verdict == "disconnect" and self.on_error:
+            self.on_error(_queue_full_error())
+        return verdict == "queue"
+
+    def close(self, timeout=1.0):
+        """Envía lo pendiente y detiene el hilo escritor."""
+        with self._lock:
+            self._closed = True
+            self._cond.notify()
+            self._room.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                # Damos margen a que lleguen más tramas, sin pasarnos del presupuesto
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and self._pending_bytes < self.flush_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                # Como mucho flush_bytes por envío: lo que siga en cola aún se puede descartar
+                frames, callbacks = self._take(self.flush_bytes)
+                self._sending_bytes = sum(len(frame) for frame in frames)
+                closed = self._closed and not self._pending
+
+            if frames:
+                try:
+                    _send_frames(self.sock, frames)
+                except (OSError, ValueError) as e:  # ValueError: archivo de una FileRegion ya cerrado
+                    with self._lock:
+                        self._closed = True
+                        self._sending_bytes = 0
+                        callbacks += self._take()[1]
+                        self._room.notify_all()
+                    self._notify_sent(callbacks)
+                    if self.on_error and not self._overflowed:
+                        self.on_error(e)
+                    return
+                with self._lock:
+                    self._sending_bytes = 0
+                    self._room.notify_all()
+                self._notify_sent(callbacks)
+                self._count_flush(frames)
+            if closed:
+                return
+
+    def _notify_sent(self, callbacks):
+        # Una excepción de un aviso no puede tumbar el hilo escritor en silencio
+        try:
+            _notify(callbacks)
+        except Exception as e:
+            if self.on_error:
+                self.on_error(e)
+
+
+class TransportWriter(_FrameQueue):
+    """
+    Camino de escritura de una conexión asyncio, con la misma interfaz que
+    SocketWriter pero sin hilo propio: las tramas encoladas en los siguientes
+    flush_interval segundos salen juntas con un solo writelines en el bucle de
+    eventos. Se puede llamar a send() desde otros hilos.
+
+    on_sent se llama cuando la trama ha pasado al transporte sin llenarlo; si
+    el transporte pide una pausa (pause_writing), las tramas siguientes esperan
+    aquí y los avisos llegan al reanudarse. Así los créditos de los archivos
+    se conceden al mismo ritmo que con el escritor por hilos.
+    Las FileRegion salen con loop.sendfile. La cola (lo pendiente aquí más el
+    búfer del transporte) sigue la política de backpressure, salvo que BLOCK
+    solo puede hacer esperar a quien envía desde otro hilo: el bucle de eventos
+    no se puede parar, así que ahí la trama se encola hasta el tope max_bytes.
+    """
+
+    def __init__(self, transport, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES, on_error=None,
+                 backpressure=None):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.on_error = on_error
+        self._waiting = []  # Avisos de tramas ya escritas, a la espera de que el transporte se vacíe
+        self._timer = None
+        self._paused = False
+        self._sending_file = False
+        self._closed = False
+        self._thread_id = threading.get_ident()
+        self._room = threading.Event()  # Puesto mientras la cola está por debajo de la marca baja
+        self._room.set()
+        self._init_queue(backpressure)
+
+    def _queued_bytes(self):
+        return self._pending_bytes + self.transport.get_write_buffer_size()
+
+    def send(self, frame, on_sent=None, kind=None):
+        """Encola una trama. Devuelve False si el escritor ya está cerrado (o si la política la descarta)."""
+        if self._closed:
+            return False
+        if threading.get_ident() != self._thread_id:
+            policy = self.backpressure
+            if policy is not None and policy.policy == Backpressure.BLOCK and not self._room.is_set():
+                self.policy_events["blocked"] += 1
+                if not self._room.wait(policy.block_timeout):
+                    self.loop.call_soon_threadsafe(self._disconnect_slow, [])
+            self.loop.call_soon_threadsafe(self._send_from_thread, frame, on_sent, kind)
+            return True
+        verdict, dropped = self._apply_policy(frame, kind)
+        if verdict == "block":
+            self._room.clear()
+            verdict, more = self._apply_policy_cap(frame)
+            dropped += more
+        if verdict == "disconnect":
+            self._disconnect_slow(dropped)
+            return False
+        _notify(dropped)
+        if verdict == "drop":
+            return False
+        self._append(frame, on_sent, kind)
+        if self._pending_bytes >= self.flush_bytes:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.flush_interval, self._flush)
+        return True
+
+    def _apply_policy_cap(self, frame):
+        # BLOCK desde el bucle: no se puede esperar, solo se respeta el tope
+        max_bytes = self.backpressure.max_bytes
+        if max_bytes is not None and self._over(frame, max_bytes):
+            return "disconnect", []
+        return "queue", []
+
+    def _disconnect_slow(self, dropped):
+        if self._closed:
+            _notify(dropped)
+            return
+        self.policy_events["disconnected"] += 1
+        self._closed = True
+        self._drop()
+        _notify(dropped)
+        if self.on_error:
+            self.on_error(_queue_full_error())
+
+    def _send_from_thread(self, frame, on_sent, kind):
+        # Ya en el bucle: si entretanto se cerró (o se descarta), el aviso se da igualmente
+        if not self.send(frame, on_sent, kind) and on_sent:
+            on_sent()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        waiting, self._waiting = self._waiting, []
+        _notify(waiting)
+        self._flush()
+        self._update_room()
+
+    def close(self):
+        """Pasa lo pendiente al transporte (que lo enviará antes de cerrarse) y no admite más tramas."""
+        self._closed = True
+        self._paused = False
+        self._flush()
+        self._room.set()
+
+    def connection_lost(self):
+        """La conexión se cerró: se descarta lo pendiente y se avisa a quien esperaba."""
+        self._closed = True
+        self._drop()
+
+    def _update_room(self):
+        if self.backpressure is not None and self._queued_bytes() <= self.backpressure.low_water:
+            self._room.set()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._paused or self._sending_file or not self._pending:
+            return
+        if self.transport.is_closing():
+            self._drop()
+            return
+        frames, callbacks = self._take()
+        if any(isinstance(frame, FileRegion) for frame in frames):
+            self._sending_file = True
+            self.loop.create_task(self._write_with_files(frames, callbacks))
+            return
+        self.transport.writelines(frames)
+        self._written(frames, callbacks)
+
+    async def _write_with_files(self, frames, callbacks):
+        batch = []
+        try:
+            for frame in frames:
+                if isinstance(frame, FileRegion):
+                    batch.append(frame.head)
+                    self.transport.writelines(batch)
+                    batch = []
+                    # loop.sendfile usa os.sendfile si puede y si no lee el archivo
+                    await self.loop.sendfile(self.transport, frame.file, frame.offset, frame.count)
+                else:
+                    batch.append(frame)
+            if batch:
+                self.transport.writelines(batch)
+        except (OSError, ValueError, RuntimeError) as e:  # RuntimeError: el transporte se está cerrando
+            self._sending_file = False
+            self._closed = True
+            _notify(callbacks)
+            self._drop()
+            if self.on_error:
+                self.on_error(e)
+            return
+        self._sending_file = False
+        self._written(frames, callbacks)
+        self._flush()
+
+    def _written(self, frames, callbacks):
+        self._count_flush(frames)
+        if self._paused:
+            self._waiting += callbacks
+            return
+        _notify(callbacks)
+        self._update_room()
+
+    def _drop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        callbacks = self._waiting + self._take()[1]
+        self._waiting = []
+        self._room.set()
+        _notify(callbacks)
+
+
+def _send_frames(sock, frames):
+    """Envía todas las tramas; las FileRegion cortan el lote y salen con sendfile."""
+    batch = []
+    for frame in frames:
+        if isinstance(frame, FileRegion):
+            batch.append(frame.head)
+            _send_buffers(sock, batch)
+            batch = []
+            # socket.sendfile usa os.sendfile donde existe y si no lee el archivo
+            sock.sendfile(frame.file, frame.offset, frame.count)
+        else:
+            batch.append(frame)
+    if batch:
+        _send_buffers(sock, batch)
+
+
+def _send_buffers(sock, frames):
+    """Envía varios búferes, con sendmsg si existe (en Windows no) y si no uniéndolos."""
+    if not _HAS_SENDMSG:
+        sock.sendall(b"".join(frames))
+        return
+    buffers = [memoryview(frame) for frame in frames]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + _IOV_MAX])
+        # sendmsg puede enviar solo una parte: saltamos lo que ya salió
+        while sent:
+            size = len(buffers[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                buffers[index] = buffers[index][sent:]
+                sent = 0
 
 def create_login_message(nickname):
     return create_message("login", nickname=nickname)
@@ -39,6 +1268,14 @@ def create_public_message(text):
 def create_private_message(recipient, text):
     return create_message("private_message", recipient=recipient, content=text)
 
+# --- Transferencia de archivos por trozos ---
+# file_offer anuncia el archivo, le siguen tramas file_chunk de tamaño fijo y
+# file_complete (o file_cancel) lo cierra. El emisor solo envía un trozo por
+# cada crédito que le concede el servidor con file_credit.
+# Los archivos públicos se suben una sola vez al almacén del servidor, que
+# avisa al resto con file_ref; cada cliente lo descarga si quiere con file_fetch.
+FILE_CHUNK_SIZE = 64 * 1024
+
 def create_file_message(recipient, filename, file_content_bytes):
     """
     Crea un mensaje para enviar un archivo.
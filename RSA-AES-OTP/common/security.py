@@ -1,5 +1,13 @@
 from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+import collections
+import functools
+import hashlib
+import itertools
 import os
+import threading
 
 # NUEVO: Importaciones para RSA y AES
 from Crypto.PublicKey import RSA
@@ -50,11 +58,38 @@ def get_public_key_pem(rsa_key):
     """Exporta la parte pública de una clave RSA a formato PEM."""
     return rsa_key.publickey().export_key()
 
+def key_fingerprint(public_key_pem):
+    """Huella corta de una clave pública PEM, para comprobar que es la misma sin enviarla entera."""
+    return hashlib.sha256(public_key_pem).hexdigest()[:32]
+
+class PeerKey:
+    """
+    Clave pública RSA de la otra parte ya leída del PEM. Leerla (RSA.import_key)
+    cuesta bastante más que cifrar con ella, y en el handshake se cifra varias
+    veces con la misma: por eso se guardan en peer_key().
+    """
+
+    def __init__(self, public_key_pem):
+        self.pem = public_key_pem
+        self.key = RSA.import_key(public_key_pem)
+        self.fingerprint = key_fingerprint(public_key_pem)
+
+    def encrypt(self, data):
+        # El objeto OAEP es barato; uno por llamada para poder cifrar desde varios hilos
+        return PKCS1_OAEP.new(self.key).encrypt(data)
+
+
+# Claves públicas que se guardan ya leídas (las del servidor, los contactos...)
+PEER_KEY_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=PEER_KEY_CACHE_SIZE)
+def peer_key(public_key_pem):
+    """PeerKey de un PEM (bytes), leída solo la primera vez."""
+    return PeerKey(public_key_pem)
+
 def encrypt_with_rsa(public_key_pem, data):
     """Cifra datos usando una clave pública RSA en formato PEM."""
-    recipient_key = RSA.import_key(public_key_pem)
-    cipher_rsa = PKCS1_OAEP.new(recipient_key)
-    return cipher_rsa.encrypt(data)
+    return peer_key(public_key_pem).encrypt(data)
 
 def decrypt_with_rsa(rsa_private_key, encrypted_data):
     """Descifra datos usando un objeto de clave privada RSA."""
@@ -100,4 +135,173 @@ def decrypt_with_aes(session_key, nonce, tag, ciphertext):
     # Desciframos y verificamos. Si el tag no es correcto, esta línea fallará.
     decrypted_bytes = cipher.decrypt_and_verify(ciphertext, tag)
     
-    return decrypted_bytes
\ No newline at end of file
+    return decrypted_bytes
+
+# --- Cifrado de los mensajes de una sesión ---
+# encrypt_with_aes prepara un cifrador de pycryptodome nuevo para cada mensaje,
+# y eso cuesta mucho más que cifrar un mensaje de chat. SessionCipher se crea
+# una vez por conexión con el AESGCM de cryptography (OpenSSL). El nonce, de 96
+# bits, es un prefijo de 4 bytes que dice quién cifra (cliente o servidor) y un
+# contador de 8: nunca se repite con la misma clave y no hay que sacar bytes
+# aleatorios en cada mensaje. Lo que cifra es compatible con decrypt_with_aes
+# y descifra también lo de encrypt_with_aes (nonces aleatorios de 16 bytes),
+# así que habla con clientes y servidores antiguos.
+
+NONCE_PREFIX_CLIENT = b"\x00\x00\x00\x01"
+NONCE_PREFIX_SERVER = b"\x00\x00\x00\x02"
+SESSION_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+
+
+class SessionCipher:
+    """
+    Cifrador AES-GCM de una clave de sesión, para una de las dos partes:
+    send_prefix es el prefijo de los nonces de lo que cifra esta parte. Al
+    descifrar se rechaza un nonce con ese mismo prefijo, que solo puede ser un
+    mensaje nuestro devuelto por alguien. Se puede usar desde varios hilos.
+    """
+
+    def __init__(self, key, send_prefix):
+        self.key = key
+        self.send_prefix = send_prefix
+        self._aead = AESGCM(key)
+        self._counter = itertools.count(1)  # next() es atómico: no hace falta candado
+
+    def next_nonce(self):
+        return self.send_prefix + next(self._counter).to_bytes(SESSION_NONCE_SIZE - len(self.send_prefix), "big")
+
+    def encrypt(self, data):
+        """Cifra data; devuelve nonce, tag y ciphertext, como encrypt_with_aes."""
+        nonce = self.next_nonce()
+        sealed = self._aead.encrypt(nonce, data, None)
+        return nonce, sealed[-GCM_TAG_SIZE:], sealed[:-GCM_TAG_SIZE]
+
+    def decrypt(self, nonce, tag, ciphertext):
+        """Descifra y comprueba el mensaje. Lanza ValueError si no es auténtico."""
+        if len(nonce) == SESSION_NONCE_SIZE and bytes(nonce[:len(self.send_prefix)]) == self.send_prefix:
+            raise ValueError("El mensaje lleva un nonce de esta misma parte.")
+        try:
+            return self._aead.decrypt(bytes(nonce), bytes(ciphertext) + bytes(tag), None)
+        except InvalidTag:
+            raise ValueError("El mensaje cifrado no es auténtico.") from None
+
+
+def client_cipher(key):
+    """SessionCipher del lado del cliente."""
+    return SessionCipher(key, NONCE_PREFIX_CLIENT)
+
+def server_cipher(key):
+    """SessionCipher del lado del servidor."""
+    return SessionCipher(key, NONCE_PREFIX_SERVER)
+
+# --- Cifrado de archivos por trozos ---
+# Cada transferencia usa una clave AES propia que viaja en la oferta cifrada con
+# la clave de sesión. Cada trozo se cifra por separado con AES-GCM y se envía
+# como un único bloque nonce + ciphertext + tag; el índice del trozo va como
+# dato asociado, así un trozo no se puede hacer pasar por otro.
+# Para los archivos se usa el AESGCM de cryptography (OpenSSL), mucho más rápido
+# que el de pycryptodome con trozos grandes.
+
+CHUNK_NONCE_SIZE = 12
+CHUNK_OVERHEAD = CHUNK_NONCE_SIZE + 16  # nonce + tag
+
+def seal_chunk(key, index, data):
+    """Cifra un trozo de archivo. data puede ser cualquier objeto tipo bytes (p. ej. un mmap)."""
+    nonce = os.urandom(CHUNK_NONCE_SIZE)
+    return nonce + AESGCM(key).encrypt(nonce, data, index.to_bytes(8, "big"))
+
+def open_chunk(key, index, sealed):
+    """Descifra un trozo sellado con seal_chunk. Lanza ValueError si no es auténtico."""
+    sealed = memoryview(sealed)
+    try:
+        return AESGCM(key).decrypt(sealed[:CHUNK_NONCE_SIZE], sealed[CHUNK_NONCE_SIZE:], index.to_bytes(8, "big"))
+    except InvalidTag:
+        raise ValueError("El trozo cifrado no es auténtico.") from None
+
+# --- Cifrado de trozos en paralelo ---
+# AES-GCM (OpenSSL) y hashlib sueltan el GIL con bloques grandes, así que con
+# varios hilos los trozos de una transferencia se cifran y descifran a la vez
+# en varios núcleos. El pool está acotado: como mucho hay max_pending trozos
+# esperando o en curso, y quien encola de más se queda esperando (así un
+# receptor rápido no llena la memoria de trozos pendientes de descifrar).
+
+CHUNK_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class ChunkCipherPool:
+    """
+    Pool de hilos para cifrar y descifrar trozos de archivo en paralelo. Con un
+    solo hilo no compensa pasar los trozos a otro: se procesan en el que llama.
+    """
+
+    def __init__(self, workers=CHUNK_WORKERS, max_pending=None):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending or 2 * self.workers
+        self.executor = None
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chunk-cipher")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def submit(self, function, *args):
+        """Encola function(*args) y devuelve su Future. Se bloquea si el pool está lleno."""
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def map_ordered(self, function, items, lookahead=None):
+        """
+        Aplica function(*item) a cada elemento de items en paralelo y devuelve
+        los resultados en el mismo orden. Solo se adelantan lookahead elementos,
+        así que items puede ser un generador sobre un archivo enorme.
+        """
+        lookahead = lookahead or self.max_pending
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append(self.submit(function, *item))
+                if len(pending) >= lookahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Si se deja a medias, esperamos a los que quedan: pueden tener vistas
+            # sobre un mmap que el llamador va a cerrar
+            for future in pending:
+                future.cancel()
+            futures_wait(pending)
+
+    def seal_chunks(self, key, chunks):
+        """Cifra los trozos (index, data) y devuelve los sellados en orden."""
+        return self.map_ordered(functools.partial(seal_chunk, key), chunks)
+
+    def open_chunks(self, key, chunks):
+        """Descifra los trozos (index, sealed) en orden. Lanza ValueError en el primero que no sea auténtico."""
+        return self.map_ordered(functools.partial(open_chunk, key), chunks)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+_chunk_pool = None
+_chunk_pool_lock = threading.Lock()
+
+def chunk_pool():
+    """Pool compartido por todas las transferencias del proceso (se crea al primer uso)."""
+    global _chunk_pool
+    with _chunk_pool_lock:
+        if _chunk_pool is None:
+            _chunk_pool = ChunkCipherPool()
+        return _chunk_pool
@@ -1,10 +1,9 @@
 import tkinter as tk
 from tkinter import simpledialog, messagebox
 import os
-import base64
 from client.gui.manager import GuiManager
 from client.network.handler import NetworkHandler
-from client.persistence import LogManager
+from client.persistence import LogManager, TransferStore
 
 from common import protocol
 from common import security
@@ -24,6 +23,7 @@ class ChatApplication:
         gui_callbacks = {
             "send_message": self.send_message,
             "send_file": self.send_file,
+            "fetch_file": self.fetch_file,
             "start_private_chat": self.start_private_chat,
             "switch_chat_view": self.switch_chat_view,
         }
@@ -36,7 +36,7 @@ class ChatApplication:
     def start(self):
         # 1. Conectar y realizar intercambio RSA (Fase 1)
         if not self.network.connect("127.0.0.1", 5000):
-            messagebox.showerror("Error", "No se pudo conectar al servidor.")
+            messagebox.showerror("Error", self.network.refusal or "No se pudo conectar al servidor.")
             self.shutdown()
             return
         
@@ -74,14 +74,14 @@ class ChatApplication:
             encrypted_aes_key = security.encrypt_with_rsa(self.network.server_rsa_public_pem, session_key)
             
             # 3. La envía al servidor
-            aes_msg = protocol.create_message(
+            aes_msg = self.network.encoder.encode(
                 "aes_key_exchange",
-                key=base64.b64encode(encrypted_aes_key).decode('ascii')
+                key=encrypted_aes_key
             )
             self.network.socket.sendall(aes_msg)
 
             # 4. Espera la confirmación final del servidor
-            final_msg = protocol.parse_message_from_socket(self.network.socket)
+            final_msg = self.network.reader.read_message()
             return final_msg and final_msg.get("type") == "secure_channel_ready"
         except Exception as e:
             print(f"Excepción durante el establecimiento de AES: {e}")
@@ -102,6 +102,8 @@ class ChatApplication:
         if self.nickname:
             self.log_manager = LogManager(self.nickname)
             self.conversations["public"] = self.log_manager.load_conversation("public")
+            # Reanuda los archivos que quedaron a medias en la última sesión
+            self.network.resume_transfers(TransferStore(self.nickname))
             self.root.deiconify() # <-- Mostramos la ventana principal
             self.switch_chat_view("public")
         else:
@@ -111,12 +113,12 @@ class ChatApplication:
         try:
             # 1. Espera el reto del servidor
             print("Esperando reto OTP del servidor...")
-            challenge_msg = protocol.parse_message_from_socket(self.network.socket)
+            challenge_msg = self.network.reader.read_message()
             if not challenge_msg or challenge_msg.get("type") != "otp_challenge":
                 return False
 
             # 2. Descifra el reto con la CLAVE PRIVADA DEL CLIENTE
-            encrypted_challenge = base64.b64decode(challenge_msg["payload"]["challenge"])
+            encrypted_challenge = protocol.as_bytes(challenge_msg["payload"]["challenge"])
             decrypted_otp = security.decrypt_with_rsa(self.network.rsa_private_key, encrypted_challenge).decode('utf-8')
 
             # 3. Muestra el código al usuario y le pide que lo re-ingrese
@@ -130,14 +132,14 @@ class ChatApplication:
             encrypted_response = security.encrypt_with_rsa(self.network.server_rsa_public_pem, user_response.encode('utf-8'))
             
             # 5. Envía la respuesta cifrada al servidor
-            response_msg = protocol.create_message(
+            response_msg = self.network.encoder.encode(
                 "otp_response",
-                response=base64.b64encode(encrypted_response).decode('ascii')
+                response=encrypted_response
             )
             self.network.socket.sendall(response_msg)
 
             # 6. Espera la confirmación final del servidor
-            final_msg = protocol.parse_message_from_socket(self.network.socket)
+            final_msg = self.network.reader.read_message()
             return final_msg and final_msg.get("type") == "auth_success"
 
         except Exception as e:
@@ -159,52 +161,40 @@ class ChatApplication:
 
     def send_message(self, recipient, content):
         # MODIFICADO: Ahora ciframos el mensaje antes de enviarlo
-        if self.network.session_key:
+        if self.network.session_key and recipient != "public":
+            # Los privados los cifra NetworkHandler: de extremo a extremo si el destinatario puede
+            self.network.send_private_message(recipient, content)
+        elif self.network.session_key:
             content_bytes = content.encode('utf-8')
             
-            # 1. Cifrar el contenido
-            nonce, tag, ciphertext = security.encrypt_with_aes(self.network.session_key, content_bytes)
+            # 1. Cifrar el contenido (con el cifrador de la sesión, preparado una sola vez)
+            nonce, tag, ciphertext = self.network.cipher.encrypt(content_bytes)
             
-            # 2. Empaquetar todo en un diccionario, codificado en Base64
-            encrypted_payload = {
-                'nonce': base64.b64encode(nonce).decode('ascii'),
-                'tag': base64.b64encode(tag).decode('ascii'),
-                'ciphertext': base64.b64encode(ciphertext).decode('ascii')
-            }
+            # 2. Empaquetar todo en un diccionario (el códec JSON lo pasa a Base64)
+            encrypted_payload = protocol.encrypted_payload(nonce, tag, ciphertext)
             
-            if recipient == "public":
-                self.network.send("public_message", content=encrypted_payload)
-                # La lógica para mostrar tu propio mensaje no cambia
-                msg = {"type": "message", "sender": self.nickname, "content": content}
-                self.conversations.setdefault("public", []).append(msg)
-                if self.gui.active_chat == "public":
-                    self.gui.add_message_to_view(msg)
-            else:
-                self.network.send("private_message", recipient=recipient, content=encrypted_payload)
+            self.network.send("public_message", content=encrypted_payload)
+            # La lógica para mostrar tu propio mensaje no cambia
+            msg = {"type": "message", "sender": self.nickname, "content": content}
+            self.conversations.setdefault("public", []).append(msg)
+            if self.gui.active_chat == "public":
+                self.gui.add_message_to_view(msg)
         else:
             messagebox.showerror("Error", "No se ha establecido una sesión segura.")
 
     def send_file(self, recipient, filepath):
         try:
             filename = os.path.basename(filepath)
-            with open(filepath, "rb") as f:
-                content_bytes = f.read()
-            
-            b64_content = base64.b64encode(content_bytes).decode("ascii")
-
-            self.network.send(
-                "file_transfer",
-                recipient=recipient,
-                filename=filename,
-                content=b64_content,
-            )
+            # El archivo sale por trozos desde un hilo aparte; no se carga entero en memoria
+            self.network.send_file(recipient, filepath, on_finished=self._on_file_sent)
 
+            # En el historial guardamos la ruta del archivo, no su contenido
             contact = recipient
             msg = {
                 "type": "file",
                 "sender": self.nickname,
                 "filename": filename,
-                "content": b64_content,
+                "path": filepath,
             }
             self.conversations.setdefault(contact, []).append(msg)
 
@@ -214,6 +204,25 @@ class ChatApplication:
         except Exception as e:
             messagebox.showerror("Error de Envío", f"No se pudo enviar el archivo: {e}")
 
+    def fetch_file(self, file_id, filename, save_path):
+        # Los archivos públicos están en el almacén del servidor; se descargan al guardarlos
+        self.gui._add_system_message(f"Descargando '{filename}'...")
+        self.network.fetch_file(
+            file_id, save_path,
+            on_finished=lambda error: self.root.after(0, self._on_file_fetched, filename, error)
+        )
+
+    def _on_file_fetched(self, filename, error):
+        if error:
+            messagebox.showerror("Error de Descarga", f"No se pudo descargar el archivo: {error}")
+        else:
+            self.gui._add_system_message(f"Archivo '{filename}' guardado.")
+
+    def _on_file_sent(self, error):
+        # Se llama desde el hilo de envío del archivo
+        if error:
+            self.root.after(0, messagebox.showerror, "Error de Envío", f"No se pudo enviar el archivo: {error}")
+
     def start_private_chat(self, contact_name):
         if contact_name not in self.conversations:
             self.conversations[contact_name] = self.log_manager.load_conversation(
@@ -247,13 +256,8 @@ class ChatApplication:
             content = "" # Variable para guardar el texto descifrado
             
             try:
-                # 1. Decodificar las partes del mensaje desde Base64
-                nonce = base64.b64decode(encrypted_content['nonce'])
-                tag = base64.b64decode(encrypted_content['tag'])
-                ciphertext = base64.b64decode(encrypted_content['ciphertext'])
-                
-                # 2. Intentar descifrar con la clave de sesión
-                decrypted_bytes = security.decrypt_with_aes(self.network.session_key, nonce, tag, ciphertext)
+                # Descifrar con la clave de sesión (o la de grupo o de extremo a extremo, según el mensaje)
+                decrypted_bytes = self.network.decrypt_content(payload)
                 content = decrypted_bytes.decode('utf-8')
 
             except (ValueError, KeyError, TypeError):
@@ -285,7 +289,6 @@ class ChatApplication:
             sender = payload["sender"]
             recipient = payload.get("recipient", "public")
             filename = payload["filename"]
-            b64_content = payload["content"]
 
             contact = "public"
             if recipient != "public":
@@ -293,20 +296,42 @@ class ChatApplication:
             
             self.start_private_chat(contact)
 
+            # El archivo ya está en el spool del disco: el mensaje solo guarda dónde
             msg = {
                 "type": "file",
                 "sender": sender,
                 "filename": filename,
-                "content": b64_content,
+                "path": payload["path"],
+                "size": payload.get("size"),
+                "hash": payload.get("file_id"),
             }
             self.conversations.setdefault(contact, []).append(msg)
 
             if self.gui.active_chat == contact:
                 self.gui.add_message_to_view(msg)
 
+        elif msg_type == "file_ref":
+            # Archivo público guardado en el servidor: solo mostramos el enlace
+            msg = {
+                "type": "file",
+                "sender": payload["sender"],
+                "filename": payload["filename"],
+                "file_id": payload["file_id"],
+                "size": payload.get("size"),
+            }
+            self.conversations.setdefault("public", []).append(msg)
+            if self.gui.active_chat == "public":
+                self.gui.add_message_to_view(msg)
+
         elif msg_type == "user_list_update":
             self.gui.update_user_list(payload["users"])
 
+        elif msg_type == "presence_join":
+            self.gui.add_users(payload["users"])
+
+        elif msg_type == "presence_leave":
+            self.gui.remove_users(payload["users"])
+
     def handle_disconnect(self, reason):
         # MODIFICADO: Envolvemos las llamadas a la GUI en un try-except
         try:
@@ -1,11 +1,21 @@
+import sys
 import tkinter as tk
 from server.server import ChatServer
+from server.async_server import AsyncChatServer
+from server.cluster import Cluster
 from server.gui import ServerGUI
 from server import config
 
+SERVER_BACKENDS = {"threads": ChatServer, "asyncio": AsyncChatServer}
+
 if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else config.BACKEND
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else config.WORKERS
     root = tk.Tk()
     gui = ServerGUI(root)
-    server = ChatServer(config.HOST, config.PORT, logger=gui.log)
+    if workers > 1:
+        server = Cluster(SERVER_BACKENDS[backend], config.HOST, config.PORT, workers, logger=gui.log)
+    else:
+        server = SERVER_BACKENDS[backend](config.HOST, config.PORT, logger=gui.log)
     server.start_in_thread()
     root.mainloop()
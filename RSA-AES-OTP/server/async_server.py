@@ -0,0 +1,178 @@
+import asyncio
+import collections
+from .client_handler import ClientSession, PHASE_MESSAGES
+from .server import ChatServer
+from common import protocol
+from . import config
+
+
+class AsyncClientConnection(ClientSession, asyncio.BufferedProtocol):
+    """
+    Conexión atendida en el bucle de eventos de AsyncChatServer: el mismo
+    protocolo que ClientHandler, pero sin hilos. Los bytes llegan directamente
+    al búfer del FrameDecoder (BufferedProtocol) y las tramas salen por un
+    TransportWriter. Los pasos del handshake se hacen en el pool del servidor
+    para que los descifrados RSA no paren el bucle, y la E/S de disco del
+    almacén (run_blocking) en el ejecutor del bucle; mientras tanto no se lee,
+    así que los mensajes de la conexión se siguen atendiendo en orden.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.writer = None  # Sigue en None si la conexión no se admite
+        self.step = None  # Paso del handshake o E/S del almacén fuera del bucle, si hay uno
+        self.queued = collections.deque()  # E/S del almacén esperando a que acabe el paso
+        self.decoder = protocol.FrameDecoder(server.recv_buffer_size)
+
+    def connection_made(self, transport):
+        reason = self.server.admit_connection(transport.get_extra_info("peername"))
+        if reason is not None:
+            transport.write(self.server.busy_frame(reason))
+            transport.close()
+            return
+        ClientSession.__init__(self, transport.get_extra_info("peername"), self.server, self.server.rsa_public_pem)
+        self.transport = transport
+        self.writer = protocol.TransportWriter(
+            transport,
+            flush_interval=self.server.flush_interval,
+            on_error=self._on_write_error,
+            backpressure=self.server.backpressure
+        )
+        self.server.add_client(self)
+        self.server.logger(f"Esperando clave pública de {self.addr}...")
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.buffer_updated(nbytes)
+        if self.writer is not None:
+            self._process_frames()
+
+    def _process_frames(self):
+        while self.step is None:
+            try:
+                frame = self.decoder.next_frame()
+                if frame is None:
+                    return
+                if self.phase == PHASE_MESSAGES:
+                    self.process_frame(frame)
+                    continue
+            except ValueError as e:
+                # Trama demasiado grande o mal formada: se corta sin leer más
+                self.server.logger(f"[TRAMA NO VÁLIDA] {self.addr}: {e}")
+                self.transport.abort()
+                return
+            # La trama se copia: el decodificador puede mover su búfer mientras
+            # tanto. Se deja de leer hasta que el paso termine.
+            self.transport.pause_reading()
+            self.step = self.server.handshake_pool.submit(self.process_frame, bytes(frame))
+            self.step.add_done_callback(
+                lambda step: self.server.loop.call_soon_threadsafe(self._handshake_step_done, step)
+            )
+
+    def _handshake_step_done(self, step):
+        self.step = None
+        error = step.exception()
+        if error is not None:
+            # El paso falló (p. ej. trama mal formada): se corta como en
+            # _process_frames, y connection_lost libera el hueco del handshake
+            self.server.logger(f"[TRAMA NO VÁLIDA] {self.addr}: {error}")
+            self.transport.abort()
+        elif not step.result() and not self.transport.is_closing():
+            # Handshake fallido: sale lo que quede (p. ej. auth_fail) y se cierra
+            self.writer.close()
+            self.transport.close()
+        if self._run_queued() or self.transport.is_closing():
+            return
+        self.transport.resume_reading()
+        self._process_frames()
+
+    def run_blocking(self, function, *args):
+        if self.step is not None:
+            # Solo pasa al cerrarse la conexión (con un paso en marcha no se
+            # leen mensajes): va detrás del que está en marcha, desde el bucle
+            self.queued.append((function, args))
+            return
+        # Las vistas del mensaje (p. ej. los datos de un trozo) apuntan al búfer
+        # del decodificador, que no se toca hasta que se vuelve a leer
+        self.step = self.server.loop.run_in_executor(None, function, *args)
+        self.step.add_done_callback(self._blocking_step_done)
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def _blocking_step_done(self, step):
+        self.step = None
+        if step.exception() is not None:
+            self.server.logger(f"[ALMACÉN] Error con {self.nickname}: {step.exception()}")
+        if self._run_queued() or self.transport.is_closing():
+            return
+        self.transport.resume_reading()
+        self._process_frames()
+
+    def _run_queued(self):
+        if not self.queued:
+            return False
+        function, args = self.queued.popleft()
+        self.run_blocking(function, *args)
+        return True
+
+    def pause_writing(self):
+        self.writer.pause_writing()
+
+    def resume_writing(self):
+        self.writer.resume_writing()
+
+    def connection_lost(self, exc):
+        if self.writer is None:
+            return
+        if exc is not None:
+            self.server.logger(f"[CONEXIÓN PERDIDA] {self.nickname} se desconectó.")
+        self.writer.connection_lost()
+        self.cleanup()
+
+    def _shutdown_connection(self):
+        self.transport.abort()
+
+    def _close_connection(self):
+        self.transport.close()
+
+
+class AsyncChatServer(ChatServer):
+    """
+    ChatServer con todas las conexiones en un bucle de eventos asyncio, en vez
+    de dos hilos (lectura y escritura) por cliente. Con miles de conexiones
+    ociosas la memoria se queda en el búfer pequeño de cada una. El registro de
+    clientes, las difusiones y las transferencias son los de ChatServer.
+    """
+
+    def __init__(self, host, port, recv_buffer_size=config.ASYNC_RECV_BUFFER, backlog=config.LISTEN_BACKLOG, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.recv_buffer_size = recv_buffer_size
+        self.backlog = backlog
+        self.loop = None
+
+    def start(self):
+        asyncio.run(self._serve())
+
+    def _reap_tick(self):
+        # En el bucle, porque cerrar un transporte solo se puede hacer desde aquí
+        self.reap_idle()
+        self.loop.call_later(self.timers.tick, self._reap_tick)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        listener = await self.loop.create_server(
+            lambda: AsyncClientConnection(self),
+            self.host,
+            self.port,
+            reuse_address=True,
+            reuse_port=self.reuse_port or None,
+            backlog=self.backlog
+        )
+        self.server_socket = listener.sockets[0]
+        self.logger(f"Servidor escuchando en {self.host}:{self.port} (asyncio)...")
+        self.loop.call_later(self.timers.tick, self._reap_tick)
+        async with listener:
+            await listener.serve_forever()
@@ -0,0 +1,377 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import uuid
+from common import protocol
+from common import security
+
+try:
+    import fcntl
+except ImportError:  # Sin flock (Windows) no hay cerrojo entre procesos: un solo proceso
+    fcntl = None
+
+
+def _valid_id(file_id):
+    # El identificador acaba en una ruta: solo aceptamos un SHA-256 en hexadecimal
+    return isinstance(file_id, str) and len(file_id) == 64 and all(c in "0123456789abcdef" for c in file_id)
+
+
+def _lock_file(path):
+    """
+    Abre path y toma su cerrojo exclusivo sin esperar. Devuelve el archivo
+    abierto (el cerrojo se suelta al cerrarlo) o None si lo tiene otro proceso.
+    """
+    file = open(path, "a+b")
+    if fcntl is not None:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+    return file
+
+
+def _record_span(info, index):
+    """Posición y tamaño en disco del trozo index, ya cifrado (nonce + datos + tag)."""
+    chunk_size = info["chunk_size"]
+    length = min(chunk_size, info["size"] - index * chunk_size)
+    return index * (chunk_size + security.CHUNK_OVERHEAD), length + security.CHUNK_OVERHEAD
+
+
+class BlobUpload:
+    """
+    Subida de un archivo al almacén. Como en el cliente, cada trozo se comprueba
+    contra el manifiesto y se escribe en su sitio de un archivo parcial, así que
+    una subida cortada se reanuda pidiendo solo los trozos que faltan.
+    Los trozos se guardan cifrados con la clave propia del archivo (info["key"]),
+    tal y como se enviarán después a quien lo descargue.
+    Varios clientes pueden estar subiendo el mismo archivo a la vez: lock
+    protege la posición del archivo, have y el cierre.
+    """
+
+    def __init__(self, info, part_path):
+        self.info = info
+        self.file_id = info["file_id"]
+        self.key = bytes.fromhex(info["key"])
+        self.chunks = [bytes.fromhex(digest) for digest in info["chunks"]]
+        self.part_path = part_path
+        self.have = set()
+        self.owners = 0  # transferencias que están subiendo este archivo
+        self.lock_file = None  # cerrojo de BlobStore entre procesos mientras dura la subida
+        self.lock = threading.Lock()
+
+        if os.path.exists(part_path):
+            self.file = open(part_path, "r+b")
+            checks = security.chunk_pool().map_ordered(self._check_record, self._records())
+            self.have.update(index for index, valid in enumerate(checks) if valid)
+        else:
+            self.file = open(part_path, "w+b")
+        self.file.truncate(info["size"] + len(self.chunks) * security.CHUNK_OVERHEAD)
+
+    def _read_record(self, index):
+        offset, count = _record_span(self.info, index)
+        self.file.seek(offset)
+        return self.file.read(count)
+
+    def _records(self):
+        # Los registros se leen en este hilo; el descifrado va al pool de security
+        return ((index, self._read_record(index)) for index in range(len(self.chunks)))
+
+    def _check_record(self, index, sealed):
+        try:
+            data = security.open_chunk(self.key, index, sealed)
+        except ValueError:
+            return False
+        return hashlib.sha256(data).digest() == self.chunks[index]
+
+    def missing(self):
+        with self.lock:
+            return [index for index in range(len(self.chunks)) if index not in self.have]
+
+    def add_chunk(self, index, data, transfer_key=None):
+        """
+        Escribe un trozo en su sitio. data viene cifrado con la clave de la
+        transferencia (transfer_key). Devuelve False si no cuadra con el manifiesto.
+        """
+        if not isinstance(index, int) or not 0 <= index < len(self.chunks):
+            return False
+        if transfer_key is not None:
+            try:
+                data = security.open_chunk(transfer_key, index, data)
+            except ValueError:
+                return False
+        if hashlib.sha256(data).digest() != self.chunks[index]:
+            return False
+        sealed = security.seal_chunk(self.key, index, data)
+        with self.lock:
+            # Si otra transferencia ya completó la subida, el trozo sobra
+            if index not in self.have and not self.file.closed:
+                self.file.seek(_record_span(self.info, index)[0])
+                self.file.write(sealed)
+                self.have.add(index)
+        return True
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def is_complete(self):
+        with self.lock:
+            return len(self.have) == len(self.chunks)
+
+    def verify(self):
+        """Comprueba que el archivo completo tiene el hash anunciado."""
+        file_hash = hashlib.sha256()
+        with self.lock:
+            for data in security.chunk_pool().open_chunks(self.key, self._records()):
+                file_hash.update(data)
+        return file_hash.hexdigest() == self.file_id
+
+
+class BlobStore:
+    """
+    Almacén en disco de los archivos enviados al canal público, con el SHA-256
+    del contenido como nombre. Un archivo que ya está en el almacén no se vuelve
+    a subir, y los clientes lo descargan solo cuando lo piden.
+    Por cada archivo se guarda <file_id> (los trozos cifrados) y <file_id>.json
+    (nombre, tamaño, clave y manifiesto de trozos, para ofrecerlo al descargarlo).
+    En un clúster todos los procesos usan el mismo directorio: mientras uno sube
+    un archivo tiene el cerrojo de <file_id>.lock, y los demás rechazan esa
+    subida en vez de escribir en el mismo parcial o acabar el archivo con otra
+    clave. Un archivo terminado no se vuelve a escribir, así que leerlo no
+    necesita cerrojo.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.uploads = {}  # {file_id: BlobUpload} en curso
+
+    def _path(self, file_id, suffix=""):
+        return os.path.join(self.directory, file_id + suffix)
+
+    def _load_info(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def info(self, file_id):
+        """Metadatos de un archivo del almacén, o None si no está (completo)."""
+        if not _valid_id(file_id) or not os.path.exists(self._path(file_id)):
+            return None
+        info = self._load_info(self._path(file_id, ".json"))
+        # Sin clave es de una versión que guardaba los trozos sin cifrar: se vuelve a subir
+        return info if info and "key" in info else None
+
+    def begin_upload(self, sender, payload):
+        """
+        Empieza (o se suma a) la subida de un archivo ofrecido. Devuelve la
+        BlobUpload, o None si la oferta no es válida o el archivo ya está entero
+        en el almacén.
+        """
+        file_id = payload.get("file_id")
+        size = payload.get("size")
+        chunk_size = payload.get("chunk_size")
+        chunks = payload.get("chunks")
+        if not _valid_id(file_id) or self.info(file_id):
+            return None
+        if not isinstance(size, int) or not isinstance(chunk_size, int) or size < 0 or chunk_size <= 0:
+            return None
+        if not isinstance(chunks, list) or len(chunks) != -(-size // chunk_size):
+            return None
+        info = {
+            "file_id": file_id,
+            "sender": sender,
+            "filename": os.path.basename(str(payload.get("filename"))),
+            "size": size,
+            "chunk_size": chunk_size,
+            "chunks": [protocol.as_bytes(digest).hex() for digest in chunks],
+        }
+        with self.lock:
+            upload = self.uploads.get(file_id)
+            if upload is None:
+                upload = self._start_upload(info)
+                if upload is None:
+                    return None
+                self.uploads[file_id] = upload
+            upload.owners += 1
+        return upload
+
+    def _start_upload(self, info):
+        # None si otro proceso del clúster lo está subiendo o acaba de terminarlo
+        file_id = info["file_id"]
+        lock_file = _lock_file(self._path(file_id, ".lock"))
+        if lock_file is None:
+            return None
+        try:
+            if self.info(file_id):
+                lock_file.close()
+                return None
+            # Un parcial de una subida anterior sirve si describe el mismo archivo
+            previous = self._load_info(self._path(file_id, ".part.json"))
+            if previous and previous["chunks"] == info["chunks"] and previous["size"] == info["size"]:
+                info["key"] = previous["key"]
+            else:
+                info["key"] = security.generate_session_key().hex()
+                if os.path.exists(self._path(file_id, ".part")):
+                    os.remove(self._path(file_id, ".part"))
+                with open(self._path(file_id, ".part.json"), "w", encoding="utf-8") as f:
+                    json.dump(info, f)
+            upload = BlobUpload(info, self._path(file_id, ".part"))
+        except BaseException:
+            lock_file.close()
+            raise
+        upload.lock_file = lock_file
+        return upload
+
+    def end_upload(self, upload):
+        """
+        Lo llama cada transferencia que subía el archivo al terminar o cancelar.
+        Si la subida está completa se comprueba el archivo entero y pasa al
+        almacén. Devuelve los metadatos si el archivo ya está disponible.
+        """
+        with self.lock:
+            upload.owners -= 1
+            finished = upload.is_complete() and self.uploads.get(upload.file_id) is upload
+            if not finished:
+                if upload.owners == 0:
+                    self.uploads.pop(upload.file_id, None)
+                    upload.close()
+                    upload.lock_file.close()
+                return self.info(upload.file_id)
+
+            self.uploads.pop(upload.file_id, None)
+            valid = upload.verify()
+            upload.close()
+            try:
+                if not valid:
+                    os.remove(upload.part_path)
+                    return None
+                os.replace(self._path(upload.file_id, ".part.json"), self._path(upload.file_id, ".json"))
+                os.replace(upload.part_path, self._path(upload.file_id))
+            finally:
+                # El cerrojo se suelta con el archivo ya en su sitio
+                upload.lock_file.close()
+            return upload.info
+
+    def open_blob(self, file_id):
+        return open(self._path(file_id), "rb")
+
+
+class BlobDownload:
+    """
+    Envío de un archivo del almacén a un cliente. Los trozos están en disco ya
+    cifrados con la clave del archivo, que se le manda al cliente en la oferta
+    cifrada con su clave de sesión, así que salen tal cual por el escritor de la
+    conexión sin pasar por Python: con el códec binario como FileRegion
+    (sendfile) y, si el cliente habla JSON, desde un mmap. Solo se encolan
+    window trozos a la vez para que los mensajes del chat no esperen detrás del
+    archivo entero.
+    """
+
+    def __init__(self, client, info, window):
+        self.client = client
+        self.info = info
+        self.transfer_id = uuid.uuid4().hex
+        self.window = window
+        self.file = None
+        self.view = None
+        self.pending = []
+        self.in_flight = 0
+        self.finished = False
+        self.closed = False
+        self.lock = threading.Lock()  # pending, in_flight y el cierre de file y view
+
+    def offer(self):
+        """Anuncia el archivo al cliente, que contestará con file_need."""
+        self.client.send_message(
+            "file_offer",
+            transfer_id=self.transfer_id,
+            file_id=self.info["file_id"],
+            sender=self.info["sender"],
+            recipient="public",
+            filename=self.info["filename"],
+            size=self.info["size"],
+            chunk_size=self.info["chunk_size"],
+            chunks=[bytes.fromhex(digest) for digest in self.info["chunks"]],
+            key=self.client.wrap_key(bytes.fromhex(self.info["key"]))
+        )
+
+    def start(self, file, missing):
+        chunk_count = len(self.info["chunks"])
+        with self.lock:
+            if self.closed:
+                # Se canceló mientras se abría el archivo
+                file.close()
+                return
+            self.file = file
+            if self.client.encoder.codec != protocol.CODEC_BINARY and self.info["size"]:
+                self.view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            self.pending = sorted(i for i in missing if isinstance(i, int) and 0 <= i < chunk_count)
+            self.pending.reverse()
+        self._pump()
+
+    def _pump(self):
+        # Encola trozos hasta llenar la ventana; cada trozo que sale llama otra vez aquí
+        while True:
+            with self.lock:
+                if self.finished or self.closed:
+                    return
+                if not self.pending:
+                    if self.in_flight:
+                        return
+                    self.finished = True
+                    break
+                if self.in_flight >= self.window:
+                    return
+                index = self.pending.pop()
+                self.in_flight += 1
+                # Con el candado: close() no puede soltar file ni view a medias
+                frame = self._chunk_frame(index)
+            if not self.client.send(frame, self._on_chunk_sent):
+                self.cancel()
+                return
+        self.client.send_message("file_complete", transfer_id=self.transfer_id)
+        self.close()
+
+    def _on_chunk_sent(self):
+        with self.lock:
+            self.in_flight -= 1
+        self._pump()
+
+    def _chunk_frame(self, index):
+        offset, count = _record_span(self.info, index)
+        if self.view is None:
+            head = protocol.binary_frame_head("file_chunk", count, transfer_id=self.transfer_id, index=index)
+            return protocol.FileRegion(head, self.file, offset, count)
+        return self.client.encoder.encode(
+            "file_chunk", transfer_id=self.transfer_id, index=index, data=self.view[offset:offset + count]
+        )
+
+    def cancel(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.close()
+
+    def close(self):
+        self.client.downloads.pop(self.transfer_id, None)
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.finished = True
+            if self.view is not None:
+                mapping = self.view.obj
+                self.view.release()
+                mapping.close()
+                self.view = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -1,14 +1,29 @@
+import socket
 import threading
+import time
 from common import protocol
 from common import security  
-import base64 
 import random
 
-class ClientHandler(threading.Thread):
+# Fases de una conexión: las tres del handshake y el bucle de mensajes
+PHASE_RSA = 1
+PHASE_OTP = 2
+PHASE_AES = 3
+PHASE_MESSAGES = 4
+
+
+class ClientSession:
+    """
+    Lado servidor de una conexión, sin E/S: las fases del protocolo (RSA, OTP,
+    clave AES y bucle de mensajes) y la limpieza al desconectar. Cada backend
+    del servidor le pasa las tramas que lee con process_frame() y pone
+    self.writer (un SocketWriter o un TransportWriter) y los métodos
+    _shutdown_connection / _close_connection.
+    """
+
     # MODIFICADO: El constructor ahora recibe las claves del servidor
-    def __init__(self, connection, address, server, rsa_public_pem):
-        super().__init__(daemon=True)
-        self.conn = connection
+    def __init__(self, address, server, rsa_public_pem):
+        self.writer = None
         self.addr = address
         self.server = server
         self.nickname = f"user_{address[1]}"
@@ -16,123 +31,220 @@ class ClientHandler(threading.Thread):
         # Atributos de seguridad
         self.server_rsa_public_pem = rsa_public_pem
         self.client_rsa_public_pem = None # Para guardar la clave del cliente
+        self.key_fingerprint = None  # Huella de esa clave: los privados de extremo a extremo dicen a cuál van
         self.session_key = None 
+        self.cipher = None  # SessionCipher de esa clave, preparado una vez al recibirla
 
+        # Transferencias por trozos que está enviando este cliente: {transfer_id: destinatario}
+        self.transfers = {}
+        # Subidas al almacén de archivos públicos: {transfer_id: {file_id, upload, filename, key}}
+        self.uploads = {}
+        # Archivos del almacén que se le están enviando: {transfer_id: BlobDownload}
+        self.downloads = {}
 
-    def run(self):
+        # Codificador con el códec negociado en la Fase 1. Hasta entonces se habla JSON.
+        self.encoder = protocol.get_encoder()
+        self.phase = PHASE_RSA
+        self.otp_code = None
+        # Cuenta en los handshakes en curso del servidor hasta llegar a la Fase 4
+        self.handshaking = True
+        # Funciones opcionales negociadas en la Fase 1 (p. ej. heartbeat)
+        self.features = []
+        # Época de la clave de grupo del canal público que tiene el cliente (None: ninguna)
+        self.group_epoch = None
+
+        # Detección de conexiones muertas: la rueda del servidor llama a check_timeout()
+        self.closed = False
+        self.phase_started = self.last_seen = time.monotonic()
+        self.ping_sent = None
+        server.timers.schedule(self, self.phase_started + server.handshake_timeout)
+
+    def process_frame(self, frame):
+        """
+        Atiende una trama recibida según la fase de la conexión. Devuelve False
+        si el handshake falla y hay que cerrar la conexión.
+        """
+        self.last_seen = time.monotonic()
+        # Solo se descomprime si se negoció la compresión (antes, nunca)
+        compressed = self.encoder.compression is not None
+        if self.phase == PHASE_MESSAGES:
+            # Los campos bytes se quedan como vistas sobre el búfer de lectura:
+            # el mensaje se atiende entero antes de leer la siguiente trama.
+            body = protocol.uncompressed_body(frame, compressed)
+            self.handle_message(protocol.decode_message(body, zero_copy=True), body)
+            return True
         try:
-            # Fase 1: Intercambio de claves RSA
-            if not self.perform_rsa_exchange():
+            message = protocol.decode_message(frame, compressed=compressed)
+        except ValueError:
+            message = None
+        return self.handle_handshake(message)
+
+    def handle_handshake(self, message):
+        # Fase 1: Intercambio de claves RSA
+        if self.phase == PHASE_RSA:
+            if not self.perform_rsa_exchange(message):
                 self.server.logger(f"[ERROR FASE 1] Falló el intercambio de claves con {self.addr}.")
-                return
+                return False
             self.server.logger(f"[FASE 1 COMPLETADA] Intercambio de claves con {self.addr} exitoso.")
+            # Fase 2: el servidor manda el reto OTP y espera la respuesta
+            self.set_phase(PHASE_OTP)
+            return self.send_otp_challenge()
 
-            # Fase 2: Autenticación OTP
-            if not self.perform_otp_authentication():
+        # Fase 2: Autenticación OTP
+        if self.phase == PHASE_OTP:
+            if not self.perform_otp_authentication(message):
                 self.server.logger(f"[ERROR FASE 2] Falló la autenticación OTP con {self.addr}.")
-                return
+                return False
             self.server.logger(f"[FASE 2 COMPLETADA] Autenticación OTP con {self.addr} exitosa.")
+            self.set_phase(PHASE_AES)
+            return True
 
-            # --- NUEVO: Fase 3, Esperar la clave AES ---
-            if not self.receive_aes_key():
-                self.server.logger(f"[ERROR FASE 3] Falló la recepción de la clave AES de {self.addr}.")
-                return
-            self.server.logger(f"[FASE 3 COMPLETADA] Clave AES de {self.addr} recibida y establecida.")
-            
-            # --- NUEVO: Fase 4, Iniciar el bucle de mensajes ---
-            self.server.logger(f"Canal seguro con {self.addr} establecido. Esperando mensajes...")
-            while True:
-                message = protocol.parse_message_from_socket(self.conn)
-                if message is None: break
-                self.handle_message(message)
+        # --- NUEVO: Fase 3, Esperar la clave AES ---
+        if not self.receive_aes_key(message):
+            self.server.logger(f"[ERROR FASE 3] Falló la recepción de la clave AES de {self.addr}.")
+            return False
+        self.server.logger(f"[FASE 3 COMPLETADA] Clave AES de {self.addr} recibida y establecida.")
 
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.server.logger(f"[CONEXIÓN PERDIDA] {self.nickname} se desconectó.")
-        finally:
-            self.cleanup()
+        # --- NUEVO: Fase 4, Iniciar el bucle de mensajes ---
+        self.server.logger(f"Canal seguro con {self.addr} establecido. Esperando mensajes...")
+        self.set_phase(PHASE_MESSAGES)
+        self.server.finish_handshake(self)
+        self.server.group_changed(self)
+        return True
+
+    def phase_timeout(self):
+        """Plazo de la fase del handshake: el OTP lo escribe una persona, los demás pasos no."""
+        return self.server.otp_timeout if self.phase == PHASE_OTP else self.server.handshake_timeout
+
+    def set_phase(self, phase):
+        # Cada fase del handshake tiene su propio plazo, que empieza a contar aquí
+        self.phase = phase
+        self.phase_started = time.monotonic()
+
+    def check_timeout(self, now):
+        """
+        Lo llama el servidor cuando vence el plazo de la conexión. Devuelve
+        cuándo hay que volver a mirarla, o None si ya no hace falta porque está
+        cerrada o se cierra ahora por inactividad. Mandar algo alarga el plazo
+        sin tocar la rueda: aquí solo se vuelve a programar.
+        """
+        if self.closed:
+            return None
+        if self.phase != PHASE_MESSAGES:
+            deadline = self.phase_started + self.phase_timeout()
+            if now < deadline:
+                return deadline
+            return self._reclaim(f"handshake sin completar en la fase {self.phase}")
+        if protocol.FEATURE_HEARTBEAT not in self.features:
+            # Un cliente antiguo no contesta a ping: no se le puede cerrar por estar callado
+            return None
+        if self.ping_sent is not None and self.ping_sent >= self.last_seen:
+            deadline = self.ping_sent + self.server.pong_timeout
+            if now < deadline:
+                return deadline
+            return self._reclaim("no contesta al ping")
+        deadline = self.last_seen + self.server.ping_interval
+        if now < deadline:
+            return deadline
+        self.ping_sent = now
+        self.send_message("ping")
+        return now + self.server.pong_timeout
+
+    def _reclaim(self, reason):
+        # Se cierra la conexión y la lectura termina: la limpieza sigue el camino normal
+        self.server.logger(f"[INACTIVO] {self.nickname} ({self.addr}): {reason}. Se cierra la conexión.")
+        self._shutdown_connection()
+        return None
 
-    def receive_aes_key(self):
+    def receive_aes_key(self, aes_msg):
         try:
-            # 1. Espera el mensaje con la clave AES
-            aes_msg = protocol.parse_message_from_socket(self.conn)
+            # 1. Comprueba el mensaje con la clave AES
             if not aes_msg or aes_msg.get("type") != "aes_key_exchange":
                 return False
 
             # 2. Descifra la clave AES con la CLAVE PRIVADA DEL SERVIDOR
-            encrypted_key = base64.b64decode(aes_msg["payload"]["key"])
+            encrypted_key = protocol.as_bytes(aes_msg["payload"]["key"])
             decrypted_key = security.decrypt_with_rsa(self.server.rsa_private_key, encrypted_key)
             
             # 3. La guarda y confirma al cliente
             self.session_key = decrypted_key
-            ready_msg = protocol.create_message("secure_channel_ready")
-            self.send(ready_msg)
+            self.cipher = security.server_cipher(decrypted_key)
+            self.send_message("secure_channel_ready")
             return True
         except Exception as e:
             self.server.logger(f"Excepción en la recepción de AES: {e}")
             return False
 
     
-    def perform_rsa_exchange(self):
+    def perform_rsa_exchange(self, client_msg):
         try:
-            # 1. El Servidor espera recibir la clave pública del Cliente.
-            self.server.logger(f"Esperando clave pública de {self.addr}...")
-            client_msg = protocol.parse_message_from_socket(self.conn)
+            # 1. El Servidor recibe la clave pública del Cliente.
             if not client_msg or client_msg.get("type") != "client_public_key":
                 self.server.logger("Mensaje de cliente no válido.")
                 return False
             
             self.client_rsa_public_pem = client_msg["payload"]["public_key"].encode('ascii')
+            self.key_fingerprint = security.key_fingerprint(self.client_rsa_public_pem)
             self.server.logger(f"Clave pública de {self.addr} recibida.")
 
-            # 2. El Servidor responde con su propia clave pública.
+            # El cliente anuncia los códecs y compresiones que entiende; uno antiguo no manda nada.
+            codec = protocol.choose_codec(client_msg["payload"].get("codecs"))
+            compression = protocol.choose_compression(client_msg["payload"].get("compression"))
+            self.features = protocol.choose_features(client_msg["payload"].get("features"))
+
+            # 2. El Servidor responde con su propia clave pública (aún en JSON)
+            # e indica el códec que se usará a partir de ahora.
             self.server.logger(f"Enviando clave pública del servidor a {self.addr}...")
-            server_key_msg = protocol.create_message(
+            self.send_message(
                 "server_public_key", 
-                public_key=self.server_rsa_public_pem.decode('ascii')
+                public_key=self.server_rsa_public_pem.decode('ascii'),
+                codec=codec,
+                compression=compression,
+                features=self.features
             )
-            self.send(server_key_msg)
+            self.encoder = protocol.get_encoder(codec, compression)
+            self.server.logger(f"Códec negociado con {self.addr}: {codec} (compresión: {compression}).")
             return True
         except Exception as e:
             self.server.logger(f"Error durante el intercambio de claves RSA con {self.addr}: {e}")
             return False
 
 
-    def perform_otp_authentication(self):
+    def send_otp_challenge(self):
         try:
             # 1. El Servidor genera un código OTP aleatorio (el reto)
-            otp_code = str(random.randint(100000, 999999))
-            self.server.logger(f"Generando reto OTP '{otp_code}' para {self.addr}.")
+            self.otp_code = str(random.randint(100000, 999999))
+            self.server.logger(f"Generando reto OTP '{self.otp_code}' para {self.addr}.")
 
             # 2. Cifra el reto con la CLAVE PÚBLICA DEL CLIENTE
-            encrypted_otp = security.encrypt_with_rsa(self.client_rsa_public_pem, otp_code.encode('utf-8'))
-            
+            encrypted_otp = security.encrypt_with_rsa(self.client_rsa_public_pem, self.otp_code.encode('utf-8'))
+
             # 3. Envía el reto cifrado al cliente
-            challenge_msg = protocol.create_message(
-                "otp_challenge",
-                challenge=base64.b64encode(encrypted_otp).decode('ascii')
-            )
-            self.send(challenge_msg)
+            self.send_message("otp_challenge", challenge=encrypted_otp)
+            return True
+        except Exception as e:
+            self.server.logger(f"Excepción en la autenticación OTP: {e}")
+            return False
 
-            # 4. Espera la respuesta del cliente
-            response_msg = protocol.parse_message_from_socket(self.conn)
+    def perform_otp_authentication(self, response_msg):
+        try:
+            # 4. Comprueba la respuesta del cliente
             if not response_msg or response_msg.get("type") != "otp_response":
                 return False
 
             # 5. Descifra la respuesta con la CLAVE PRIVADA DEL SERVIDOR
-            encrypted_response = base64.b64decode(response_msg["payload"]["response"])
+            encrypted_response = protocol.as_bytes(response_msg["payload"]["response"])
             # Necesitamos la clave privada del servidor, que no pasamos antes. La obtenemos del objeto server.
             decrypted_response = security.decrypt_with_rsa(self.server.rsa_private_key, encrypted_response).decode('utf-8')
             
             # 6. Compara el reto original con la respuesta descifrada
-            if decrypted_response == otp_code:
+            if decrypted_response == self.otp_code:
                 # ¡Éxito! Enviamos la confirmación.
-                success_msg = protocol.create_message("auth_success")
-                self.send(success_msg)
+                self.send_message("auth_success")
                 return True
             else:
                 # ¡Fallo! Enviamos el rechazo.
-                fail_msg = protocol.create_message("auth_fail")
-                self.send(fail_msg)
+                self.send_message("auth_fail")
                 return False
 
         except Exception as e:
@@ -140,7 +252,8 @@ class ClientHandler(threading.Thread):
             return False
         
         
-    def handle_message(self, message):
+    def handle_message(self, message, body=None):
+        # 'body' es el cuerpo original de la trama, para reenviar archivos sin recodificarlos
         msg_type = message.get("type")
         payload = message.get("payload", {})
 
@@ -148,19 +261,33 @@ class ClientHandler(threading.Thread):
             self.nickname = payload.get("nickname", self.nickname)
             self.server.register_client(self, self.nickname)
             self.server.logger(f"'{self.addr}' se identificó como '{self.nickname}'.")
+            self.server.send_presence_snapshot(self)
             self.server.broadcast_user_list()
 
+        elif msg_type == "presence_sync":
+            # Al cliente le falta algún delta de presencia: lista entera
+            self.server.send_presence_snapshot(self)
+
+        elif msg_type == "peer_key_request":
+            nickname = payload.get("nickname")
+            self.send_message("peer_key", nickname=nickname, public_key=self.server.peer_public_key(nickname))
+
+        elif msg_type == "private_message" and payload.get("e2e"):
+            # Cifrado de extremo a extremo: el servidor no tiene la clave, solo lo reenvía
+            self.server.forward_private_message(self, payload, message=message, body=body)
+            self.server.logger(f"[{self.nickname} -> {payload.get('recipient')}] Mensaje privado cifrado de extremo a extremo.")
+
         elif msg_type in ["public_message", "private_message"]:
             # MODIFICADO: Desciframos el mensaje del cliente
             encrypted_content = payload.get("content")
             try:
-                nonce = base64.b64decode(encrypted_content['nonce'])
-                tag = base64.b64decode(encrypted_content['tag'])
-                ciphertext = base64.b64decode(encrypted_content['ciphertext'])
+                nonce = protocol.as_bytes(encrypted_content['nonce'])
+                tag = protocol.as_bytes(encrypted_content['tag'])
+                ciphertext = protocol.as_bytes(encrypted_content['ciphertext'])
                 
-                decrypted_bytes = security.decrypt_with_aes(self.session_key, nonce, tag, ciphertext)
+                decrypted_bytes = self.cipher.decrypt(nonce, tag, ciphertext)
                 content = decrypted_bytes.decode('utf-8')
-            except (ValueError, KeyError):
+            except (ValueError, KeyError, TypeError):
                 self.server.logger(f"Error al descifrar mensaje de {self.nickname}.")
                 return
             
@@ -175,22 +302,177 @@ class ClientHandler(threading.Thread):
                 self.server.logger(f"[{self.nickname} -> {recipient}] Mensaje privado: {content} (CIFRADO: {encrypted_content})")
         
         
+        elif msg_type == "pong":
+            pass  # Respuesta a un ping: basta con que haya llegado (last_seen)
+
         elif msg_type == "file_transfer":
             recipient = payload.get("recipient")
             filename = payload.get("filename")
             self.server.logger(f"[{self.nickname} -> {recipient}] Archivo: {filename}")
-            self.server.relay_file(self.nickname, payload, source_client=self)
+            self.server.relay_file(self.nickname, payload, source_client=self, message=message, body=body)
 
-    def send(self, message_bytes):
-        try:
-            self.conn.sendall(message_bytes)
-        except OSError:
-            self.cleanup()
+        elif msg_type == "file_offer":
+            transfer_id = payload.get("transfer_id")
+            recipient = payload.get("recipient")
+            if not transfer_id or transfer_id in self.transfers or transfer_id in self.uploads:
+                return
+            if recipient == "public" and self.server.blob_store and payload.get("file_id"):
+                self.run_blocking(self.server.begin_blob_upload, self, payload)
+                return
+            recipients = self.server.relay_file_offer(self.nickname, payload, source_client=self, message=message, body=body)
+            if recipients is None:
+                return
+            self.transfers[transfer_id] = recipient
+            self.server.logger(f"[{self.nickname} -> {recipient}] Archivo por trozos: {payload.get('filename')} ({payload.get('size')} bytes)")
+            # Ventana inicial: el cliente puede enviar ya FILE_WINDOW trozos. Le
+            # decimos también cuántos file_need esperar antes de empezar.
+            self.send_message("file_credit", transfer_id=transfer_id, credits=self.server.file_window, recipients=recipients)
+
+        elif msg_type == "file_need":
+            if payload.get("transfer_id") in self.downloads:
+                self.server.start_blob_download(self, payload)
+            else:
+                self.server.relay_file_need(payload, source_client=self)
+
+        elif msg_type == "file_fetch":
+            self.server.serve_blob(self, payload.get("file_id"))
+
+        elif msg_type == "file_resume":
+            self.server.request_file_resume(self.nickname, payload)
+
+        elif msg_type == "file_chunk":
+            transfer_id = payload.get("transfer_id")
+            if transfer_id in self.uploads:
+                self.run_blocking(self.server.store_blob_chunk, self, payload)
+                return
+            recipient = self.transfers.get(transfer_id)
+            if recipient is not None:
+                self.server.relay_file_chunk(recipient, payload, source_client=self, body=body)
+
+        elif msg_type in ["file_complete", "file_cancel"]:
+            transfer_id = payload.get("transfer_id")
+            if transfer_id in self.uploads:
+                self.run_blocking(self.server.end_blob_upload, self, transfer_id, msg_type == "file_complete")
+                return
+            recipient = self.transfers.pop(transfer_id, None)
+            if recipient is not None:
+                self.server.relay_file_end(msg_type, recipient, transfer_id, source_client=self)
+
+    def wrap_key(self, key):
+        """Cifra la clave de una transferencia con la clave de sesión de este cliente."""
+        return protocol.encrypted_payload(*self.cipher.encrypt(key))
+
+    def unwrap_key(self, wrapped):
+        return self.cipher.decrypt(
+            protocol.as_bytes(wrapped["nonce"]),
+            protocol.as_bytes(wrapped["tag"]),
+            protocol.as_bytes(wrapped["ciphertext"])
+        )
+
+    def send_message(self, msg_type, **payload):
+        """Codifica un mensaje con el códec negociado para este cliente y lo envía."""
+        self.send(self.encoder.encode(msg_type, **payload), kind=msg_type)
+
+    def send(self, message_bytes, on_sent=None, kind=None):
+        # Solo encola: el escritor de la conexión agrupa y envía las tramas.
+        # Devuelve False si la trama no se encola (conexión cerrada o
+        # descartada por la política de la cola). kind es el tipo de mensaje.
+        return self.writer.send(message_bytes, on_sent, kind)
+
+    def _on_write_error(self, error):
+        # Lo llama el escritor. Cerramos la conexión para que la lectura
+        # termine y la limpieza siga el camino normal.
+        self.server.logger(f"[ERROR DE ENVÍO] {self.nickname}: {error}")
+        self._shutdown_connection()
+
+    def _shutdown_connection(self):
+        raise NotImplementedError
+
+    def run_blocking(self, function, *args):
+        """
+        Ejecuta E/S de disco del almacén (guardar un trozo, comprobar un archivo
+        entero). ClientHandler ya está en el hilo lector de su conexión, así que
+        la hace aquí mismo; el backend asyncio la saca del bucle de eventos.
+        """
+        function(*args)
+
+    def _close_connection(self):
+        raise NotImplementedError
 
     def cleanup(self):
+        self.closed = True
+        self.server.finish_handshake(self)
+        # La clave de grupo se retira antes de salir del registro: mientras
+        # tanto ningún público nuevo va cifrado con una clave que tiene quien se va
+        self.server.group_changed(self, departed=True)
         self.server.remove_client(self)
+        # Los destinatarios de lo que estaba enviando se quedan con el parcial para reanudarlo
+        for transfer_id, recipient in list(self.transfers.items()):
+            self.server.relay_file_end("file_cancel", recipient, transfer_id, source_client=self)
+        self.transfers.clear()
+        for transfer_id in list(self.uploads):
+            self.run_blocking(self.server.end_blob_upload, self, transfer_id, False)
+        self.writer.close()
+        # Después de cerrar el escritor, que aún podía tener trozos suyos en cola
+        for download in list(self.downloads.values()):
+            download.cancel()
+        self._close_connection()
+        stats = self.writer.stats()
+        self.server.logger(
+            f"[ENVÍOS] {self.nickname}: {stats['frames']} tramas en {stats['flushes']} envíos "
+            f"({stats['frames_per_flush']:.1f} por envío, máximo {stats['max_frames_per_flush']})."
+        )
+        if stats["policy_events"]:
+            self.server.logger(f"[COLA] {self.nickname}: {stats['policy_events']}")
+        self.server.retire_writer_stats(self.writer)
+        self.server.logger(f"[DESCONEXIÓN] {self.nickname} se ha desconectado.")
+        self.server.broadcast_user_list()
+
+
+class ClientHandler(ClientSession, threading.Thread):
+    """Conexión atendida por un hilo propio con sockets bloqueantes."""
+
+    def __init__(self, connection, address, server, rsa_public_pem):
+        threading.Thread.__init__(self, daemon=True)
+        ClientSession.__init__(self, address, server, rsa_public_pem)
+        self.conn = connection
+        self.reader = protocol.SocketReader(connection)
+        self.writer = protocol.SocketWriter(
+            connection,
+            flush_interval=server.flush_interval,
+            on_error=self._on_write_error,
+            backpressure=server.backpressure
+        )
+
+    def run(self):
+        try:
+            self.server.logger(f"Esperando clave pública de {self.addr}...")
+            while True:
+                frame = self.reader.read_frame()
+                if frame is None:
+                    break
+                if self.phase == PHASE_MESSAGES:
+                    handled = self.process_frame(frame)
+                else:
+                    # Los pasos del handshake van al pool acotado del servidor;
+                    # este hilo espera, así que la trama sigue siendo válida
+                    handled = self.server.handshake_pool.submit(self.process_frame, frame).result()
+                if not handled:
+                    break
+        except (ConnectionResetError, ConnectionAbortedError):
+            self.server.logger(f"[CONEXIÓN PERDIDA] {self.nickname} se desconectó.")
+        except ValueError as e:
+            # Trama demasiado grande o mal formada: se corta la conexión
+            self.server.logger(f"[TRAMA NO VÁLIDA] {self.addr}: {e}")
+        finally:
+            self.cleanup()
+
+    def _shutdown_connection(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    def _close_connection(self):
         try:
             self.conn.close()
         except Exception: pass
-        self.server.logger(f"[DESCONEXIÓN] {self.nickname} se ha desconectado.")
-        self.server.broadcast_user_list()
@@ -0,0 +1,255 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+from common import protocol
+from . import config
+
+# Entre procesos se habla el códec binario sin comprimir: todo va por un socket Unix local
+_ENCODER = protocol.get_encoder(protocol.CODEC_BINARY)
+
+
+class Broker:
+    """
+    Centralita local del modo multiproceso. Cada proceso trabajador se conecta
+    por un socket Unix y se presenta con hello; lo que publica uno se reenvía
+    tal cual a los demás, o solo al trabajador indicado en "to". Cuando un
+    trabajador se va, el broker avisa al resto con worker_gone.
+    Por aquí pasan los mensajes en claro (el servidor los descifra para volver
+    a cifrarlos a cada destinatario), así que el socket solo lo puede abrir el
+    usuario que arranca el servidor.
+    """
+
+    def __init__(self, path, logger=print):
+        self.path = path
+        self.logger = logger
+        self.workers = {}  # {worker_id: StreamWriter}
+
+    def start(self):
+        asyncio.run(self._serve())
+
+    def start_in_thread(self):
+        threading.Thread(target=self.start, daemon=True).start()
+
+    async def _serve(self):
+        # El socket se crea en un directorio privado (0700) y solo se mueve a
+        # self.path con los permisos ya quitados: ningún otro usuario llega a
+        # verlo abierto, ni siquiera entre el bind y el chmod
+        private_dir = tempfile.mkdtemp(prefix=".broker-", dir=os.path.dirname(self.path) or ".")
+        private_path = os.path.join(private_dir, "broker.sock")
+        try:
+            server = await asyncio.start_unix_server(self._handle_worker, private_path)
+            os.chmod(private_path, 0o600)
+            os.replace(private_path, self.path)
+        finally:
+            if os.path.exists(private_path):
+                os.remove(private_path)
+            os.rmdir(private_dir)
+        self.logger(f"[CLÚSTER] Broker escuchando en {self.path}.")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            while True:
+                head = await reader.readexactly(4)
+                msg_len = int.from_bytes(head, "big")
+                protocol.check_frame_size(msg_len)
+                body = await reader.readexactly(msg_len)
+                message = protocol.decode_message(body)
+                if message["type"] == "hello":
+                    worker_id = message["payload"]["worker"]
+                    self.workers[worker_id] = writer
+                    self.logger(f"[CLÚSTER] Trabajador {worker_id} conectado.")
+                await self._forward(worker_id, message["payload"].get("to"), head + body)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.logger(f"[CLÚSTER] Trabajador {worker_id} desconectado.")
+                await self._forward(worker_id, None, _ENCODER.encode("worker_gone", worker=worker_id))
+
+    async def _forward(self, source_id, target_id, frame):
+        for worker_id, writer in list(self.workers.items()):
+            if worker_id != source_id and target_id in (None, worker_id):
+                writer.write(frame)
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+
+class ClusterLink:
+    """
+    Conexión de un proceso trabajador con el Broker. ChatServer la usa cuando
+    server.cluster no es None: los mensajes públicos y los cambios de la lista
+    de usuarios se publican a todos los procesos, y un privado a un nick que no
+    está en este proceso va solo al proceso que lo tiene.
+    Las transferencias de archivos entre clientes de procesos distintos no
+    pasan por aquí; los archivos públicos del almacén sí llegan a todos, con
+    su file_ref: el directorio del almacén es el mismo para todos los procesos,
+    y BlobStore deja que solo uno a la vez suba cada archivo (un cerrojo de
+    archivo), así que los demás leen archivos ya terminados.
+    """
+
+    def __init__(self, server, worker_id, path):
+        self.server = server
+        self.worker_id = worker_id
+        self.path = path
+        self.writer = None
+        self.remote = {}  # {worker_id: [nicks]} de los clientes de los demás procesos
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=10.0):
+        """Se conecta al broker (esperando a que arranque) y empieza a escucharlo."""
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.writer = protocol.SocketWriter(sock, flush_interval=self.server.flush_interval, on_error=self._on_error)
+        self._publish("hello", worker=self.worker_id)
+        threading.Thread(target=self._listen, args=(sock,), daemon=True).start()
+
+    def _publish(self, msg_type, **payload):
+        self.writer.send(_ENCODER.encode(msg_type, **payload))
+
+    def _on_error(self, error):
+        self.server.logger(f"[CLÚSTER] Error al escribir al broker: {error}")
+
+    def publish_public_message(self, sender_nick, content_text):
+        self._publish("public_message", sender=sender_nick, content=content_text)
+
+    def publish_users(self, user_list):
+        self._publish("users", worker=self.worker_id, users=user_list)
+
+    def publish_broadcast(self, msg_type, payload):
+        self._publish("broadcast", msg_type=msg_type, payload=payload)
+
+    def send_private_message(self, recipient_nick, sender_nick, content_text):
+        """Manda un privado al proceso que tiene a recipient_nick. Devuelve False si no lo tiene nadie."""
+        with self.lock:
+            target = next((worker for worker, users in self.remote.items() if recipient_nick in users), None)
+        if target is None:
+            return False
+        self._publish("private_message", to=target, recipient=recipient_nick, sender=sender_nick, content=content_text)
+        return True
+
+    def remote_users(self):
+        with self.lock:
+            return [nick for users in self.remote.values() for nick in users]
+
+    def _listen(self, sock):
+        reader = protocol.SocketReader(sock)
+        while True:
+            try:
+                message = reader.read_message()
+            except (OSError, ValueError):
+                message = None
+            if message is None:
+                self.server.logger("[CLÚSTER] Se perdió la conexión con el broker.")
+                self.writer.close()
+                return
+            self._dispatch(message["type"], message["payload"])
+
+    def _dispatch(self, msg_type, payload):
+        if msg_type == "hello":
+            # Un trabajador nuevo: le contamos quién está conectado aquí
+            self._publish("users", to=payload["worker"], worker=self.worker_id, users=list(self.server.registry.nicknames))
+
+        elif msg_type == "users":
+            with self.lock:
+                self.remote[payload["worker"]] = set(payload["users"])
+            self.server.presence_changed()
+
+        elif msg_type == "worker_gone":
+            with self.lock:
+                self.remote.pop(payload["worker"], None)
+            self.server.presence_changed()
+
+        elif msg_type == "public_message":
+            self.server.deliver_public_message(payload["sender"], payload["content"])
+
+        elif msg_type == "private_message":
+            self.server.deliver_private_message(payload["recipient"], payload["sender"], payload["content"])
+
+        elif msg_type == "broadcast":
+            self.server.broadcast(payload["msg_type"], **payload["payload"])
+
+
+def run_worker(server_class, worker_id, host, port, path, log_queue, server_kwargs):
+    """Proceso trabajador: un servidor normal que comparte el puerto y habla con el broker."""
+    def logger(text):
+        log_queue.put(f"[T{worker_id}] {text}")
+
+    server = server_class(host, port, logger=logger, reuse_port=True, **server_kwargs)
+    server.cluster = ClusterLink(server, worker_id, path)
+    server.cluster.connect()
+    server.start()
+
+
+class Cluster:
+    """
+    Modo multiproceso: workers procesos, cada uno con su propio servidor
+    (server_class, de cualquier backend), aceptan conexiones en el mismo
+    puerto con SO_REUSEPORT y el núcleo reparte las conexiones entre ellos.
+    Así el cifrado y la codificación de cada proceso van en su propio núcleo.
+    El broker corre en este proceso y los registros de los trabajadores llegan
+    a logger por una cola.
+    """
+
+    def __init__(self, server_class, host, port, workers, path=config.BROKER_SOCKET, logger=print, **server_kwargs):
+        self.server_class = server_class
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.path = os.path.abspath(path)
+        self.logger = logger
+        self.server_kwargs = server_kwargs
+        self.broker = Broker(self.path, logger)
+        self.processes = []
+
+    def start(self):
+        self.start_in_thread()
+        for process in self.processes:
+            process.join()
+
+    def start_in_thread(self):
+        # spawn y no fork: este proceso ya tiene hilos (el broker, la GUI)
+        context = multiprocessing.get_context("spawn")
+        log_queue = context.Queue()
+        self.broker.start_in_thread()
+        self.processes = [
+            context.Process(
+                target=run_worker,
+                args=(self.server_class, worker_id, self.host, self.port, self.path, log_queue, self.server_kwargs),
+                daemon=True
+            )
+            for worker_id in range(self.workers)
+        ]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self._relay_logs, args=(log_queue,), daemon=True).start()
+        self.logger(f"[CLÚSTER] {self.workers} procesos trabajadores en {self.host}:{self.port}.")
+
+    def _relay_logs(self, log_queue):
+        while True:
+            self.logger(log_queue.get())
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
@@ -1,3 +1,93 @@
+import os
+
 HOST = "127.0.0.1"
 PORT = 5000
-MAX_CLIENTS = 10
+# Conexiones abiertas a la vez como máximo, contando las que aún están en el
+# handshake. A las que pasan del límite se les manda "server_busy" y se cierran.
+MAX_CLIENTS = 1000
+
+# Control de admisión de los handshakes (RSA, OTP y clave AES). Los descifrados
+# RSA son caros: tras reiniciar el servidor, una avalancha de reconexiones
+# dejaría sin CPU a los chats ya establecidos. Como mucho MAX_HANDSHAKES
+# conexiones pueden estar en el handshake a la vez (el resto recibe
+# "server_busy"), y sus pasos se hacen en un pool de HANDSHAKE_WORKERS hilos.
+MAX_HANDSHAKES = 64
+HANDSHAKE_WORKERS = min(4, os.cpu_count() or 1)
+# Segundos que se le sugiere esperar a un cliente rechazado antes de reintentar
+BUSY_RETRY_AFTER = 5
+
+# Conexiones muertas (un portátil que se cerró, un NAT que olvidó la conexión):
+# cada fase del handshake tiene HANDSHAKE_TIMEOUT segundos para completarse,
+# salvo la del OTP, que tiene OTP_TIMEOUT: ahí espera a una persona que lee el
+# código en una ventana y lo escribe. En el bucle de mensajes, a un cliente que lleva PING_INTERVAL s sin mandar nada
+# se le manda un ping, y si no contesta en PONG_TIMEOUT s se cierra su
+# conexión. Los plazos se vigilan con una rueda de ticks de TIMER_TICK s.
+HANDSHAKE_TIMEOUT = 10.0
+OTP_TIMEOUT = 120.0
+PING_INTERVAL = 30.0
+PONG_TIMEOUT = 10.0
+TIMER_TICK = 0.5
+
+# Los cambios de la lista de usuarios de este intervalo (s) salen juntos en un
+# solo presence_join / presence_leave
+PRESENCE_WINDOW = 0.05
+
+# La clave de grupo del canal público se cambia cuando entra o sale alguien.
+# Las entradas y salidas de este intervalo (s) acaban en una sola clave nueva;
+# mientras tanto los públicos van cifrados para cada destinatario, como antes.
+GROUP_KEY_WINDOW = 0.05
+
+# Los públicos que hay que cifrar para cada destinatario (clientes sin la clave
+# de grupo) se reparten en tandas de al menos FANOUT_BATCH clientes entre el
+# hilo del que envía y un pool de FANOUT_WORKERS - 1 hilos. Con uno solo no hay pool.
+FANOUT_WORKERS = min(4, os.cpu_count() or 1)
+FANOUT_BATCH = 64
+
+# Presupuesto de latencia (segundos) para agrupar tramas salientes en un solo envío
+FLUSH_INTERVAL = 0.002
+
+# Cola de salida de cada cliente. Si un cliente lee más despacio de lo que le
+# llega, su cola crece; al pasar de la marca alta se aplica la política:
+#   "block": quien envía espera (como mucho BLOCK_TIMEOUT s) a que baje de la marca baja
+#   "drop_oldest": se descartan los mensajes prescindibles más antiguos hasta la marca baja
+#   "coalesce": de los mensajes acumulables solo se deja en cola el último
+#   "disconnect": se desconecta al cliente
+# Con cualquier política, un cliente cuya cola llega al tope se desconecta:
+# así no retrasa ni llena la memoria del resto del servidor.
+BACKPRESSURE_POLICY = "coalesce"
+QUEUE_HIGH_WATER = 1024 * 1024
+QUEUE_LOW_WATER = 256 * 1024
+OUTBOUND_QUEUE_BYTES = 8 * 1024 * 1024
+BLOCK_TIMEOUT = 5.0
+# Mensajes que "drop_oldest" puede descartar (el resto, como los de archivos, no).
+# Si se pierde un delta de presencia, el cliente ve el salto de versión y pide la lista entera.
+DROPPABLE_MESSAGES = ("public_message", "user_list_update", "presence_join", "presence_leave", "file_ref")
+# Mensajes en los que el último deja obsoletos a los anteriores
+COALESCED_MESSAGES = ("user_list_update",)
+
+# Ventana de control de flujo de las transferencias por trozos: cuántos trozos
+# de un mismo archivo pueden estar en el servidor pendientes de salir
+FILE_WINDOW = 8
+
+# Carpeta del almacén de archivos públicos (por hash de contenido). None lo
+# desactiva y los archivos públicos se reenvían a todos como antes.
+BLOB_DIR = "blobs"
+
+# Backend del servidor: "threads" (un hilo por conexión) o "asyncio" (todas las
+# conexiones en un bucle de eventos). Se puede cambiar al arrancar:
+#   python run_server.py asyncio
+BACKEND = "threads"
+
+# Con asyncio: búfer de recepción inicial de cada conexión (pequeño, para que
+# miles de conexiones ociosas ocupen poco; crece solo mientras llega una trama
+# grande) y cola de conexiones pendientes de aceptar.
+ASYNC_RECV_BUFFER = 4 * 1024
+LISTEN_BACKLOG = 1024
+
+# Modo multiproceso: con WORKERS > 1 arrancan otros tantos procesos, cada uno
+# con un servidor del backend elegido, aceptando en el mismo puerto
+# (SO_REUSEPORT). Se pasan los mensajes por un broker local en este socket Unix.
+#   python run_server.py asyncio 4
+# MAX_CLIENTS y MAX_HANDSHAKES son por proceso.
+WORKERS = 1
+BROKER_SOCKET = "chat-broker.sock"
@@ -1,34 +1,118 @@
+import collections
 import socket
 import threading
-from .client_handler import ClientHandler
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from .client_handler import ClientHandler, PHASE_MESSAGES
+from .blob_store import BlobStore, BlobDownload
+from .timers import TimerWheel
 from common import protocol
 from common import security  
-import base64 
+from . import config
+
+
+# Foto del registro de clientes: una tupla de conexiones y un diccionario de
+# solo lectura {nickname: cliente}. Nunca se modifica; al entrar, salir o
+# cambiar de nick un cliente se publica una foto nueva.
+Registry = collections.namedtuple("Registry", ["clients", "nicknames"])
+
+# Clave de grupo del canal público, su número de época y su SessionCipher. Como
+# el registro, se cambia entera por otra y quien reparte mensajes la lee sin candado.
+GroupKey = collections.namedtuple("GroupKey", ["epoch", "key", "cipher"])
+
 
 class ChatServer:
-    def __init__(self, host, port, logger=print):
+    def __init__(self, host, port, logger=print, flush_interval=config.FLUSH_INTERVAL, file_window=config.FILE_WINDOW,
+                 blob_dir=config.BLOB_DIR, backpressure=None, max_clients=config.MAX_CLIENTS,
+                 max_handshakes=config.MAX_HANDSHAKES, handshake_workers=config.HANDSHAKE_WORKERS, reuse_port=False,
+                 handshake_timeout=config.HANDSHAKE_TIMEOUT, otp_timeout=config.OTP_TIMEOUT, ping_interval=config.PING_INTERVAL,
+                 pong_timeout=config.PONG_TIMEOUT, presence_window=config.PRESENCE_WINDOW,
+                 group_key_window=config.GROUP_KEY_WINDOW, fanout_workers=config.FANOUT_WORKERS):
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port  # Varios procesos aceptando en el mismo puerto (modo multiproceso)
         self.server_socket = None
-        self.clients = []
-        self.nicknames = {}  # {nickname: client_handler_instance}
+        # ClusterLink con los demás procesos en el modo multiproceso; None si el servidor va solo
+        self.cluster = None
+        # Quien reparte mensajes coge self.registry sin candado; el candado solo
+        # ordena a los que publican fotos nuevas (y protege transfers)
+        self.registry = Registry((), types.MappingProxyType({}))
+        self.transfers = {}  # {transfer_id: (emisor, destinatarios)}, para devolverle los file_need
         self.lock = threading.Lock()
         self.logger = logger
+        self.flush_interval = flush_interval
+        # Política de las colas de salida con clientes lentos (compartida por todas las conexiones)
+        self.backpressure = backpressure or protocol.Backpressure(
+            config.BACKPRESSURE_POLICY,
+            high_water=config.QUEUE_HIGH_WATER,
+            low_water=config.QUEUE_LOW_WATER,
+            max_bytes=config.OUTBOUND_QUEUE_BYTES,
+            droppable=config.DROPPABLE_MESSAGES,
+            coalesced=config.COALESCED_MESSAGES,
+            block_timeout=config.BLOCK_TIMEOUT
+        )
+        # Eventos de la política de clientes ya desconectados (los de los conectados están en su escritor)
+        self.retired_policy_events = collections.Counter()
+        self.file_window = file_window
+        # Control de admisión: conexiones abiertas y handshakes en curso (con self.lock)
+        self.max_clients = max_clients
+        self.max_handshakes = max_handshakes
+        self.handshakes = 0
+        self.rejected_connections = collections.Counter()  # {motivo: conexiones rechazadas}
+        # Los pasos del handshake (descifrados RSA) se hacen aquí. Cada handshake
+        # tiene como mucho un paso pendiente, así que la cola no pasa de max_handshakes.
+        self.handshake_pool = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix="handshake")
+        # Plazos de cada conexión (handshake, ping y pong) en una sola rueda; el backend la mueve cada tick
+        self.handshake_timeout = handshake_timeout
+        self.otp_timeout = otp_timeout
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.timers = TimerWheel(config.TIMER_TICK)
+        # Lista de usuarios publicada (con su versión) y cambios pendientes de enviar
+        self.presence_window = presence_window
+        self.presence_lock = threading.Lock()
+        self.presence_users = frozenset()
+        self.presence_version = 0
+        self.presence_pending = False
+        # Clave de grupo del canal público (None mientras no haya una válida) y
+        # la rotación pendiente; group_lock ordena las rotaciones
+        self.group_key_window = group_key_window
+        self.group_lock = threading.Lock()
+        self.group_key = None
+        self.group_epoch = 0
+        self.group_pending = False
+        # Cifrado de los públicos para cada destinatario en paralelo; el hilo que
+        # envía hace una tanda y espera a las demás, así que la cola no pasa de
+        # fanout_workers - 1 tandas por cada mensaje que se está repartiendo
+        self.fanout_workers = max(1, fanout_workers)
+        self.fanout_pool = None
+        if self.fanout_workers > 1:
+            self.fanout_pool = ThreadPoolExecutor(max_workers=self.fanout_workers - 1, thread_name_prefix="fanout")
+        self.blob_store = BlobStore(blob_dir) if blob_dir else None
         
         # NUEVO: Generar par de claves RSA para el servidor al iniciar
         self.logger("Generando par de claves RSA para el servidor...")
         self.rsa_private_key = security.generate_rsa_keys()
         self.rsa_public_pem = security.get_public_key_pem(self.rsa_private_key)
         self.logger("Claves RSA generadas correctamente.")
+        self.logger(f"Backend JSON del protocolo: {protocol.JSON_BACKEND}.")
 
     def start(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         self.logger(f"Servidor escuchando en {self.host}:{self.port}...")
+        threading.Thread(target=self._reap_forever, daemon=True).start()
         while True:
             conn, addr = self.server_socket.accept()
+            reason = self.admit_connection(addr)
+            if reason is not None:
+                self.reject_connection(conn, reason)
+                continue
             # MODIFICADO: Ya no pasamos la clave privada, solo la pública.
             client_handler = ClientHandler(conn, addr, self, self.rsa_public_pem)
             self.add_client(client_handler)
@@ -38,110 +122,601 @@ class ChatServer:
         server_thread = threading.Thread(target=self.start, daemon=True)
         server_thread.start()
 
+    @property
+    def clients(self):
+        return self.registry.clients
+
+    @property
+    def nicknames(self):
+        return self.registry.nicknames
+
+    def reap_idle(self):
+        """Revisa las conexiones cuyo plazo ha vencido; el backend lo llama en cada tick de self.timers."""
+        now = time.monotonic()
+        for client in self.timers.expired(now):
+            deadline = client.check_timeout(now)
+            if deadline is not None:
+                self.timers.schedule(client, deadline)
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.timers.tick)
+            self.reap_idle()
+
+    def admit_connection(self, address):
+        """
+        Decide si se atiende una conexión nueva. Devuelve None si se acepta (y
+        pasa a contar como handshake en curso) o el motivo del rechazo.
+        """
+        with self.lock:
+            if len(self.registry.clients) >= self.max_clients:
+                reason = "full"
+            elif self.handshakes >= self.max_handshakes:
+                reason = "busy"
+            else:
+                self.handshakes += 1
+                return None
+            self.rejected_connections[reason] += 1
+        self.logger(f"[OCUPADO] Rechazada la conexión de {address} ({reason}).")
+        return reason
+
+    def busy_frame(self, reason):
+        # Aún no hay códec negociado: el rechazo va en JSON, que entiende cualquier cliente
+        return protocol.get_encoder().encode("server_busy", reason=reason, retry_after=config.BUSY_RETRY_AFTER)
+
+    def reject_connection(self, conn, reason):
+        """Manda server_busy a una conexión no admitida y la cierra, sin crearle hilo."""
+        try:
+            conn.settimeout(1.0)
+            conn.sendall(self.busy_frame(reason))
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
+
+    def finish_handshake(self, client):
+        """El cliente terminó el handshake (o se fue a medias): deja sitio a otro."""
+        with self.lock:
+            if client.handshaking:
+                client.handshaking = False
+                self.handshakes -= 1
+
     def add_client(self, client):
         with self.lock:
-            self.clients.append(client)
+            registry = self.registry
+            self.registry = Registry(registry.clients + (client,), registry.nicknames)
 
     def remove_client(self, client):
         with self.lock:
-            if client in self.clients:
-                self.clients.remove(client)
-            try:
-                if client.nickname in self.nicknames and self.nicknames[client.nickname] == client:
-                    del self.nicknames[client.nickname]
-            except (AttributeError, KeyError):
-                pass
+            registry = self.registry
+            clients = tuple(c for c in registry.clients if c is not client)
+            nickname = getattr(client, "nickname", None)
+            nicknames = registry.nicknames
+            if nicknames.get(nickname) is client:
+                nicknames = dict(nicknames)
+                del nicknames[nickname]
+                nicknames = types.MappingProxyType(nicknames)
+            self.registry = Registry(clients, nicknames)
 
     def register_client(self, client, nickname):
         with self.lock:
-            if client.nickname in self.nicknames and self.nicknames[client.nickname] == client:
-                del self.nicknames[client.nickname]
-            self.nicknames[nickname] = client
+            registry = self.registry
+            nicknames = dict(registry.nicknames)
+            if nicknames.get(client.nickname) is client:
+                del nicknames[client.nickname]
+            nicknames[nickname] = client
+            self.registry = Registry(registry.clients, types.MappingProxyType(nicknames))
 
-    def broadcast(self, message_bytes, source_client=None):
-        # Esta función ahora solo la usaremos para mensajes que no necesitan cifrado por cliente (como la lista de usuarios)
+    def write_stats(self):
+        """
+        Suma los contadores de escritura de los clientes conectados. En
+        policy_events van los eventos de la política de colas desde que arrancó
+        el servidor, también los de clientes que ya se desconectaron.
+        """
+        with self.lock:
+            writers = [client.writer for client in self.registry.clients]
+            policy_events = self.retired_policy_events.copy()
+        flushes = sum(writer.flushes for writer in writers)
+        frames = sum(writer.frames_sent for writer in writers)
+        for writer in writers:
+            policy_events.update(writer.policy_events)
+        return {
+            "flushes": flushes,
+            "frames": frames,
+            "bytes": sum(writer.bytes_sent for writer in writers),
+            "frames_per_flush": frames / flushes if flushes else 0.0,
+            "policy_events": dict(policy_events),
+        }
+
+    def retire_writer_stats(self, writer):
+        """Guarda los eventos de la política de un cliente que se desconecta."""
         with self.lock:
-            for client in list(self.clients):
-                if client is not source_client:
-                    client.send(message_bytes)
+            self.retired_policy_events.update(writer.policy_events)
+
+    def broadcast(self, msg_type, /, source_client=None, **payload):
+        # Esta función ahora solo la usaremos para mensajes que no necesitan cifrado por cliente (como la lista de usuarios)
+        # El mensaje se codifica una sola vez por cada codificador en uso.
+        # La foto del registro no cambia, así que se recorre sin candado; enviar solo encola.
+        targets = self._chat_clients(source_client)
+        self._send_to(targets, msg_type, **payload)
     
     def broadcast_message(self, sender_nick, content_text, source_client):
-        with self.lock:
-            # Iteramos sobre una copia de la lista de clientes
-            for client in list(self.clients):
-                # Nos aseguramos de no enviarle el mensaje a quien lo originó y de que el cliente tenga una clave de sesión
-                if client is not source_client and client.session_key:
-                    content_bytes = content_text.encode('utf-8')
-                    # Ciframos el mensaje CON LA CLAVE DE SESIÓN DE CADA CLIENTE DESTINATARIO
-                    nonce, tag, ciphertext = security.encrypt_with_aes(client.session_key, content_bytes)
-                    
-                    encrypted_payload = {
-                        'nonce': base64.b64encode(nonce).decode('ascii'),
-                        'tag': base64.b64encode(tag).decode('ascii'),
-                        'ciphertext': base64.b64encode(ciphertext).decode('ascii')
-                    }
-                    
-                    msg = protocol.create_message("public_message", sender=sender_nick, content=encrypted_payload)
-                    client.send(msg)
+        if self.cluster:
+            self.cluster.publish_public_message(sender_nick, content_text)
+        self.deliver_public_message(sender_nick, content_text, source_client)
+
+    def deliver_public_message(self, sender_nick, content_text, source_client=None):
+        """
+        Cifra y envía un mensaje público a los clientes de este proceso. Los que
+        tienen la clave de grupo actual reciben todos la misma trama, cifrada
+        una sola vez; el resto, una cifrada con su clave de sesión.
+        """
+        # Nos aseguramos de no enviarle el mensaje a quien lo originó y de que el cliente tenga una clave de sesión
+        targets = self._chat_clients(source_client)
+        content_bytes = content_text.encode('utf-8')
+        group = self.group_key
+        if group is not None:
+            members = [client for client in targets if client.group_epoch == group.epoch]
+            if members:
+                nonce, tag, ciphertext = group.cipher.encrypt(content_bytes)
+                self._send_to(
+                    members, "public_message",
+                    sender=sender_nick, content=protocol.encrypted_payload(nonce, tag, ciphertext), epoch=group.epoch
+                )
+                targets = [client for client in targets if client.group_epoch != group.epoch]
+        self._encrypt_for_each(targets, "public_message", content_bytes, sender=sender_nick)
+
+    def _encrypt_for_each(self, targets, msg_type, content_bytes, **payload):
+        """
+        Cifra content_bytes con la clave de sesión de cada destinatario y le
+        manda su trama. Con muchos destinatarios el cifrado se reparte en
+        tandas: una la hace el hilo que llama y el resto el pool de reparto.
+        Las tramas las envía siempre el hilo que llama, tanda a tanda, así
+        cada cliente sigue recibiendo los mensajes en el orden en que se
+        enviaron. Los hilos del pool solo cifran: si enviaran, con la política
+        BLOCK podrían quedarse esperando sitio en la cola de un cliente lento
+        mientras quien llama los espera a ellos (en asyncio, el bucle, que es
+        el único que vacía esas colas).
+        """
+        batches = self._fanout_batches(targets)
+        futures = [
+            self.fanout_pool.submit(self._encrypt_batch, batch, msg_type, content_bytes, payload)
+            for batch in batches[1:]
+        ]
+        self._send_batch(batches[0], self._encrypt_batch(batches[0], msg_type, content_bytes, payload), msg_type)
+        for batch, future in zip(batches[1:], futures):
+            self._send_batch(batch, future.result(), msg_type)
+
+    def _fanout_batches(self, targets):
+        count = min(self.fanout_workers, len(targets) // config.FANOUT_BATCH)
+        if self.fanout_pool is None or count < 2:
+            return [targets]
+        size = -(-len(targets) // count)
+        return [targets[i:i + size] for i in range(0, len(targets), size)]
+
+    def _encrypt_batch(self, targets, msg_type, content_bytes, payload):
+        """Las tramas de una tanda, cada una cifrada con la clave de sesión de su destinatario."""
+        frames = []
+        for client in targets:
+            # Ciframos el mensaje CON LA CLAVE DE SESIÓN DE CADA CLIENTE DESTINATARIO
+            nonce, tag, ciphertext = client.cipher.encrypt(content_bytes)
+            encrypted_payload = protocol.encrypted_payload(nonce, tag, ciphertext)
+            frames.append(client.encoder.encode(msg_type, content=encrypted_payload, **payload))
+        return frames
+
+    def _send_batch(self, targets, frames, msg_type):
+        for client, frame in zip(targets, frames):
+            client.send(frame, kind=msg_type)
 
 
     def broadcast_user_list(self):
-        with self.lock:
-            user_list = list(self.nicknames.keys())
-        self.logger(f"Enviando lista de usuarios: {user_list}")
-        user_list_message = protocol.create_message("user_list_update", users=user_list)
-        self.broadcast(user_list_message)
+        """La lista de usuarios de este proceso ha cambiado (alguien entró o salió)."""
+        if self.cluster:
+            # Los demás procesos también se lo cuentan a sus clientes
+            self.cluster.publish_users(list(self.registry.nicknames))
+        self.presence_changed()
+
+    def presence_changed(self):
+        """
+        Los cambios de la lista de usuarios se agrupan: el primero programa un
+        envío dentro de presence_window segundos, y ese envío lleva todo lo que
+        haya cambiado hasta entonces. Así una avalancha de conexiones acaba en
+        pocos mensajes en vez de una lista entera a cada cliente por cada una.
+        """
+        with self.presence_lock:
+            if self.presence_pending:
+                return
+            self.presence_pending = True
+        timer = threading.Timer(self.presence_window, self._flush_presence)
+        timer.daemon = True
+        timer.start()
+
+    def _flush_presence(self):
+        # Con el candado de presencia: las versiones salen en orden hacia cada cliente
+        with self.presence_lock:
+            self.presence_pending = False
+            current = set(self.registry.nicknames)
+            if self.cluster:
+                current.update(self.cluster.remote_users())
+            left = sorted(self.presence_users - current)
+            joined = sorted(current - self.presence_users)
+            if not left and not joined:
+                return
+            self.presence_users = frozenset(current)
+            targets = self._chat_clients()
+            # Los clientes que no entienden los deltas reciben la lista entera, como antes
+            delta_clients = [client for client in targets if protocol.FEATURE_PRESENCE in client.features]
+            legacy_clients = [client for client in targets if protocol.FEATURE_PRESENCE not in client.features]
+            for msg_type, users in (("presence_leave", left), ("presence_join", joined)):
+                if users:
+                    self.presence_version += 1
+                    self._send_to(delta_clients, msg_type, users=users, version=self.presence_version)
+            self._send_to(legacy_clients, "user_list_update", users=sorted(current))
+            self.logger(f"[PRESENCIA] v{self.presence_version}: entran {joined}, salen {left}.")
+
+    def group_changed(self, client, departed=False):
+        """
+        client entra en el canal público (terminó el handshake) o sale de él.
+        Si sale uno que tenía la clave de grupo, esa clave deja de usarse ya:
+        hasta la siguiente, los públicos van cifrados para cada destinatario.
+        La clave nueva se reparte pasado group_key_window, así una avalancha de
+        entradas y salidas acaba en una sola rotación.
+        """
+        if protocol.FEATURE_GROUP_KEY not in client.features:
+            return
+        with self.group_lock:
+            if departed:
+                if client.group_epoch is None:
+                    return
+                self.group_key = None
+            if self.group_pending:
+                return
+            self.group_pending = True
+        timer = threading.Timer(self.group_key_window, self.rotate_group_key)
+        timer.daemon = True
+        timer.start()
+
+    def rotate_group_key(self):
+        """Crea una clave de grupo nueva y se la manda a cada cliente que la entiende."""
+        with self.group_lock:
+            self.group_pending = False
+            self.group_epoch += 1
+            key = security.generate_session_key()
+            group = GroupKey(self.group_epoch, key, security.server_cipher(key))
+            members = [
+                client for client in self._chat_clients()
+                if protocol.FEATURE_GROUP_KEY in client.features and not client.closed
+            ]
+            for client in members:
+                client.send_message("group_key", epoch=group.epoch, key=client.wrap_key(group.key))
+                # Después de encolar la clave: ningún público con esta época le llega antes
+                client.group_epoch = group.epoch
+            self.group_key = group
+        self.logger(f"[CLAVE DE GRUPO] Época {group.epoch} repartida a {len(members)} clientes.")
+
+    def send_presence_snapshot(self, client):
+        """
+        Lista entera, a un cliente que acaba de entrar o que perdió algún delta.
+        Lleva la versión si el cliente entiende los deltas; si no, es la misma
+        lista sin versión que le manda _flush_presence.
+        """
+        with self.presence_lock:
+            if protocol.FEATURE_PRESENCE in client.features:
+                client.send_message("user_list_update", users=sorted(self.presence_users), version=self.presence_version)
+            else:
+                client.send_message("user_list_update", users=sorted(self.presence_users))
 
     def send_private_message(self, recipient_nick, sender_nick, content_text):
-        recipient_client = None
-        sender_client = None
-        with self.lock:
-            recipient_client = self.nicknames.get(recipient_nick)
-            sender_client = self.nicknames.get(sender_nick)
+        # Los dos nicks se buscan en la misma foto del registro
+        nicknames = self.registry.nicknames
+        sender_client = nicknames.get(sender_nick)
+        if recipient_nick in nicknames or not self.cluster:
+            self.deliver_private_message(recipient_nick, sender_nick, content_text, nicknames)
+        else:
+            # El destinatario puede estar conectado a otro proceso
+            self.cluster.send_private_message(recipient_nick, sender_nick, content_text)
 
         content_bytes = content_text.encode('utf-8')
+        # Cifrar el "eco" para el que envía
+        if sender_client and sender_client.session_key:
+            nonce, tag, ciphertext = sender_client.cipher.encrypt(content_bytes)
+            encrypted_payload = protocol.encrypted_payload(nonce, tag, ciphertext)
+            sender_client.send_message("private_message_echo", recipient=recipient_nick, content=encrypted_payload)
 
+    def deliver_private_message(self, recipient_nick, sender_nick, content_text, nicknames=None):
+        """Cifra y envía un privado a recipient_nick si está conectado a este proceso."""
+        if nicknames is None:
+            nicknames = self.registry.nicknames
+        recipient_client = nicknames.get(recipient_nick)
         # Cifrar para el destinatario
         if recipient_client and recipient_client.session_key:
-            nonce, tag, ciphertext = security.encrypt_with_aes(recipient_client.session_key, content_bytes)
-            encrypted_payload = {
-                'nonce': base64.b64encode(nonce).decode('ascii'),
-                'tag': base64.b64encode(tag).decode('ascii'),
-                'ciphertext': base64.b64encode(ciphertext).decode('ascii')
-            }
-            msg_to_recipient = protocol.create_message("private_message", sender=sender_nick, content=encrypted_payload)
-            recipient_client.send(msg_to_recipient)
-            
-        # Cifrar el "eco" para el que envía
-        if sender_client and sender_client.session_key:
-            nonce, tag, ciphertext = security.encrypt_with_aes(sender_client.session_key, content_bytes)
-            encrypted_payload = {
-                'nonce': base64.b64encode(nonce).decode('ascii'),
-                'tag': base64.b64encode(tag).decode('ascii'),
-                'ciphertext': base64.b64encode(ciphertext).decode('ascii')
-            }
-            echo_to_sender = protocol.create_message("private_message_echo", recipient=recipient_nick, content=encrypted_payload)
-            sender_client.send(echo_to_sender)
+            nonce, tag, ciphertext = recipient_client.cipher.encrypt(content_text.encode('utf-8'))
+            encrypted_payload = protocol.encrypted_payload(nonce, tag, ciphertext)
+            recipient_client.send_message("private_message", sender=sender_nick, content=encrypted_payload)
+
+    def peer_public_key(self, nickname):
+        """
+        Clave pública RSA (PEM) de nickname para cifrarle privados de extremo a
+        extremo, o None si no está en este proceso o no los entiende: entonces
+        se le escribe como antes, con el servidor descifrando y cifrando.
+        """
+        client = self.registry.nicknames.get(nickname)
+        if client is None or client.phase != PHASE_MESSAGES or protocol.FEATURE_E2E not in client.features:
+            return None
+        return client.client_rsa_public_pem.decode('ascii')
+
+    def forward_private_message(self, source_client, payload, message=None, body=None):
+        """
+        Reenvía un privado cifrado de extremo a extremo sin tocar el contenido:
+        al destinatario (si se tiene la trama original, tal cual, añadiendo
+        solo el remitente) y como eco al que lo envía. Si iba cifrado para una
+        clave que ya no es la del destinatario (se volvió a conectar, o se fue),
+        se le devuelve al remitente con la clave actual para que lo reenvíe.
+        """
+        recipient = payload.get("recipient")
+        content = payload.get("content")
+        e2e = payload.get("e2e")
+        recipient_client = self.registry.nicknames.get(recipient)
+        if (
+            recipient_client is None
+            or protocol.FEATURE_E2E not in recipient_client.features
+            or recipient_client.key_fingerprint != e2e.get("to_key")
+        ):
+            source_client.send_message(
+                "peer_key", nickname=recipient, public_key=self.peer_public_key(recipient),
+                bounced={"content": content, "e2e": e2e}
+            )
+            return
+        raw_body = None
+        if body is not None and message is not None:
+            raw_body = protocol.extend_body(body, message, sender=source_client.nickname)
+        self._send_to(
+            [recipient_client], "private_message",
+            raw_body=raw_body, sender=source_client.nickname, recipient=recipient, content=content, e2e=e2e
+        )
+        source_client.send_message("private_message_echo", recipient=recipient, content=content, e2e=e2e)
 
-    def relay_file(self, sender_nick, payload, source_client):
+    def relay_file(self, sender_nick, payload, source_client, message=None, body=None):
         """
         Reenvía un mensaje de archivo al destinatario correcto (público o privado).
+        Si se tiene la trama original, se reenvía tal cual añadiéndole solo el
+        remitente, sin volver a codificar el contenido del archivo.
         """
         recipient = payload.get("recipient")
-        
-        file_msg = protocol.create_message(
+        raw_body = None
+        if body is not None and message is not None:
+            raw_body = protocol.extend_body(body, message, sender=sender_nick)
+
+        self._send_to(
+            self._file_targets(recipient, source_client),
             "file_transfer",
+            raw_body=raw_body,
             sender=sender_nick,
             recipient=recipient,
             filename=payload.get("filename"),
             content=payload.get("content")
         )
 
+    def _file_targets(self, recipient, source_client):
+        """Clientes que deben recibir un archivo dirigido a 'recipient'."""
         if recipient == "public":
-            self.broadcast(file_msg, source_client=source_client)
+            return self._chat_clients(source_client)
+        recipient_client = self.registry.nicknames.get(recipient)
+        return [recipient_client] if recipient_client else []
+
+    def _chat_clients(self, source_client=None):
+        """
+        Clientes de la foto actual del registro que ya están en el bucle de
+        mensajes (con clave de sesión), menos source_client. A uno que aún está
+        en el handshake no se le puede mandar nada: espera las respuestas de
+        cada fase en orden.
+        """
+        return [
+            client for client in self.registry.clients
+            if client is not source_client and client.phase == PHASE_MESSAGES
+        ]
+
+    def _send_to(self, targets, msg_type, on_sent=None, raw_body=None, **payload):
+        """
+        Envía el mismo mensaje a varios clientes, codificándolo una vez por
+        codificador. on_sent se llama una vez por destinatario, cuando su trama
+        sale (o se descarta porque su conexión se cerró).
+        Con raw_body (un cuerpo ya codificado de este mismo mensaje), a los
+        clientes con ese códec se les reenvía tal cual; al resto se le codifica.
+        """
+        raw_codec = protocol.body_codec(raw_body) if raw_body is not None else None
+        frames = {}
+        for client in targets:
+            frame = frames.get(client.encoder)
+            if frame is None:
+                if client.encoder.codec == raw_codec:
+                    frame = client.encoder.wrap(raw_body)
+                else:
+                    frame = client.encoder.encode(msg_type, **payload)
+                frames[client.encoder] = frame
+            if not client.send(frame, on_sent, kind=msg_type) and on_sent:
+                on_sent()
+
+    def relay_file_offer(self, sender_nick, payload, source_client, message=None, body=None):
+        """
+        Anuncia a los destinatarios una transferencia por trozos. La oferta
+        lleva el manifiesto con el hash de cada trozo, así que también se
+        reenvía tal cual cuando se puede; solo cambia la clave de la
+        transferencia, que se vuelve a cifrar con la clave de sesión de cada
+        destinatario. Los trozos, ya cifrados con ella, pasan sin tocarse.
+        Devuelve a cuántos clientes llegó, o None si el transfer_id ya lo usa
+        otra transferencia (lo elige el cliente y el mapa es de todo el servidor).
+        """
+        recipient = payload.get("recipient")
+        transfer_id = payload.get("transfer_id")
+        try:
+            key = source_client.unwrap_key(payload["key"]) if payload.get("key") else None
+        except (ValueError, KeyError, TypeError):
+            self.logger(f"Clave de transferencia no válida de {sender_nick}.")
+            return 0
+
+        targets = self._file_targets(recipient, source_client)
+        with self.lock:
+            taken = transfer_id in self.transfers
+            if not taken:
+                self.transfers[transfer_id] = (source_client, targets)
+        if taken:
+            self.logger(f"[{sender_nick}] El transfer_id {transfer_id} ya está en uso; se ignora la oferta.")
+            return None
+        for client in targets:
+            extra = {"sender": sender_nick}
+            if key is not None:
+                extra["key"] = client.wrap_key(key)
+            frame = None
+            if body is not None and message is not None:
+                raw_body = protocol.extend_body(body, message, **extra)
+                if raw_body is not None and client.encoder.codec == protocol.body_codec(raw_body):
+                    frame = client.encoder.wrap(raw_body)
+            if frame is None:
+                frame = client.encoder.encode(
+                    "file_offer",
+                    recipient=recipient,
+                    transfer_id=transfer_id,
+                    file_id=payload.get("file_id"),
+                    filename=payload.get("filename"),
+                    size=payload.get("size"),
+                    chunk_size=payload.get("chunk_size"),
+                    chunks=payload.get("chunks"),
+                    **extra
+                )
+            client.send(frame)
+        return len(targets)
+
+    def relay_file_need(self, payload, source_client):
+        """
+        Pasa al emisor la lista de trozos que le faltan a un destinatario. Solo
+        se hace caso a quien recibió la oferta: otro cliente no puede pedirle
+        trozos al emisor ni gastarle los file_need que espera.
+        """
+        transfer_id = payload.get("transfer_id")
+        with self.lock:
+            sender_client, recipients = self.transfers.get(transfer_id, (None, ()))
+        if source_client in recipients:
+            sender_client.send_message("file_need", transfer_id=transfer_id, missing=payload.get("missing", []))
+
+    def request_file_resume(self, requester_nick, payload):
+        """Pide al emisor original que vuelva a ofrecer un archivo que quedó a medias."""
+        sender_client = self.registry.nicknames.get(payload.get("sender"))
+        if sender_client:
+            sender_client.send_message("file_resume", file_id=payload.get("file_id"), requester=requester_nick)
+
+    def relay_file_chunk(self, recipient, payload, source_client, body=None):
+        """
+        Reenvía un trozo de archivo; si se tiene la trama original, tal cual.
+        El crédito para el siguiente trozo se le devuelve al emisor cuando el
+        trozo ha salido hacia todos los destinatarios, así el servidor nunca
+        retiene más de una ventana.
+        """
+        transfer_id = payload.get("transfer_id")
+        targets = self._file_targets(recipient, source_client)
+        pending = [len(targets)]
+        pending_lock = threading.Lock()
+
+        def on_sent():
+            with pending_lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                source_client.send_message("file_credit", transfer_id=transfer_id, credits=1)
+
+        if not targets:
+            source_client.send_message("file_credit", transfer_id=transfer_id, credits=1)
+            return
+        self._send_to(
+            targets,
+            "file_chunk",
+            on_sent=on_sent,
+            raw_body=body,
+            transfer_id=transfer_id,
+            index=payload.get("index"),
+            data=payload.get("data")
+        )
+
+    def relay_file_end(self, msg_type, recipient, transfer_id, source_client):
+        """Reenvía el cierre (file_complete o file_cancel) de una transferencia."""
+        with self.lock:
+            # Solo el emisor la cierra: un transfer_id ajeno se queda donde está
+            if self.transfers.get(transfer_id, (None,))[0] is not source_client:
+                return
+            del self.transfers[transfer_id]
+        self._send_to(self._file_targets(recipient, source_client), msg_type, transfer_id=transfer_id)
+
+    # --- Almacén de archivos públicos ---
+
+    def begin_blob_upload(self, client, payload):
+        """
+        Oferta de un archivo público: el servidor es su único destinatario y lo
+        guarda en el almacén. Solo pide los trozos que no tiene, así que un
+        archivo que ya se compartió antes no se vuelve a subir.
+        """
+        transfer_id = payload.get("transfer_id")
+        file_id = payload.get("file_id")
+        try:
+            key = client.unwrap_key(payload["key"]) if payload.get("key") else None
+            upload = self.blob_store.begin_upload(client.nickname, payload)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self.logger(f"[ALMACÉN] Oferta no válida de {client.nickname}: {e}")
+            upload = None
+            file_id = None
+        if upload is not None:
+            missing = upload.missing()
+        elif self.blob_store.info(file_id):
+            missing = []
+            self.logger(f"[ALMACÉN] {payload.get('filename')} ya estaba en el almacén; no se sube.")
         else:
-            with self.lock:
-                recipient_client = self.nicknames.get(recipient)
-            
-            if recipient_client:
-                recipient_client.send(file_msg)
+            # Oferta no válida, o el archivo lo sube otro proceso del clúster: sin
+            # destinatarios, el cliente la da por terminada
+            client.send_message("file_credit", transfer_id=transfer_id, credits=0, recipients=0)
+            return
+        client.uploads[transfer_id] = {"file_id": file_id, "upload": upload, "filename": payload.get("filename"), "key": key}
+        client.send_message("file_credit", transfer_id=transfer_id, credits=self.file_window, recipients=1)
+        client.send_message("file_need", transfer_id=transfer_id, missing=missing)
+
+    def store_blob_chunk(self, client, payload):
+        transfer_id = payload.get("transfer_id")
+        entry = client.uploads[transfer_id]
+        upload = entry["upload"]
+        if upload is None or not upload.add_chunk(payload.get("index"), protocol.as_bytes(payload.get("data")), entry["key"]):
+            self.logger(f"[ALMACÉN] Trozo no válido de {client.nickname} para {entry['filename']}.")
+        client.send_message("file_credit", transfer_id=transfer_id, credits=1)
+
+    def end_blob_upload(self, client, transfer_id, completed):
+        """Cierra una subida; si el archivo ya está en el almacén, avisa a los demás con file_ref."""
+        entry = client.uploads.pop(transfer_id)
+        file_id, upload, filename = entry["file_id"], entry["upload"], entry["filename"]
+        info = self.blob_store.end_upload(upload) if upload is not None else self.blob_store.info(file_id)
+        if not completed or info is None:
+            return
+        self.logger(f"[ALMACÉN] {client.nickname} compartió {filename} ({info['size']} bytes, {file_id[:12]}).")
+        file_ref = {"sender": client.nickname, "recipient": "public", "file_id": file_id, "filename": filename, "size": info["size"]}
+        if self.cluster:
+            # El almacén está en disco: los clientes de otros procesos lo piden a su propio proceso
+            self.cluster.publish_broadcast("file_ref", file_ref)
+        self.broadcast("file_ref", source_client=client, **file_ref)
+
+    def serve_blob(self, client, file_id):
+        """Un cliente pide un archivo del almacén: se le ofrece y él dirá qué trozos le faltan."""
+        info = self.blob_store.info(file_id)
+        if info is None:
+            client.send_message("file_unavailable", file_id=file_id)
+            return
+        download = BlobDownload(client, info, self.file_window)
+        client.downloads[download.transfer_id] = download
+        download.offer()
+
+    def start_blob_download(self, client, payload):
+        download = client.downloads.get(payload.get("transfer_id"))
+        if download is None:
+            return
+        try:
+            blob = self.blob_store.open_blob(download.info["file_id"])
+        except OSError:
+            download.cancel()
+            client.send_message("file_cancel", transfer_id=download.transfer_id)
+            return
+        download.start(blob, payload.get("missing", []))
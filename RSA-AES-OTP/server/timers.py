@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class TimerWheel:
+    """
+    Rueda de temporizadores (hashed timing wheel) para vigilar miles de
+    conexiones sin un temporizador por cada una: el tiempo se divide en ticks
+    de tick segundos y cada elemento se guarda en la casilla de su tick de
+    vencimiento (módulo size). Programar es O(1) y cada tick solo mira su
+    casilla; un vencimiento a más de size ticks da vueltas hasta que le toca.
+    La rueda no llama a nada: expired() devuelve lo que ha vencido y quien la
+    mueve decide qué hacer (p. ej. volver a programarlo si su plazo se alargó,
+    así la actividad de una conexión no tiene que tocar la rueda).
+    """
+
+    def __init__(self, tick=1.0, size=512, clock=time.monotonic):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+        self.origin = clock()
+        self.position = 0  # Último tick ya procesado
+        self.slots = [[] for _ in range(size)]  # Cada casilla: [(tick de vencimiento, elemento)]
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, item, deadline):
+        """Programa item para el instante deadline (según clock)."""
+        with self.lock:
+            # Nunca en un tick ya procesado: vencería una vuelta entera tarde
+            tick = max(int((deadline - self.origin) / self.tick) + 1, self.position + 1)
+            self.slots[tick % self.size].append((tick, item))
+            self.count += 1
+
+    def expired(self, now=None):
+        """Saca y devuelve los elementos cuyo tick ya ha pasado."""
+        if now is None:
+            now = self.clock()
+        target = int((now - self.origin) / self.tick)
+        due = []
+        with self.lock:
+            while self.position < target:
+                self.position += 1
+                slot = self.slots[self.position % self.size]
+                if not slot:
+                    continue
+                later = [entry for entry in slot if entry[0] > self.position]
+                due.extend(item for tick, item in slot if tick <= self.position)
+                slot[:] = later
+            self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,439 @@
+"""
+Un cliente que deja de leer: SocketWriter y TransportWriter tienen que aplicar
+cada política de Backpressure sin perder las tramas que no toca perder, y en
+el servidor el resto de clientes tiene que seguir recibiendo.
+"""
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from common import protocol
+
+
+FRAME_PAD = "x" * 2048
+HIGH_WATER = 16 * 1024
+LOW_WATER = 4 * 1024
+
+
+def frame(kind, index):
+    return protocol.get_encoder(protocol.CODEC_JSON).encode(kind, index=index, pad=FRAME_PAD)
+
+
+def stalled_pair():
+    """Par de sockets con búferes pequeños; nadie lee del segundo hasta que el test quiera."""
+    writer_sock, reader_sock = socket.socketpair()
+    writer_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    reader_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    return writer_sock, reader_sock
+
+
+def read_until_eof(sock):
+    reader = protocol.SocketReader(sock)
+    messages = []
+    while True:
+        message = reader.read_message()
+        if message is None:
+            return [(message["type"], message["payload"]["index"]) for message in messages]
+        messages.append(message)
+
+
+def start_draining(sock):
+    """Empieza a leer en otro hilo; result() devuelve las tramas leídas hasta el cierre."""
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(read_until_eof(sock)), daemon=True)
+    thread.start()
+
+    def finish():
+        thread.join(10)
+        assert not thread.is_alive()
+        return result
+    return finish
+
+
+def backpressure(policy, **kwargs):
+    return protocol.Backpressure(
+        policy, high_water=HIGH_WATER, low_water=LOW_WATER,
+        droppable=("public_message",), coalesced=("user_list_update",), **kwargs
+    )
+
+
+# --- SocketWriter ---
+
+def make_socket_writer(policy, **kwargs):
+    writer_sock, reader_sock = stalled_pair()
+    errors = []
+    writer = protocol.SocketWriter(
+        writer_sock, flush_interval=0.001, on_error=errors.append, backpressure=backpressure(policy, **kwargs)
+    )
+    return writer, writer_sock, reader_sock, errors
+
+
+def close_socket_writer(writer, writer_sock):
+    writer.close(timeout=10)
+    writer_sock.shutdown(socket.SHUT_WR)
+
+
+def test_socket_writer_disconnect():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.DISCONNECT)
+    with writer_sock, reader_sock:
+        accepted = 0
+        while writer.send(frame("private_message", accepted), kind="private_message"):
+            accepted += 1
+            assert accepted < 1000, "la cola no deja de crecer"
+        assert len(errors) == 1
+        assert writer.policy_events["disconnected"] == 1
+        assert not writer.send(frame("private_message", accepted), kind="private_message")
+
+
+def test_socket_writer_block_waits_for_the_reader():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.BLOCK, block_timeout=5.0)
+    with writer_sock, reader_sock:
+        # El lector despierta al rato: los envíos esperan en vez de perder tramas
+        drained = []
+        threading.Timer(0.3, lambda: drained.append(start_draining(reader_sock))).start()
+        sent = [("private_message", index) for index in range(100)]
+        for kind, index in sent:
+            assert writer.send(frame(kind, index), kind=kind)
+        close_socket_writer(writer, writer_sock)
+        assert drained[0]() == sent
+    assert writer.policy_events["blocked"] >= 1
+    assert not errors
+
+
+def test_socket_writer_block_gives_up_after_timeout():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.BLOCK, block_timeout=0.2)
+    with writer_sock, reader_sock:
+        start = time.monotonic()
+        accepted = 0
+        while writer.send(frame("private_message", accepted), kind="private_message"):
+            accepted += 1
+            assert accepted < 1000
+        assert 0.2 <= time.monotonic() - start < 5
+        assert writer.policy_events["disconnected"] == 1
+        assert len(errors) == 1
+
+
+def test_socket_writer_drop_oldest_keeps_what_is_not_droppable():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.DROP_OLDEST)
+    with writer_sock, reader_sock:
+        kinds = ["public_message", "private_message"]
+        sent = [(kinds[index % 2], index) for index in range(200)]
+        for kind, index in sent:
+            writer.send(frame(kind, index), kind=kind)
+        finish = start_draining(reader_sock)
+        close_socket_writer(writer, writer_sock)
+        received = finish()
+    assert writer.policy_events["dropped"] > 0
+    assert [item for item in received if item[0] == "private_message"] == [
+        item for item in sent if item[0] == "private_message"
+    ]
+    assert received == sorted(received, key=lambda item: item[1])
+    assert not errors
+
+
+def test_socket_writer_coalesce_keeps_the_latest():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.COALESCE)
+    with writer_sock, reader_sock:
+        kinds = ["user_list_update", "private_message"]
+        sent = [(kinds[index % 2], index) for index in range(200)]
+        for kind, index in sent:
+            assert writer.send(frame(kind, index), kind=kind)
+        finish = start_draining(reader_sock)
+        close_socket_writer(writer, writer_sock)
+        received = finish()
+    updates = [item for item in received if item[0] == "user_list_update"]
+    assert writer.policy_events["coalesced"] > 0
+    assert len(updates) < 100
+    assert updates[-1] == sent[-2]
+    assert [item for item in received if item[0] == "private_message"] == [
+        item for item in sent if item[0] == "private_message"
+    ]
+    assert not errors
+
+
+def test_socket_writer_reports_a_failing_on_sent():
+    writer, writer_sock, reader_sock, errors = make_socket_writer(protocol.Backpressure.DISCONNECT)
+    with writer_sock, reader_sock:
+        finish = start_draining(reader_sock)
+        notified = []
+
+        def failing():
+            raise RuntimeError("on_sent roto")
+        assert writer.send(frame("private_message", 0), failing, kind="private_message")
+        assert writer.send(frame("private_message", 1), lambda: notified.append(1), kind="private_message")
+        # El hilo escritor sigue vivo: lo que llega después también sale
+        time.sleep(0.1)
+        assert writer.send(frame("private_message", 2), lambda: notified.append(2), kind="private_message")
+        close_socket_writer(writer, writer_sock)
+        assert finish() == [("private_message", index) for index in range(3)]
+    assert notified == [1, 2]
+    assert [str(error) for error in errors] == ["on_sent roto"]
+
+
+# --- TransportWriter ---
+
+class WriterProtocol(asyncio.Protocol):
+    """Lo mínimo de AsyncClientConnection: el transporte avisa al escritor de pausas y cierres."""
+
+    def __init__(self, policy, **kwargs):
+        self.policy = backpressure(policy, **kwargs)
+        self.errors = []
+        self.writer = None
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=4096)
+        self.writer = protocol.TransportWriter(
+            transport, flush_interval=0.001, on_error=self.errors.append, backpressure=self.policy
+        )
+
+    def pause_writing(self):
+        self.writer.pause_writing()
+
+    def resume_writing(self):
+        self.writer.resume_writing()
+
+    def connection_lost(self, exc):
+        self.writer.connection_lost()
+
+
+async def open_transport_writer(policy, **kwargs):
+    writer_sock, reader_sock = stalled_pair()
+    transport, writer_protocol = await asyncio.get_running_loop().connect_accepted_socket(
+        lambda: WriterProtocol(policy, **kwargs), writer_sock
+    )
+    return transport, writer_protocol, reader_sock
+
+
+async def drain_and_close(transport, writer_protocol, reader_sock):
+    finish = start_draining(reader_sock)
+    writer_protocol.writer.close()
+    transport.close()
+    return await asyncio.to_thread(finish)
+
+
+def test_transport_writer_disconnect():
+    async def scenario():
+        transport, writer_protocol, reader_sock = await open_transport_writer(protocol.Backpressure.DISCONNECT)
+        with reader_sock:
+            writer = writer_protocol.writer
+            accepted = 0
+            while writer.send(frame("private_message", accepted), kind="private_message"):
+                accepted += 1
+                assert accepted < 1000
+                await asyncio.sleep(0)
+            assert writer.policy_events["disconnected"] == 1
+            assert len(writer_protocol.errors) == 1
+            transport.abort()
+
+    asyncio.run(scenario())
+
+
+def test_transport_writer_block_waits_for_the_reader():
+    async def scenario():
+        transport, writer_protocol, reader_sock = await open_transport_writer(
+            protocol.Backpressure.BLOCK, block_timeout=5.0
+        )
+        with reader_sock:
+            writer = writer_protocol.writer
+            sent = [("private_message", index) for index in range(500)]
+
+            def send_all():
+                # BLOCK solo hace esperar a quien envía desde otro hilo, no al bucle
+                for kind, index in sent:
+                    assert writer.send(frame(kind, index), kind=kind)
+
+            sender = asyncio.create_task(asyncio.to_thread(send_all))
+            # Con la cola llena el hilo se queda esperando sitio
+            for _ in range(300):
+                if writer.policy_events["blocked"]:
+                    break
+                await asyncio.sleep(0.01)
+            assert writer.policy_events["blocked"] >= 1
+            assert not sender.done()
+            finish = start_draining(reader_sock)
+            await sender
+            writer.close()
+            transport.close()
+            received = await asyncio.to_thread(finish)
+            assert received == sent
+            assert writer.policy_events["blocked"] >= 1
+            assert not writer_protocol.errors
+
+    asyncio.run(scenario())
+
+
+def test_transport_writer_block_gives_up_after_timeout():
+    async def scenario():
+        transport, writer_protocol, reader_sock = await open_transport_writer(
+            protocol.Backpressure.BLOCK, block_timeout=0.2
+        )
+        with reader_sock:
+            writer = writer_protocol.writer
+
+            def send_until_closed():
+                for index in range(1000):
+                    if not writer.send(frame("private_message", index), kind="private_message"):
+                        return index
+                return None
+
+            assert await asyncio.to_thread(send_until_closed) is not None
+            assert writer.policy_events["disconnected"] == 1
+            assert len(writer_protocol.errors) == 1
+            transport.abort()
+
+    asyncio.run(scenario())
+
+
+def test_transport_writer_drop_oldest_keeps_what_is_not_droppable():
+    async def scenario():
+        transport, writer_protocol, reader_sock = await open_transport_writer(protocol.Backpressure.DROP_OLDEST)
+        with reader_sock:
+            writer = writer_protocol.writer
+            kinds = ["public_message", "private_message"]
+            sent = [(kinds[index % 2], index) for index in range(200)]
+            for kind, index in sent:
+                writer.send(frame(kind, index), kind=kind)
+                await asyncio.sleep(0)
+            received = await drain_and_close(transport, writer_protocol, reader_sock)
+            assert writer.policy_events["dropped"] > 0
+            assert [item for item in received if item[0] == "private_message"] == [
+                item for item in sent if item[0] == "private_message"
+            ]
+            assert received == sorted(received, key=lambda item: item[1])
+            assert not writer_protocol.errors
+
+    asyncio.run(scenario())
+
+
+def test_transport_writer_coalesce_keeps_the_latest():
+    async def scenario():
+        transport, writer_protocol, reader_sock = await open_transport_writer(protocol.Backpressure.COALESCE)
+        with reader_sock:
+            writer = writer_protocol.writer
+            kinds = ["user_list_update", "private_message"]
+            sent = [(kinds[index % 2], index) for index in range(200)]
+            for kind, index in sent:
+                assert writer.send(frame(kind, index), kind=kind)
+                await asyncio.sleep(0)
+            received = await drain_and_close(transport, writer_protocol, reader_sock)
+            updates = [item for item in received if item[0] == "user_list_update"]
+            assert writer.policy_events["coalesced"] > 0
+            assert len(updates) < 100
+            assert updates[-1] == sent[-2]
+            assert [item for item in received if item[0] == "private_message"] == [
+                item for item in sent if item[0] == "private_message"
+            ]
+            assert not writer_protocol.errors
+
+    asyncio.run(scenario())
+
+
+# --- Servidor: un cliente atascado no frena a los demás ---
+
+POLICY_EVENTS = {
+    # BLOCK desde el bucle de asyncio no puede esperar: ahí acaba en el tope max_bytes
+    protocol.Backpressure.BLOCK: {"blocked", "disconnected"},
+    protocol.Backpressure.DROP_OLDEST: {"dropped"},
+    # public_message no se acumula: la cola del atascado llega al tope
+    protocol.Backpressure.COALESCE: {"coalesced", "disconnected"},
+    protocol.Backpressure.DISCONNECT: {"disconnected"},
+}
+
+
+@pytest.fixture
+def modules(tmp_path, monkeypatch):
+    # security guarda una clave en el directorio actual al importarse
+    monkeypatch.chdir(tmp_path)
+    from common import security
+    from client.network import handler
+    from server.server import ChatServer
+    from server.async_server import AsyncChatServer
+    return security, handler, {"threads": ChatServer, "asyncio": AsyncChatServer}
+
+
+def start_server(server_class, policy):
+    server = server_class(
+        "127.0.0.1", 0, logger=lambda *args: None, blob_dir=None,
+        backpressure=protocol.Backpressure(
+            policy, high_water=256 * 1024, low_water=64 * 1024, max_bytes=1024 * 1024,
+            droppable=("public_message",), coalesced=("user_list_update",), block_timeout=1.0
+        )
+    )
+    server.start_in_thread()
+    for _ in range(200):
+        # El socket existe antes de bind(): hasta entonces el puerto es 0
+        port = server.server_socket.getsockname()[1] if server.server_socket is not None else 0
+        if port:
+            return server, port
+        time.sleep(0.01)
+    raise RuntimeError("El servidor no arranca")
+
+
+def login(modules, port, nickname, rcvbuf=None):
+    """Cliente con las cuatro fases hechas; rcvbuf limita lo que el sistema le guarda sin leer."""
+    security, handler, _ = modules
+    messages = []
+    network = handler.NetworkHandler(
+        lambda msg_type, payload: messages.append((msg_type, payload)), lambda reason: None
+    )
+    real_socket = socket.socket
+
+    def small_socket(*args, **kwargs):
+        sock = real_socket(*args, **kwargs)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        return sock
+
+    if rcvbuf:
+        socket.socket = small_socket
+    try:
+        assert network.connect("127.0.0.1", port)
+    finally:
+        socket.socket = real_socket
+    challenge = protocol.as_bytes(network.reader.read_message()["payload"]["challenge"])
+    otp = security.decrypt_with_rsa(network.rsa_private_key, challenge)
+    network.is_listening = True  # send() solo manda con la conexión activa
+    network.send("otp_response", response=security.encrypt_with_rsa(network.server_rsa_public_pem, otp))
+    assert network.reader.read_message()["type"] == "auth_success"
+    network.session_key = security.generate_session_key()
+    network.send("aes_key_exchange", key=security.encrypt_with_rsa(network.server_rsa_public_pem, network.session_key))
+    assert network.reader.read_message()["type"] == "secure_channel_ready"
+    network.send("login", nickname=nickname)
+    return network, messages
+
+
+def public_texts(network, messages):
+    return [
+        network.decrypt_content(payload).decode()
+        for msg_type, payload in list(messages) if msg_type == "public_message"
+    ]
+
+
+@pytest.mark.parametrize("backend", ["threads", "asyncio"])
+@pytest.mark.parametrize("policy", protocol.Backpressure.POLICIES)
+def test_stalled_client_does_not_stop_the_others(modules, backend, policy):
+    server, port = start_server(modules[2][backend], policy)
+    stalled, _ = login(modules, port, "atascado", rcvbuf=4096)
+    reader, received = login(modules, port, "lectora")
+    threading.Thread(target=reader.listen, daemon=True).start()
+    sender, _ = login(modules, port, "emisor")
+    threading.Thread(target=sender.listen, daemon=True).start()
+    time.sleep(0.3)  # Que la lista de usuarios y la clave de grupo lleguen a todos
+
+    # Nadie lee del socket de "atascado"; son muchos más bytes de los que caben
+    # en los búferes. Se envía por tandas al ritmo de "lectora", que sí lee.
+    padding = "x" * 16 * 1024
+    sent = [f"{index} {padding}" for index in range(600)]
+    deadline = time.monotonic() + 60
+    for start in range(0, len(sent), 5):
+        for text in sent[start:start + 5]:
+            sender.send("public_message", content=protocol.encrypted_payload(*sender.cipher.encrypt(text.encode())))
+        while sum(msg_type == "public_message" for msg_type, _ in list(received)) < start + 5 \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert public_texts(reader, received) == sent
+    assert set(server.write_stats()["policy_events"]) & POLICY_EVENTS[policy]
+    for network in (stalled, reader, sender):
+        network.disconnect()
@@ -0,0 +1,41 @@
+"""
+Cuerpos binarios mal formados: decode_message solo puede lanzar ValueError,
+que es lo que capturan el hilo lector del cliente y las sesiones del servidor.
+"""
+import pytest
+
+from common import protocol
+
+
+def binary_body():
+    encoder = protocol.get_encoder(protocol.CODEC_BINARY)
+    frame = encoder.encode(
+        "file_chunk",
+        transfer_id="t1",
+        index=3,
+        data=bytes(range(64)),
+        extra=[1, 2.5, "ñ", None, True, {"k": b"v"}],
+    )
+    return frame[4:]
+
+
+def test_round_trip():
+    message = protocol.decode_message(binary_body())
+    assert message["payload"]["extra"][-1] == {"k": b"v"}
+
+
+@pytest.mark.parametrize("size", range(1, len(binary_body())))
+def test_truncated_body_raises_value_error(size):
+    with pytest.raises(ValueError):
+        protocol.decode_message(binary_body()[:size])
+
+
+@pytest.mark.parametrize("body", [
+    bytes.fromhex("b105"),  # tipo de 5 bytes que no están
+    bytes.fromhex("b10178" "0001" "0161" "ff"),  # etiqueta desconocida
+    bytes.fromhex("b10178" "0002" "0161" "00"),  # dice dos campos y trae uno
+    bytes.fromhex("b10178" "0000" "0161" "00"),  # dice cero y sobran bytes
+])
+def test_malformed_body_raises_value_error(body):
+    with pytest.raises(ValueError):
+        protocol.decode_message(body)
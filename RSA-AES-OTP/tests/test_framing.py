@@ -0,0 +1,140 @@
+"""
+Tramas partidas en cualquier punto: FrameDecoder y SocketReader tienen que
+entregar cada mensaje exactamente una vez, también cuando el corte cae dentro
+del prefijo de longitud.
+"""
+import socket
+import threading
+
+import pytest
+
+from common import protocol
+
+
+MESSAGES = [
+    ("public_message", {"sender": "ana", "content": "hola"}),
+    ("ping", {}),
+    ("file_chunk", {"transfer_id": "t1", "index": 3, "data": bytes(range(256)) * 3}),
+    ("private_message", {"sender": "bob", "content": "ñandú " * 40}),
+]
+
+
+def encoded_stream(codec):
+    encoder = protocol.get_encoder(codec)
+    return b"".join(encoder.encode(msg_type, **payload) for msg_type, payload in MESSAGES)
+
+
+def expected(codec):
+    decoder = protocol.FrameDecoder()
+    return decoder.feed(encoded_stream(codec))
+
+
+def split_points(stream):
+    # Un corte en cada posición, y también el flujo partido byte a byte
+    for offset in range(1, len(stream)):
+        yield [stream[:offset], stream[offset:]]
+    yield [stream[i:i + 1] for i in range(len(stream))]
+
+
+@pytest.mark.parametrize("codec", [protocol.CODEC_JSON, protocol.CODEC_BINARY])
+def test_feed_split_at_every_offset(codec):
+    stream = encoded_stream(codec)
+    want = expected(codec)
+    assert [message["type"] for message in want] == [msg_type for msg_type, _ in MESSAGES]
+    for pieces in split_points(stream):
+        decoder = protocol.FrameDecoder(buffer_size=16)
+        got = []
+        for piece in pieces:
+            got.extend(decoder.feed(piece))
+        assert got == want
+
+
+@pytest.mark.parametrize("codec", [protocol.CODEC_JSON, protocol.CODEC_BINARY])
+def test_get_buffer_split_at_every_offset(codec):
+    stream = encoded_stream(codec)
+    want = expected(codec)
+    for pieces in split_points(stream):
+        decoder = protocol.FrameDecoder(buffer_size=16)
+        got = []
+        for piece in pieces:
+            while piece:
+                buffer = decoder.get_buffer()
+                count = min(len(buffer), len(piece))
+                buffer[:count] = piece[:count]
+                decoder.buffer_updated(count)
+                piece = piece[count:]
+                # Las tramas se decodifican antes de volver a tocar el búfer
+                got.extend(protocol.decode_message(frame) for frame in decoder.frames())
+        assert got == want
+        assert decoder.next_frame() is None
+
+
+class PieceSocket:
+    """Socket de mentira: cada recv_into entrega como mucho uno de los trozos."""
+
+    def __init__(self, pieces):
+        self.pieces = [memoryview(piece) for piece in pieces]
+
+    def recv_into(self, buffer):
+        if not self.pieces:
+            return 0
+        piece = self.pieces[0]
+        count = min(len(buffer), len(piece))
+        buffer[:count] = piece[:count]
+        if count == len(piece):
+            self.pieces.pop(0)
+        else:
+            self.pieces[0] = piece[count:]
+        return count
+
+
+def read_all(reader):
+    messages = []
+    while True:
+        message = reader.read_message()
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def test_socket_reader_split_at_every_offset():
+    stream = encoded_stream(protocol.CODEC_BINARY)
+    want = expected(protocol.CODEC_BINARY)
+    for pieces in split_points(stream):
+        reader = protocol.SocketReader(PieceSocket(pieces), buffer_size=16)
+        assert read_all(reader) == want
+
+
+def test_socket_reader_over_socketpair():
+    stream = encoded_stream(protocol.CODEC_JSON) * 50
+    reader_sock, writer_sock = socket.socketpair()
+    with reader_sock, writer_sock:
+        def send():
+            for i in range(0, len(stream), 7):
+                writer_sock.sendall(stream[i:i + 7])
+            writer_sock.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        got = read_all(protocol.SocketReader(reader_sock, buffer_size=16))
+        sender.join()
+    assert got == expected(protocol.CODEC_JSON) * 50
+
+
+def test_oversized_prefix_is_rejected_without_allocating():
+    decoder = protocol.FrameDecoder(buffer_size=16)
+    decoder.feed((protocol.MAX_FRAME_SIZE + 1).to_bytes(4, "big")[:2])
+    with pytest.raises(ValueError):
+        decoder.feed((protocol.MAX_FRAME_SIZE + 1).to_bytes(4, "big")[2:])
+    assert len(decoder.get_buffer()) < 1024
+
+
+def test_large_frame_buffer_grows_with_the_data():
+    body = b"x" * (1024 * 1024)
+    frame = protocol.get_encoder(protocol.CODEC_BINARY).encode("file_chunk", data=body)
+    decoder = protocol.FrameDecoder(buffer_size=16)
+    decoder.feed(frame[:4096])
+    # Con 4 KiB recibidos el búfer no se ha reservado con lo que dice el prefijo
+    assert len(decoder.get_buffer()) < 16 * 1024
+    messages = decoder.feed(frame[4096:])
+    assert [bytes(message["payload"]["data"]) for message in messages] == [body]